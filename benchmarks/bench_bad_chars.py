@@ -0,0 +1,68 @@
+"""
+Character checks per second with the old per-character list scans vs. the
+frozensets checkForBadCharsUsername and checkForBadCharsPost use now, for
+a username and for a 4,000 character post.
+
+    python benchmarks/bench_bad_chars.py
+"""
+
+import time
+import string
+
+PERMITTED_USERNAME = list(string.ascii_letters) + list(string.digits) + ["_", "-"]
+PERMITTED_POST = list(string.ascii_letters) + list(string.digits) + list(string.punctuation) + [" "]
+
+USERNAME = frozenset(PERMITTED_USERNAME)
+POST = frozenset(PERMITTED_POST)
+
+VALUES = {
+    "username": ("Meower_Bot-2022", PERMITTED_USERNAME, USERNAME),
+    "post": (("The quick brown fox jumps over the lazy dog, 42 times! " * 80)[:4000], PERMITTED_POST, POST),
+}
+
+
+def old_check(value, permitted):
+    # The loop checkForBadChars* used to run
+    badchars = False
+    for char in value:
+        if not char in permitted:
+            badchars = True
+            break
+    return badchars
+
+
+def new_check(value, permitted):
+    return not permitted.issuperset(value)
+
+
+def run(check, value, permitted, repeat=5):
+    count = 0
+    best = None
+    while True:
+        count = count * 2 or 1
+        start = time.perf_counter()
+        for i in range(count):
+            check(value, permitted)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0.2:
+            break
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(count):
+            check(value, permitted)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count / best
+
+
+def main():
+    print("{0:>10} {1:>16} {2:>16} {3:>10}".format("value", "before checks/s", "after checks/s", "speedup"))
+    for name, (value, old_permitted, new_permitted) in VALUES.items():
+        before = run(old_check, value, old_permitted)
+        after = run(new_check, value, new_permitted)
+        print("{0:>10} {1:>16.0f} {2:>16.0f} {3:>9.0f}x".format(name, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Broadcast latency against connected client count, serializing per client
+(the old CloudLink._send_to_all) vs. once per client type.
+
+Clients are socketpairs, so the timings include one send() per client.
+A tenth of the clients are Scratch clients. The last column has Trusted
+Access on (as main.py runs it) with every client trusted, so each one is
+checked against the trusted clients and the IP blocklist.
+
+    python benchmarks/bench_broadcast.py
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from cloudlink import CloudLink
+from websocket_server import WebSocketHandler
+from websocket_server.websocket_server import WebsocketServerBase
+
+COUNTS = [100, 1000, 5000]
+ROUNDS = 20
+
+PAYLOAD = {
+    "cmd": "direct",
+    "val": {
+        "mode": 1,
+        "_id": "00000000-0000-0000-0000-000000000000",
+        "post_origin": "home",
+        "u": "someone",
+        "t": {"mo": "01", "d": "01", "y": "2022", "h": "00", "mi": "00", "s": "00", "e": 1640995200},
+        "p": "Hello, world! " * 10,
+        "isDeleted": False,
+    },
+}
+
+
+class Handler(WebSocketHandler):
+    # Writes straight to the socket, leaving the writer thread out of the timings
+    def send_frame(self, *buffers):
+        self.request.sendmsg(buffers)
+
+
+def make_link(count):
+    cl = CloudLink()
+    cl.state = 1
+    cl.wss = WebsocketServerBase()
+    cl.wss._clients = {}
+    cl.wss._clients_lock = threading.Lock()
+    cl.statedata = {"ulist": {"usernames": {}, "objs": {}}, "secure_enable": False, "gmsg": "", "trusted": set(), "ip_blocklist": set([""])}
+
+    peers = []
+    for client_id in range(1, count + 1):
+        ours, theirs = socket.socketpair()
+        handler = Handler.__new__(Handler)
+        handler.request = ours
+        handler.deflate = None
+        client = {"id": client_id, "handler": handler, "address": ("127.0.0.1", 0)}
+        client_type = "scratch" if client_id % 10 == 0 else "js"
+        cl.statedata["ulist"]["objs"][client_id] = {"object": client, "username": "", "ip": "127.0.0.1", "type": client_type}
+        cl.wss._clients[handler] = client
+        cl.statedata["trusted"].add(client_id)
+        peers.append(theirs)
+    return cl, peers
+
+
+def send_to_all_per_client(cl, payload):
+    # CloudLink._send_to_all before encode-once
+    tmp_payload = payload
+    for client in cl.wss.clients:
+        if cl._get_client_type(client) == "scratch":
+            if ("val" in payload) and (type(payload["val"]) == dict):
+                tmp_payload["val"] = json.dumps(payload["val"])
+            cl.wss.send_message(client, json.dumps(tmp_payload))
+        else:
+            cl.wss.send_message(client, json.dumps(payload))
+
+
+def drain(peers):
+    for peer in peers:
+        peer.recv(1 << 20)
+
+
+def measure(cl, peers, broadcast):
+    elapsed = 0.0
+    for _ in range(ROUNDS):
+        payload = json.loads(json.dumps(PAYLOAD))
+        start = time.perf_counter()
+        broadcast(payload)
+        elapsed += time.perf_counter() - start
+        drain(peers)
+    return elapsed / ROUNDS * 1000
+
+
+def main():
+    print("{0:>8} {1:>12} {2:>12} {3:>8} {4:>12}".format("clients", "before ms", "after ms", "speedup", "trusted ms"))
+    for count in COUNTS:
+        cl, peers = make_link(count)
+        before = measure(cl, peers, lambda payload: send_to_all_per_client(cl, payload))
+        after = measure(cl, peers, cl._send_to_all)
+        cl.statedata["secure_enable"] = True
+        trusted = measure(cl, peers, cl._send_to_all)
+        print("{0:>8} {1:>12.2f} {2:>12.2f} {3:>7.1f}x {4:>12.2f}".format(count, before, after, before / after, trusted))
+        for client in cl.wss.clients:
+            client["handler"].request.close()
+        for peer in peers:
+            peer.close()
+
+
+if __name__ == "__main__":
+    main()
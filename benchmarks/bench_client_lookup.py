@@ -0,0 +1,105 @@
+"""
+Per-message client lookup overhead against connected client count, with the
+old linear scan of WebsocketServer.clients vs. the handler-keyed dict, plus
+the username and IP lookups CloudLink and Meower do per packet.
+
+Handlers are bare objects, nothing is sent; the timings are the lookup alone.
+
+    python benchmarks/bench_client_lookup.py
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from cloudlink import CloudLink
+from websocket_server.websocket_server import WebsocketServerBase
+
+COUNTS = [100, 1000, 10000]
+LOOKUPS = 20000
+
+
+class Handler:
+    def __init__(self, ip):
+        self.client_address = (ip, 0)
+        self.ip = ip
+        self.denied = None
+
+
+def make_server(count):
+    server = WebsocketServerBase()
+    server._clients = {}
+    server._clients_lock = threading.Lock()
+    server._deny_clients = False
+    server.id_counter = 0
+    handlers = []
+    for i in range(count):
+        handler = Handler("10.0.{0}.{1}".format(i // 256, i % 256))
+        server._add_client_(handler)
+        handlers.append(handler)
+    return server, handlers
+
+
+def make_link(server):
+    cl = CloudLink()
+    cl.state = 1
+    cl.wss = server
+    cl.statedata = {"ulist": {"usernames": {}, "objs": {}}, "secure_enable": False, "motd_enable": False, "gmsg": ""}
+    cl.ulist_window = 3600 # Keep the broadcast timer from firing during the run
+    cl.wss.send_message = lambda client, msg: None
+    for client in server.clients:
+        cl._on_connection_server(client, server)
+        cl.setUsername(client, "user{0}".format(client["id"]))
+    return cl
+
+
+def handler_to_client_scan(clients, handler):
+    # WebsocketServer.handler_to_client before the dict index
+    for client in clients:
+        if client['handler'] == handler:
+            return client
+
+
+def usernames_scan(cl, username):
+    # Meower's `username in self.cl.getUsernames()` before isUsernameOnline
+    return username in cl.getUsernames()
+
+
+def ip_scan(cl, ip):
+    # Meower's IP ban kick loop before getClientsOfIP
+    return [entry["object"] for entry in list(cl.statedata["ulist"]["objs"].values()) if entry["ip"] == ip]
+
+
+def measure(function, keys):
+    start = time.perf_counter()
+    for key in keys:
+        function(key)
+    return (time.perf_counter() - start) / len(keys) * 1000000
+
+
+def main():
+    print("{0:>8} {1:>18} {2:>12} {3:>12} {4:>8}".format("clients", "lookup", "before us", "after us", "speedup"))
+    for count in COUNTS:
+        server, handlers = make_server(count)
+        cl = make_link(server)
+        clients = server.clients
+        rng = random.Random(count)
+
+        keys = [rng.choice(handlers) for _ in range(LOOKUPS)]
+        rows = [("handler -> client", measure(lambda handler: handler_to_client_scan(clients, handler), keys), measure(server.handler_to_client, keys))]
+
+        keys = ["user{0}".format(rng.randint(1, count)) for _ in range(LOOKUPS // 10)]
+        rows.append(("username online", measure(lambda username: usernames_scan(cl, username), keys), measure(cl.isUsernameOnline, keys)))
+
+        keys = [rng.choice(handlers).ip for _ in range(LOOKUPS // 100)]
+        rows.append(("ip -> clients", measure(lambda ip: ip_scan(cl, ip), keys), measure(cl.getClientsOfIP, keys)))
+
+        for name, before, after in rows:
+            print("{0:>8} {1:>18} {2:>12.3f} {3:>12.3f} {4:>7.1f}x".format(count, name, before, after, before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Bytes on the wire and CPU per packet for the CloudLink codecs, JSON vs.
+MessagePack, over a Meower traffic mix: home post broadcasts, statuscode
+replies, pings, chat typing states, username lists and home index pages
+going out, and the packets clients send to make posts coming in.
+
+Packets are serialized with the same CloudLink helpers the server uses, so
+statuscodes go through the spliced-listener cache. Needs msgpack.
+
+    python benchmarks/bench_codec.py
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from cloudlink import CloudLink, Packet, msgpack
+
+ROUNDS = 20000
+CODECS = [None, "msgpack"]
+
+rng = random.Random(0)
+WORDS = "the a meower post cat hello world today just scratch project lol new update when why".split()
+
+
+def post_text():
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))
+
+
+def timestamp():
+    return {"mo": "10", "d": "18", "y": "2026", "h": "14", "mi": "05", "s": "33", "e": 1792332333}
+
+
+def home_post():
+    return {"cmd": "direct", "val": {
+        "type": 1, "post_origin": "home", "u": "user{0}".format(rng.randint(1, 500)), "t": timestamp(),
+        "p": post_text(), "post_id": str(uuid.UUID(int=rng.getrandbits(128))), "isDeleted": False, "mode": 1,
+    }}
+
+
+def typing_state():
+    return {"cmd": "direct", "val": {"chatid": "livechat", "u": "user{0}".format(rng.randint(1, 500)), "state": 101}}
+
+
+def home_index():
+    return {"cmd": "direct", "val": {"mode": "home", "payload": {
+        "query": {"post_origin": "home", "isDeleted": False}, "index": [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(25)], "page#": 1, "pages": 40,
+    }}, "listener": "get_home"}
+
+
+ULIST = {"cmd": "ulist", "val": "".join("user{0};".format(i) for i in range(200))}
+
+# (name, share of outbound packets, packet factory)
+OUTBOUND = [
+    ("post broadcast", 0.30, home_post),
+    ("statuscode", 0.30, None),
+    ("ping", 0.10, lambda: {"cmd": "ping", "val": "I:100 | OK", "listener": "ping"}),
+    ("typing state", 0.15, typing_state),
+    ("ulist", 0.05, lambda: ULIST),
+    ("home index", 0.05, home_index),
+    ("delete", 0.05, lambda: {"cmd": "direct", "val": {"mode": "delete", "id": str(uuid.UUID(int=rng.getrandbits(128)))}}),
+]
+
+
+def inbound_post():
+    return {"cmd": "direct", "val": {"cmd": "post_home", "val": post_text()}, "listener": "post"}
+
+
+def measure(function, items):
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    return (time.perf_counter() - start) / len(items) * 1000000
+
+
+def main():
+    if msgpack == None:
+        print("msgpack is not installed")
+        return
+    cl = CloudLink()
+
+    print("{0:>16} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10}".format("packet", "share", "json B", "msgpack B", "json us", "msgpack us"))
+    totals = {codec: [0.0, 0.0] for codec in CODECS}
+    rows = {}
+    for name, share, factory in OUTBOUND:
+        row = []
+        for codec in CODECS:
+            if factory == None:
+                encode = lambda listener: cl._get_code_packet("OK", True, listener, codec)
+                items = ["post{0}".format(i % 100) for i in range(ROUNDS)]
+            else:
+                encode = lambda payload: cl._encode_packet(payload, codec)
+                items = [factory() for i in range(ROUNDS // 10)]
+            size = sum(len(encode(item)) for item in items) / len(items)
+            cpu = measure(encode, items)
+            totals[codec][0] += share * size
+            totals[codec][1] += share * cpu
+            row += [size, cpu]
+        rows[name] = row
+        print("{0:>16} {1:>5.0f}% {2:>10.1f} {4:>10.1f} {3:>10.2f} {5:>10.2f}".format(name, share * 100, *row))
+
+    json_bytes, json_cpu = totals[None]
+    packed_bytes, packed_cpu = totals["msgpack"]
+    print("{0:>16} {1:>6} {2:>10.1f} {3:>10.1f} {4:>10.2f} {5:>10.2f}".format("outbound mix", "", json_bytes, packed_bytes, json_cpu, packed_cpu))
+
+    # Inbound: parse into a Packet, the way _on_packet_server does
+    items = [inbound_post() for i in range(ROUNDS // 10)]
+    row = []
+    for codec in CODECS:
+        encoded = [cl._encode_packet(item, codec) for item in items]
+        decode = None if codec == None else cl.codecs[codec][1]
+        row += [sum(map(len, encoded)) / len(encoded), measure(lambda message: Packet(None, message, decode), encoded)]
+    print("{0:>16} {1:>6} {2:>10.1f} {4:>10.1f} {3:>10.2f} {5:>10.2f}".format("inbound post", "", *row))
+
+    print()
+    json_post, packed_post = rows["post broadcast"][0], rows["post broadcast"][2]
+    print("bytes per post broadcast: json {0:.1f}, msgpack {1:.1f} ({2:.0f}% smaller)".format(json_post, packed_post, (1 - packed_post / json_post) * 100))
+    print("outbound mix: {0:.0f}% fewer bytes, {1:.2f}x the CPU per packet".format((1 - packed_bytes / json_bytes) * 100, packed_cpu / json_cpu))
+
+
+if __name__ == "__main__":
+    main()
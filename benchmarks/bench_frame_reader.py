@@ -0,0 +1,116 @@
+"""
+Client frames read per second, and recv calls per frame, through the
+buffered file the handler used to read with vs. FrameReader. The frames
+come over a socketpair from another thread, as fast as it can send them.
+
+    python benchmarks/bench_frame_reader.py
+"""
+
+import io
+import os
+import sys
+import json
+import socket
+import struct
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from websocket_server import FrameReader, unmask, PAYLOAD_LEN
+
+FRAMES = 20000
+
+MESSAGES = {
+    "ping": (0x89, b''),
+    "set_chat_state": (0x81, json.dumps({"cmd": "direct", "val": {"cmd": "set_chat_state", "val": {"chatid": "livechat", "state": 101}}}).encode()),
+    "post_home": (0x81, json.dumps({"cmd": "direct", "val": {"cmd": "post_home", "val": "Hello, world! " * 100}}).encode()),
+}
+
+
+def masked_frame(b1, payload):
+    masks = os.urandom(4)
+    if len(payload) < 126:
+        header = bytes([b1, 0x80 | len(payload)])
+    else:
+        header = bytes([b1, 0x80 | 126]) + struct.pack(">H", len(payload))
+    return header + masks + unmask(masks, payload)
+
+
+class CountingSocket(io.RawIOBase):
+    """
+    Counts the recv calls made on a socket, usable as the raw file under a
+    BufferedReader too
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.recvs = 0
+
+    def readable(self):
+        return True
+
+    def recv_into(self, buffer):
+        self.recvs += 1
+        return self.sock.recv_into(buffer)
+
+    readinto = recv_into
+
+
+class FileHandler():
+    # How WebSocketHandler used to read, from StreamRequestHandler's rfile
+    def __init__(self, sock):
+        self.rfile = io.BufferedReader(sock)
+
+    def read_bytes(self, num):
+        return self.rfile.read(num)
+
+
+def read_frames_from_file(sock):
+    handler = FileHandler(sock)
+    for i in range(FRAMES):
+        b1, b2 = handler.read_bytes(2)
+        payload_length = b2 & PAYLOAD_LEN
+        if payload_length == 126:
+            payload_length = struct.unpack(">H", handler.rfile.read(2))[0]
+        masks = handler.read_bytes(4)
+        unmask(masks, handler.read_bytes(payload_length))
+
+
+def read_frames(sock):
+    reader = FrameReader(sock)
+    for i in range(FRAMES):
+        b1, b2, payload_length, masks, payload = reader.read_frame()
+        if payload is None:
+            payload = reader.read(payload_length)
+        unmask(masks, payload)
+
+
+def run(read, data, repeat=5):
+    best = None
+    for i in range(repeat):
+        sender, receiver = socket.socketpair()
+        thread = threading.Thread(target=sender.sendall, args=(data,))
+        thread.start()
+        sock = CountingSocket(receiver)
+        start = time.perf_counter()
+        read(sock)
+        elapsed = time.perf_counter() - start
+        thread.join()
+        sender.close()
+        receiver.close()
+        if best is None or elapsed < best:
+            best = elapsed
+    return FRAMES / best, sock.recvs / FRAMES
+
+
+def main():
+    print("{0:>16} {1:>16} {2:>16} {3:>14} {4:>14}".format("frame", "before frames/s", "after frames/s", "before recv/f", "after recv/f"))
+    for name, (b1, payload) in MESSAGES.items():
+        data = b''.join(masked_frame(b1, payload) for i in range(FRAMES))
+        before, before_recvs = run(read_frames_from_file, data)
+        after, after_recvs = run(read_frames, data)
+        print("{0:>16} {1:>16.0f} {2:>16.0f} {3:>14.4f} {4:>14.4f}".format(name, before, after, before_recvs, after_recvs))
+
+
+if __name__ == "__main__":
+    main()
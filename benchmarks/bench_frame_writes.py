@@ -0,0 +1,158 @@
+"""
+Bytes allocated to get one broadcast written to every client, with frames
+joined into one bytes object per send (before) vs. header and payload
+gathered by sendmsg (after). Each client already has a small frame queued,
+as happens under load, so the writer sends two frames at once.
+
+Allocations are measured with tracemalloc: the peak above the baseline of
+every step, building the frame and each client's write, summed up. The
+times are taken in a second run without tracemalloc.
+
+    python benchmarks/bench_frame_writes.py
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from websocket_server import WebSocketHandler, WebsocketServer, make_frame_header, try_decode_UTF8, encode_to_UTF8
+from websocket_server.websocket_server import WebsocketServerBase
+from websocket_server.writer import WRITE_IDLE, WRITE_BLOCKED
+
+COUNTS = [10, 100, 1000]
+SIZES = [256, 4096]
+ROUNDS = 5
+
+
+def make_payload_frame_before(payload, opcode, rsv=0):
+    header = bytearray(make_frame_header(opcode, len(payload), rsv))
+    return bytes(header + payload)
+
+
+class BeforeServer(WebsocketServerBase):
+    def _build_frame_(self, payload, opcode, rsv=0):
+        # The bytes message went through try_decode_UTF8 and back
+        payload = encode_to_UTF8(try_decode_UTF8(payload))
+        return (make_payload_frame_before(payload, opcode, rsv),)
+
+
+class AfterServer(WebsocketServerBase):
+    _build_frame_ = WebsocketServer._build_frame_
+
+
+class BeforeHandler(WebSocketHandler):
+    def write_some(self):
+        # WebSocketHandler.write_some before sendmsg: everything queued is joined and sent
+        while True:
+            with self._send_ready:
+                if self._writing is None:
+                    if not self._send_queue:
+                        self._write_scheduled = False
+                        return WRITE_IDLE
+                    self._writing = memoryview(self._take_frames())
+                data = self._writing
+            try:
+                sent = self.request.send(data, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return WRITE_BLOCKED
+            with self._send_ready:
+                self._queued_bytes -= sent
+                if sent < len(data):
+                    self._writing = data[sent:]
+                    return WRITE_BLOCKED
+                self._writing = None
+
+
+class AfterHandler(WebSocketHandler):
+    pass
+
+
+def make_server(server_class, handler_class, count):
+    server = server_class()
+    server._clients = {}
+    server._clients_lock = threading.Lock()
+    server.send_queue_limit = 0
+    peers = []
+    for client_id in range(count):
+        ours, theirs = socket.socketpair()
+        handler = handler_class.__new__(handler_class)
+        handler.request = ours
+        handler.server = server
+        handler.deflate = None
+        handler._send_lock = threading.Lock()
+        handler._send_ready = threading.Condition(handler._send_lock)
+        handler._send_queue = deque()
+        handler._queued_bytes = 0
+        handler._write_scheduled = False
+        handler._writing = None
+        handler._write_error = False
+        handler._send_closing = False
+        handler._evicted = False
+        handler._writer = None
+        server._clients[handler] = {"id": client_id, "handler": handler, "address": ("127.0.0.1", 0)}
+        peers.append(theirs)
+    return server, peers
+
+
+def allocated(step):
+    # Peak bytes above what was allocated before the step
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    step()
+    return tracemalloc.get_traced_memory()[1] - current
+
+
+def broadcast(server, peers, message, step):
+    clients = server.clients
+    server._multicast_to(clients, b'{"cmd": "statuscode", "val": "I:100 | OK"}')
+    result = step(lambda: server._multicast_to(clients, message))
+    for client in clients:
+        result += step(client["handler"].write_some)
+    for peer in peers:
+        peer.recv(1 << 20)
+    return result
+
+
+def timed(step):
+    start = time.perf_counter()
+    step()
+    return time.perf_counter() - start
+
+
+def measure(server, peers, message):
+    tracemalloc.start()
+    total = sum(broadcast(server, peers, message, allocated) for i in range(ROUNDS))
+    tracemalloc.stop()
+    elapsed = sum(broadcast(server, peers, message, timed) for i in range(ROUNDS))
+    return total / ROUNDS, elapsed / ROUNDS * 1000
+
+
+def close(server, peers):
+    for client in server.clients:
+        client["handler"].request.close()
+    for peer in peers:
+        peer.close()
+
+
+def main():
+    print("{0:>8} {1:>8} {2:>16} {3:>16} {4:>10} {5:>10}".format("clients", "payload", "before bytes", "after bytes", "before ms", "after ms"))
+    for size in SIZES:
+        message = json.dumps({"cmd": "direct", "val": {"p": "a" * size}}).encode()
+        for count in COUNTS:
+            before_server, before_peers = make_server(BeforeServer, BeforeHandler, count)
+            after_server, after_peers = make_server(AfterServer, AfterHandler, count)
+            before, before_ms = measure(before_server, before_peers, message)
+            after, after_ms = measure(after_server, after_peers, message)
+            print("{0:>8} {1:>8} {2:>16.0f} {3:>16.0f} {4:>10.2f} {5:>10.2f}".format(count, len(message), before, after, before_ms, after_ms))
+            close(before_server, before_peers)
+            close(after_server, after_peers)
+
+
+if __name__ == "__main__":
+    main()
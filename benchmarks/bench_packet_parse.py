@@ -0,0 +1,87 @@
+"""
+json.loads calls per inbound packet, and packets/sec on one core, through
+CloudLink._on_packet_server with the worker pool run inline.
+
+    python benchmarks/bench_packet_parse.py
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from cloudlink import CloudLink
+
+PACKETS = {
+    "ping": {"cmd": "ping", "listener": "bench"},
+    "pmsg": {"cmd": "pmsg", "val": "hello", "id": "bob"},
+    "pmsg (scratch, nested)": {"cmd": "pmsg", "val": json.dumps({"text": "hello"}), "id": "bob"},
+    "direct": {"cmd": "direct", "val": {"cmd": "get_home", "val": {"page": 1}}, "listener": "bench"},
+}
+
+
+class NullServer:
+    def __init__(self):
+        self.clients = []
+
+    def send_message(self, client, msg):
+        pass
+
+
+class CountingLoads:
+    def __init__(self, loads):
+        self.loads = loads
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.loads(*args, **kwargs)
+
+
+def make_link():
+    cl = CloudLink()
+    cl.state = 1
+    cl.wss = NullServer()
+    cl.statedata = {
+        "ulist": {"usernames": {}, "objs": {}},
+        "secure_enable": False,
+        "gmsg": "",
+    }
+    cl.packet_workers.submit = lambda client_id, function: function() or True
+    cl.callback("on_packet", lambda message: None)
+
+    clients = []
+    for client_id, username in [(1, "alice"), (2, "bob")]:
+        client = {"id": client_id, "handler": None, "address": ("127.0.0.1", 0)}
+        cl.statedata["ulist"]["usernames"][username] = client_id
+        cl.statedata["ulist"]["objs"][client_id] = {"object": client, "username": username, "ip": "127.0.0.1", "type": None}
+        cl.wss.clients.append(client)
+        clients.append(client)
+    return cl, clients
+
+
+def main():
+    cl, (alice, bob) = make_link()
+    counter = CountingLoads(json.loads)
+    json.loads = counter
+
+    print("{0:>24} {1:>14} {2:>14}".format("packet", "loads/packet", "packets/sec"))
+    for name, payload in PACKETS.items():
+        cl.statedata["ulist"]["objs"][alice["id"]]["type"] = "scratch" if "scratch" in name else None
+        message = json.dumps(payload)
+
+        counter.calls = 0
+        cl._on_packet_server(alice, None, message)
+        calls = counter.calls
+
+        runs = 20000
+        start = time.perf_counter()
+        for _ in range(runs):
+            cl._on_packet_server(alice, None, message)
+        elapsed = time.perf_counter() - start
+        print("{0:>24} {1:>14} {2:>14.0f}".format(name, calls, runs / elapsed))
+
+
+if __name__ == "__main__":
+    main()
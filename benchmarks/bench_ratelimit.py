@@ -0,0 +1,93 @@
+"""
+Memory per million tracked keys and checks per second for the old
+check_for_spam (three dicts per type, never emptied) vs. RateLimiter and
+SharedRateLimiter, and what a sweep leaves once the keys have gone quiet.
+SharedRateLimiter's table has a fixed size, 16 bytes per slot.
+
+    python benchmarks/bench_ratelimit.py
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ratelimit import RateLimiter, SharedRateLimiter, SLOT
+
+KEYS = 1000000
+CHECKS = 200000
+
+
+class OldLimiter:
+    # Supporter.check_for_spam before RateLimiter
+    def __init__(self):
+        self.last_packet = dict()
+        self.burst_amount = dict()
+        self.ratelimits = dict()
+
+    def check(self, type, client, burst=1, seconds=1):
+        if not (type in self.last_packet):
+            self.last_packet[type] = {}
+            self.burst_amount[type] = {}
+            self.ratelimits[type] = {}
+        if client not in self.last_packet[type]:
+            self.last_packet[type][client] = 0
+            self.burst_amount[type][client] = 0
+            self.ratelimits[type][client] = 0
+        if self.ratelimits[type][client] > time.time():
+            return True
+        if (self.last_packet[type][client] + seconds) < time.time():
+            self.burst_amount[type][client] = 0
+        self.last_packet[type][client] = time.time()
+        self.burst_amount[type][client] += 1
+        if self.burst_amount[type][client] > burst:
+            self.ratelimits[type][client] = (time.time() + seconds)
+            self.burst_amount[type][client] = 0
+            return True
+        else:
+            return False
+
+
+def memory_per_key(limiter, keys):
+    tracemalloc.start()
+    for key in keys:
+        limiter.check("login", key, burst=5, seconds=60)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / len(keys)
+
+
+def checks_per_second(limiter, keys):
+    start = time.perf_counter()
+    for key in keys:
+        limiter.check("posts", key, burst=6, seconds=5)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def main():
+    # IP addresses, made before measuring so their strings don't count
+    keys = ["10.{0}.{1}.{2}".format(i >> 16, (i >> 8) & 255, i & 255) for i in range(KEYS)]
+    new_keys = ["11.{0}.{1}.{2}".format(i >> 16, (i >> 8) & 255, i & 255) for i in range(CHECKS)]
+    repeat_keys = keys[:1000] * (CHECKS // 1000)
+
+    old = OldLimiter()
+    new = RateLimiter()
+    new.sweeper = True  # Swept by hand below
+    print("{0:>8} {1:>18} {2:>18} {3:>18}".format("", "MB/million keys", "new keys checks/s", "repeats checks/s"))
+    old_memory = memory_per_key(old, keys)
+    new_memory = memory_per_key(new, keys)
+    shared = SharedRateLimiter(groups=KEYS // 16)
+    for name, limiter, memory in [("before", old, old_memory), ("after", new, new_memory), ("shared", shared, SLOT.size)]:
+        print("{0:>8} {1:>18.1f} {2:>18.0f} {3:>18.0f}".format(name, memory, checks_per_second(limiter, new_keys), checks_per_second(limiter, repeat_keys)))
+    shared.remove()
+
+    # Once every bucket is full again nothing needs to be kept
+    start = time.perf_counter()
+    swept = new.sweep(time.monotonic() + 60)
+    print()
+    print("Sweep forgot {0} keys in {1:.0f} ms, {2} left".format(swept, (time.perf_counter() - start) * 1000, sum(new.get_stats()["keys"].values())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Frame unmasking throughput, per-byte loop vs. bulk XOR.
+
+    python benchmarks/bench_unmask.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from websocket_server import unmask
+
+SIZES = [125, 1024, 4096, 16384, 65536]
+
+
+def unmask_bytewise(masks, payload):
+    message_bytes = bytearray()
+    for message_byte in payload:
+        message_byte ^= masks[len(message_bytes) % 4]
+        message_bytes.append(message_byte)
+    return message_bytes
+
+
+def mb_per_sec(fn, masks, payload):
+    runs, elapsed = timeit.Timer(lambda: fn(masks, payload)).autorange()
+    return (len(payload) * runs) / elapsed / (1024 * 1024)
+
+
+def main():
+    masks = os.urandom(4)
+    print("{0:>8} {1:>14} {2:>14} {3:>8}".format("size", "before MB/s", "after MB/s", "speedup"))
+    for size in SIZES:
+        payload = os.urandom(size)
+        before = mb_per_sec(unmask_bytewise, masks, payload)
+        after = mb_per_sec(unmask, masks, payload)
+        print("{0:>8} {1:>14.1f} {2:>14.1f} {3:>7.1f}x".format(size, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
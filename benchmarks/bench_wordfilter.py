@@ -0,0 +1,72 @@
+"""
+Time to censor 4,000 character posts, the longest Meower takes, with the
+old Supporter.wordfilter (better_profanity's word list reloaded and the
+post censored twice per call) vs. the compiled WordFilter, plus how long
+building the WordFilter takes.
+
+    python benchmarks/bench_wordfilter.py
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from better_profanity import profanity
+from filter import WordFilter
+
+LENGTH = 4000
+FILTER_DOC = {"whitelist": ["hell"], "blacklist": ["meowbad", "cat food"]}
+
+CLEAN_WORDS = ["hello", "world", "this", "is", "a", "post", "about", "my", "cat", "and", "meower", "!", "lol", "the", "server"]
+
+
+def post(words, rng):
+    text = ""
+    while len(text) < LENGTH:
+        text += rng.choice(words) + rng.choice([" ", " ", " ", ", ", ". "])
+    return text[:LENGTH]
+
+
+def old_wordfilter(message):
+    # Supporter.wordfilter before it used WordFilter
+    profanity.load_censor_words(whitelist_words=list(FILTER_DOC["whitelist"]))
+    message = profanity.censor(message)
+    profanity.load_censor_words(whitelist_words=list(FILTER_DOC["whitelist"]), custom_words=FILTER_DOC["blacklist"])
+    message = profanity.censor(message)
+    return message
+
+
+def run(function, text, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+
+def main():
+    rng = random.Random(0)
+    posts = {
+        "clean": post(CLEAN_WORDS, rng),
+        "some profanity": post(CLEAN_WORDS * 5 + ["shit", "f*ck", "meowbad"], rng),
+        "one long word": "a" * LENGTH,
+    }
+
+    start = time.perf_counter()
+    word_filter = WordFilter(**FILTER_DOC)
+    print("WordFilter built in {0:.1f} ms, {1} states".format((time.perf_counter() - start) * 1000, len(word_filter.transitions)))
+    print()
+    print("{0:>16} {1:>14} {2:>14} {3:>10}".format("post", "before ms", "after ms", "speedup"))
+    for name, text in posts.items():
+        before = run(old_wordfilter, text, 3)
+        after = run(word_filter.censor, text, 20)
+        print("{0:>16} {1:>14.1f} {2:>14.2f} {3:>9.0f}x".format(name, before, after, before / after))
+
+
+if __name__ == "__main__":
+    main()
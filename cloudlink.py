@@ -14,10 +14,18 @@ import json
 import sys
 import threading
 from websocket_server import WebsocketServer as ws_server
+from websocket_server import AsyncWebsocketServer as ws_async_server
+from websocket_server import DEFAULT_SEND_QUEUE_LIMIT, DEFAULT_COMPRESSION_THRESHOLD, DEFAULT_MAX_MESSAGE_SIZE, DEFAULT_MAX_FRAME_SIZE, DEFAULT_PING_TIMEOUT
 import websocket as ws_client
 import time
 import traceback
 import sys
+import queue
+from collections import deque
+try:
+    import msgpack
+except ImportError: # Optional, clients can only use JSON without it
+    msgpack = None
 
 """
 Code formatting
@@ -47,21 +55,48 @@ def full_stack():
     return stackstr
 
 class API:
-    def server(self, ip="127.0.0.1", port=3000, threaded=False): # Runs CloudLink in server mode.
+    def server(self, ip="127.0.0.1", port=3000, threaded=False, backend="threaded", send_queue_limit=DEFAULT_SEND_QUEUE_LIMIT, compression=False, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, compression_context_takeover=False, max_message_size=DEFAULT_MAX_MESSAGE_SIZE, max_frame_size=DEFAULT_MAX_FRAME_SIZE, ping_interval=0, ping_timeout=DEFAULT_PING_TIMEOUT, reuse_port=False): # Runs CloudLink in server mode. backend is "threaded" (one thread per client) or "asyncio" (single event loop), clients that fall send_queue_limit bytes behind get disconnected, compression offers permessage-deflate for packets of at least compression_threshold bytes, clients that send a message over max_message_size bytes or a frame over max_frame_size bytes get disconnected, clients quiet for ping_interval seconds get pinged and are disconnected if they don't answer within ping_timeout seconds, reuse_port lets several processes share the port (see joinCluster)
         try:
             if self.state == 0:
                 
                 # Change the link state to 1 (Server mode)
                 self.state = 1
-                self.wss = ws_server(
-                    host=ip,
-                    port=port
-                )
+                if backend == "asyncio":
+                    self.wss = ws_async_server(
+                        host=ip,
+                        port=port,
+                        send_queue_limit=send_queue_limit,
+                        compression=compression,
+                        compression_threshold=compression_threshold,
+                        compression_context_takeover=compression_context_takeover,
+                        max_message_size=max_message_size,
+                        max_frame_size=max_frame_size,
+                        ping_interval=ping_interval,
+                        ping_timeout=ping_timeout,
+                        reuse_port=reuse_port
+                    )
+                else:
+                    if (not backend == "threaded") and self.debug:
+                        print("Error: Unknown server backend {0}, falling back to threaded".format(backend))
+                    self.wss = ws_server(
+                        host=ip,
+                        port=port,
+                        send_queue_limit=send_queue_limit,
+                        compression=compression,
+                        compression_threshold=compression_threshold,
+                        compression_context_takeover=compression_context_takeover,
+                        max_message_size=max_message_size,
+                        max_frame_size=max_frame_size,
+                        ping_interval=ping_interval,
+                        ping_timeout=ping_timeout,
+                        reuse_port=reuse_port
+                    )
                 
                 # Set the server's callbacks to CloudLink's class functions
                 self.wss.set_fn_new_client(self._on_connection_server)
                 self.wss.set_fn_client_left(self._closed_connection_server)
                 self.wss.set_fn_message_received(self._on_packet_server)
+                self.wss.set_fn_message_received_binary(self._on_binary_packet_server)
                 
                 # Format dict for storing this mode's specific data
                 
@@ -72,7 +107,7 @@ class API:
                     self.statedata["secure_enable"] = False
                     self.statedata["secure_keys"] = []
                 if not "ip_blocklist" in self.statedata:
-                    self.statedata["ip_blocklist"] = [""]
+                    self.statedata["ip_blocklist"] = set([""])
                 
                 self.statedata = {
                     "ulist": {
@@ -86,10 +121,17 @@ class API:
                     "motd": self.statedata["motd"], # MOTD text
                     "secure_enable": self.statedata["secure_enable"], # Trusted Access enabler
                     "secure_keys": self.statedata["secure_keys"], # Trusted Access keys
-                    "trusted": [], # Clients that are trusted with Secure Access, references memory objects only
-                    "ip_blocklist": self.statedata["ip_blocklist"] # Blocks clients with certain IP addresses
+                    "trusted": set(), # IDs of the clients that are trusted with Secure Access, a set so checking a client while broadcasting is one lookup
+                    "ip_blocklist": self.statedata["ip_blocklist"] # Blocks clients with certain IP addresses, a set like trusted
                 }
                 
+                # Start the packet workers
+                self.packet_workers.start()
+                
+                # Connect to the other processes of the cluster
+                if not self.cluster == None:
+                    self.cluster.start()
+                
                 # Run the server
                 print("Running server on ws://{0}:{1}/".format(ip, port))
                 self.wss.run_forever(threaded=threaded)
@@ -191,7 +233,7 @@ class API:
                         if self._get_client_type(client) == "scratch":
                             if ("val" in msg) and (type(msg["val"]) == dict):
                                 msg["val"] = json.dumps(msg["val"])
-                        self.wss.send_message(client, json.dumps(msg))
+                        self._send_packet(client, msg)
                     except Exception as e:
                         if self.debug:
                             print("Error on sendPacket (server): {0}".format(full_stack()))
@@ -199,7 +241,10 @@ class API:
                 elif ("id" in msg) and (type(msg["id"]) == str) and (msg["cmd"] not in ["gmsg", "gvar"]):
                     id = msg["id"]
                     del msg["id"]
-                    if id in self.statedata["ulist"]["usernames"]:
+                    if (not id in self.statedata["ulist"]["usernames"]) and (id in self.remote_usernames):
+                        # Online on another process of the cluster, only that one gets it
+                        self._send_to_remote_users(msg, {self.remote_usernames[id]: [id]})
+                    elif id in self.statedata["ulist"]["usernames"]:
                         try:
                             client = self.statedata["ulist"]["objs"][self.statedata["ulist"]["usernames"][id]]["object"]
                             if self.debug:
@@ -207,7 +252,7 @@ class API:
                             if self._get_client_type(client) == "scratch":
                                 if ("val" in msg) and (type(msg["val"]) == dict):
                                     msg["val"] = json.dumps(msg["val"])
-                            self.wss.send_message(client, json.dumps(msg))
+                            self._send_packet(client, msg)
                         except Exception as e:
                             if self.debug:
                                 print("Error on sendPacket (server): {0}".format(e))
@@ -216,6 +261,8 @@ class API:
                         if self.debug:
                             print('Sending "{0}" to all clients'.format(json.dumps(msg)))
                         self._send_to_all(msg)
+                        if not self.cluster == None:
+                            self.cluster.publish("packet", msg)
                     except Exception as e:
                             if self.debug:
                                 print("Error on sendPacket (server): {0}".format(e))
@@ -232,6 +279,75 @@ class API:
         except Exception as e:
             print("Error at sendPacket: {0}".format(e))
     
+    def sendPacketToUsers(self, msg, usernames): # Sends a packet to every user of usernames that is online, serialized once per codec, server-side only. Users on other processes of a cluster get it through theirs.
+        try:
+            if self.state == 1:
+                clients, remote = self._get_clients_of_usernames(usernames)
+                if self.debug:
+                    print('Sending {0} to {1} users'.format(msg, len(clients)))
+                self._send_to_clients(clients, msg)
+                self._send_to_remote_users(msg, remote)
+            else:
+                if self.debug:
+                    print("Error: Cannot use the packet sender in current state!")
+        except Exception as e:
+            if self.debug:
+                print("Error at sendPacketToUsers: {0}".format(full_stack()))
+    
+    def sendPacketToRoom(self, msg, room, members=None): # Sends a packet to the online members of a room, serialized once per codec, server-side only. members (e.g. read from the database) fills in a room that hasn't been set yet.
+        try:
+            if self.state == 1:
+                with self.ulist_lock:
+                    usernames = self.rooms.get(room)
+                    if usernames == None:
+                        if members == None:
+                            if self.debug:
+                                print("Error: Room {0} has no members set".format(room))
+                            return
+                        usernames = set(members)
+                        self.rooms[room] = usernames
+                    clients, remote = self._get_clients_of_usernames_locked(usernames)
+                if self.debug:
+                    print('Sending {0} to {1} members of room {2}'.format(msg, len(clients), room))
+                self._send_to_clients(clients, msg)
+                self._send_to_remote_users(msg, remote)
+            else:
+                if self.debug:
+                    print("Error: Cannot use the packet sender in current state!")
+        except Exception as e:
+            if self.debug:
+                print("Error at sendPacketToRoom: {0}".format(full_stack()))
+    
+    def setRoom(self, room, usernames): # Sets the members of a room (a chat) for sendPacketToRoom, on every process of a cluster.
+        if (type(room) == str) and (type(usernames) == list):
+            with self.ulist_lock:
+                self.rooms[room] = set(usernames)
+            if not self.cluster == None:
+                self.cluster.publish("room", {"room": room, "users": usernames})
+        else:
+            if self.debug:
+                print('Error: Cannot set room: expecting <class "str"> and <class "list">, got {0} and {1}'.format(type(room), type(usernames)))
+    
+    def deleteRoom(self, room): # Forgets a room, on every process of a cluster.
+        with self.ulist_lock:
+            self.rooms.pop(room, None)
+        if not self.cluster == None:
+            self.cluster.publish("room", {"room": room, "users": None})
+    
+    def sendCode(self, client, code, listener_detected=False, listener_id=""): # Sends a statuscode to a client (memory object or username), server-side only.
+        try:
+            if self.state == 1:
+                if type(client) == str:
+                    client = self._get_obj_of_username(client)
+                if not client == None:
+                    self._send_code(client, code, listener_detected, listener_id)
+            else:
+                if self.debug:
+                    print("Error: Cannot use the statuscode sender in current state!")
+        except Exception as e:
+            if self.debug:
+                print("Error at sendCode: {0}".format(full_stack()))
+    
     def setMOTD(self, motd, enable=True): # Sets the MOTD on the server-side.
         try:
             if type(enable) == bool:
@@ -252,18 +368,53 @@ class API:
             if self.debug:
                 print("Error at setMOTD: {0}".format(e))
 
-    def getUsernames(self): # Returns the username list.
+    def getUsernames(self): # Returns the username list, with the users of the other processes of a cluster.
         if self.state == 1:
-            return list((self.statedata["ulist"]["usernames"]).keys())
+            with self.ulist_lock:
+                usernames = list((self.statedata["ulist"]["usernames"]).keys())
+                usernames.extend([username for username in self.remote_usernames if not username in self.statedata["ulist"]["usernames"]])
+            return usernames
         elif self.state == 2:
             return self.statedata["ulist"]["usernames"]
         else:
             return None
     
+    def isUsernameOnline(self, user): # Checks if a username is on the username list without copying it.
+        if self.state == 1:
+            return (user in self.statedata["ulist"]["usernames"])
+        else:
+            if self.debug:
+                print("Error: Cannot use the username checker in current state!")
+            return False
+    
+    def isUsernameInCluster(self, user): # Checks if a username is online on this server or on another process of its cluster.
+        if self.state == 1:
+            return (user in self.statedata["ulist"]["usernames"]) or (user in self.remote_usernames)
+        else:
+            if self.debug:
+                print("Error: Cannot use the username checker in current state!")
+            return False
+    
+    def setUsername(self, obj, username): # Sets the username of a client (memory object) on the server-side, the username list update goes out with the next broadcast.
+        if self.state == 1:
+            if (type(obj) == dict) and (type(username) == str):
+                if obj["id"] in self.statedata["ulist"]["objs"]:
+                    self._add_username(obj, username)
+                else:
+                    if self.debug:
+                        print("Unable to set the username of an ID that does not exist")
+            else:
+                if self.debug:
+                    print('Error: Cannot set username: expecting <class "dict"> and <class "str">, got {0} and {1}'.format(type(obj), type(username)))
+        else:
+            if self.debug:
+                print("Error: Cannot use the username setter in current state!")
+    
     def getIPofUsername(self, user): # Allows the server to track user IPs for Trusted Access, uses the username of a client.
         if self.state == 1:
-            if not self._get_obj_of_username(user) == None:
-                return self._get_ip_of_obj(self._get_obj_of_username(user))
+            obj = self._get_obj_of_username(user)
+            if not obj == None:
+                return self._get_ip_of_obj(obj)
         else:
             if self.debug:
                 print("Error: Cannot use the IP getter in current state!")
@@ -277,12 +428,21 @@ class API:
                 print("Error: Cannot use the IP getter in current state!")
             return ""
     
+    def getClientsOfIP(self, ip): # Returns the memory objects of every client connected from an IP address.
+        if self.state == 1:
+            with self.ulist_lock:
+                return [self.statedata["ulist"]["objs"][client_id]["object"] for client_id in self.ip_index.get(ip, ())]
+        else:
+            if self.debug:
+                print("Error: Cannot use the IP lookup in current state!")
+            return []
+    
     def untrust(self, obj): # If a client has been trusted, the server can loose trust and refuse future packets.
         if self.state == 1:
             if self.statedata["secure_enable"]:
                 if type(obj) == dict:
-                    if obj in self.statedata["trusted"]:
-                        self.statedata["trusted"].remove(obj)
+                    if obj["id"] in self.statedata["trusted"]:
+                        self.statedata["trusted"].discard(obj["id"])
                         if self.debug:
                             print("Untrusted ID {0}.".format(obj["id"]))
                     else:   
@@ -291,8 +451,8 @@ class API:
                 elif type(obj) == str:
                     obj = self._get_obj_of_username(obj)
                     if not obj == None:
-                        if obj in self.statedata["trusted"]:
-                            self.statedata["trusted"].remove(obj)
+                        if obj["id"] in self.statedata["trusted"]:
+                            self.statedata["trusted"].discard(obj["id"])
                             if self.debug:
                                 print("Untrusted ID {0}.".format(obj["id"]))
                         else:   
@@ -310,9 +470,8 @@ class API:
     
     def loadIPBlocklist(self, blist): # Loads a list of IP addresses to block
         if type(blist) == list:
-            if not '' in blist:
-                blist.append("")
-            self.statedata["ip_blocklist"] = blist
+            self.statedata["ip_blocklist"] = set(blist)
+            self.statedata["ip_blocklist"].add("")
             if self.debug:
                 print("Loaded {0} blocked IPs into the blocklist!".format(len(self.statedata["ip_blocklist"])-1))
     
@@ -321,7 +480,7 @@ class API:
             if self.statedata["secure_enable"]:
                 if type(ip) == str:
                     if not ip in self.statedata["ip_blocklist"]:
-                        self.statedata["ip_blocklist"].append(ip)
+                        self.statedata["ip_blocklist"].add(ip)
                         if self.debug:
                             print("Blocked IP {0}!".format(ip))
         else:
@@ -343,14 +502,61 @@ class API:
     def getIPBlocklist(self): # Returns the latest IP blocklist
         if self.state == 1:
             if self.statedata["secure_enable"]:
-                tmp = self.statedata["ip_blocklist"]
-                tmp.remove('')
-                return self.statedata["ip_blocklist"]
+                return [ip for ip in self.statedata["ip_blocklist"] if not ip == ""]
         else:
             if self.debug:
                 print("Error: Cannot use the IP Blocklist get function in current state!")
             return []
     
+    def registerCommand(self, cmd, function, max_size=None): # Handles a direct custom command with its own function instead of the on_packet callback, function gets the same dict as on_packet, max_size sets the command's packet size limit
+        if type(cmd) == str:
+            self.custom_commands[cmd] = function
+            if not max_size == None:
+                self.setPacketSizeLimit(max_size, cmd)
+            if self.debug:
+                print("Registered command {0}.".format(cmd))
+        else:
+            if self.debug:
+                print('Error: Cannot register command: expecting <class "str">, got {0}'.format(type(cmd)))
+    
+    def setPacketSizeLimit(self, size, cmd=None): # Sets the longest packet (in characters, or bytes for a binary codec) a command takes, direct commands by their own name. cmd None sets the limit of every other command, size 0 removes a limit
+        if size:
+            self.packet_size_limits[cmd] = size
+        elif cmd in self.packet_size_limits:
+            del self.packet_size_limits[cmd]
+        if None in self.packet_size_limits:
+            self.packet_size_cap = max(self.packet_size_limits.values())
+        else:
+            self.packet_size_cap = 0 # Commands without a limit take anything
+    
+    def getPacketQueueStats(self): # Returns the packet worker counters (queue depth, drops, queue wait times in seconds)
+        return self.packet_workers.get_stats()
+    
+    def getSendQueueStats(self): # Returns the outbound queue counters (bytes queued, slow clients disconnected), server-side only
+        if self.state == 1:
+            return self.wss.get_send_queue_stats()
+        else:
+            if self.debug:
+                print("Error: Cannot use the send queue stats in current state!")
+            return {}
+    
+    def getHeartbeatStats(self): # Returns the heartbeat counters (pings sent, dead connections disconnected), server-side only
+        if self.state == 1:
+            return self.wss.get_heartbeat_stats()
+        else:
+            if self.debug:
+                print("Error: Cannot use the heartbeat stats in current state!")
+            return {}
+    
+    def joinCluster(self, bus): # Shares broadcasts, packets for users and the username list with the other processes of a cluster through bus (a cluster.EventBus), call before server()
+        self.cluster = bus
+        bus.subscribe("packet", self._on_cluster_packet)
+        bus.subscribe("user_packet", self._on_cluster_user_packet)
+        bus.subscribe("room", self._on_cluster_room)
+        bus.subscribe("user_add", self._on_cluster_user_add)
+        bus.subscribe("user_remove", self._on_cluster_user_remove)
+        bus.subscribe("drop", self._on_cluster_drop)
+    
     def kickClient(self, obj): # Terminates a client's connection (should only be used for specific purposes)
         if self.state == 1:
             if self.statedata["secure_enable"]:
@@ -390,9 +596,149 @@ class CLTLS: #Feature NOT YET IMPLEMENTED
         pass
 """
 
+class PacketWorkerPool: # Fixed-size set of worker threads that run packets in order per client
+    def __init__(self, workers=16, queue_depth=64, overflow="ratelimit"):
+        self.workers = workers # Number of worker threads
+        self.queue_depth = queue_depth # Max packets waiting per client
+        self.overflow = overflow # "ratelimit" replies with the RateLimit code, "drop" discards silently
+        self.queues = {} # Client ID -> deque of (enqueue time, function), present while the client is scheduled or running
+        self.ready = queue.Queue() # Client IDs that have work and are not being run by a worker
+        self.lock = threading.Lock()
+        self.threads = []
+        self.stats = {
+            "submitted": 0, # Packets accepted into a queue
+            "processed": 0, # Packets run by a worker
+            "dropped": 0, # Packets rejected because the client's queue was full
+            "wait_total": 0.0, # Seconds packets spent queued, summed
+            "wait_max": 0.0 # Longest time a packet spent queued
+        }
+    
+    def start(self): # Starts the worker threads, safe to call more than once
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._worker, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+    
+    def submit(self, client_id, function): # Queues a function for a client, returns False if the client's queue is full
+        with self.lock:
+            if client_id in self.queues:
+                pending = self.queues[client_id]
+                if len(pending) >= self.queue_depth:
+                    self.stats["dropped"] += 1
+                    return False
+                pending.append((time.monotonic(), function))
+                schedule = False # A worker already owns this client and will pick it up
+            else:
+                self.queues[client_id] = deque([(time.monotonic(), function)])
+                schedule = True
+            self.stats["submitted"] += 1
+        if schedule:
+            self.ready.put(client_id)
+        return True
+    
+    def discard(self, client_id): # Drops a client's pending packets, the one currently running (if any) finishes
+        with self.lock:
+            if client_id in self.queues:
+                self.queues[client_id].clear()
+    
+    def get_stats(self): # Returns a copy of the counters plus the current queue depths
+        with self.lock:
+            stats = dict(self.stats)
+            stats["queued"] = sum(len(pending) for pending in self.queues.values())
+            stats["clients"] = len(self.queues)
+            if stats["processed"]:
+                stats["wait_avg"] = stats["wait_total"] / stats["processed"]
+            else:
+                stats["wait_avg"] = 0.0
+        return stats
+    
+    def _worker(self):
+        while True:
+            client_id = self.ready.get()
+            with self.lock:
+                pending = self.queues[client_id]
+                if not pending: # Discarded while waiting for a worker
+                    del self.queues[client_id]
+                    continue
+                enqueued, function = pending.popleft()
+                waited = time.monotonic() - enqueued
+                self.stats["processed"] += 1
+                self.stats["wait_total"] += waited
+                if waited > self.stats["wait_max"]:
+                    self.stats["wait_max"] = waited
+            try:
+                function()
+            except Exception:
+                print("Error on PacketWorkerPool: {0}".format(full_stack()))
+            with self.lock:
+                if self.queues[client_id]:
+                    reschedule = True # Go to the back of the line so one busy client can't starve the others
+                else:
+                    del self.queues[client_id]
+                    reschedule = False
+            if reschedule:
+                self.ready.put(client_id)
+
+class Packet: # An inbound server packet, parsed once when it arrives and passed along from there
+    def __init__(self, client, message, decode=None):
+        self.client = client # Client that sent the packet
+        self.raw = message # Packet text (or bytes, for a binary codec) as received
+        self.msg = None # Parsed packet, None if it could not be parsed
+        self.error = None # Status code to reply with if the packet can't be used
+        self.listener_detected = False # Support listener IDs feature from CL Turbo
+        self.listener_id = ""
+        self._val_source = None # String val that _val_parsed came from
+        self._val_parsed = None
+        self._val_is_json = False
+        
+        if len(message) == 0:
+            self.error = "EmptyPacket"
+        else:
+            try:
+                if decode == None:
+                    msg = json.loads(message)
+                else:
+                    msg = decode(message)
+            except Exception: # JSONDecodeError, or whatever the binary codec raises
+                self.error = "Syntax"
+            else:
+                if type(msg) == dict:
+                    self.msg = msg
+                    if ("listener" in msg) and (type(msg["listener"]) == str):
+                        self.listener_detected = True
+                        self.listener_id = msg["listener"]
+                else:
+                    self.error = "Syntax"
+    
+    def val_is_json(self): # Same result as CloudLink._is_json(msg["val"]), but each string val is only parsed once
+        val = self.msg["val"]
+        if type(val) == dict:
+            return True
+        elif not type(val) == str:
+            return False
+        if not val is self._val_source:
+            self._val_source = val
+            try:
+                self._val_parsed = json.loads(val)
+                self._val_is_json = True
+            except json.decoder.JSONDecodeError:
+                self._val_is_json = False
+        return self._val_is_json
+    
+    def decode_val(self): # Replaces a nested JSON string val with its parsed value
+        if (type(self.msg["val"]) == str) and self.val_is_json():
+            self.msg["val"] = self._val_parsed
+    
+    def decoded_val(self): # The val decode_val would leave, without replacing it
+        if (type(self.msg["val"]) == str) and self.val_is_json():
+            return self._val_parsed
+        return self.msg["val"]
+
 class CloudLink(API):
-    def __init__(self, debug=False): # Initializes CloudLink
+    def __init__(self, debug=False, workers=16, queue_depth=64, overflow="ratelimit"): # Initializes CloudLink
         self.wss = None # Websocket Object
+        self.packet_workers = PacketWorkerPool(workers, queue_depth, overflow) # Runs server-side packets, in order per client
         self.state = 0 # Module state
         self.userlist = [] # Stores usernames set on link
         self.callback_function = { # For linking external code, use with functions
@@ -401,6 +747,33 @@ class CloudLink(API):
             "on_packet": None, # Packet handler
             "on_close": None # Runs code when disconnected (client) or server stops (server)
         }
+        self.commands = { # Server-side commands: cmd -> (handler, parameters the packet must contain), anything else is routed using UPL
+            "gmsg": (self._cmd_gmsg, ("val",)),
+            "pmsg": (self._cmd_pmsg, ("val", "id")),
+            "setid": (self._cmd_setid, ("val",)),
+            "direct": (self._cmd_direct, ("val",)),
+            "gvar": (self._cmd_gvar, ("val", "name")),
+            "pvar": (self._cmd_pvar, ("val", "id", "name")),
+            "ping": (self._cmd_ping, ())
+        }
+        self.disabled_commands = set(["gmsg", "setid", "gvar"]) # Commands that reply with the Disabled code
+        self.custom_commands = {} # Direct commands registered by the application, see registerCommand
+        self.packet_size_limits = {} # cmd -> longest packet it takes, None for every other command, see setPacketSizeLimit
+        self.packet_size_cap = 0 # Longest packet any command takes, longer ones are refused before they are parsed, 0 for no limit
+        self.code_packets = {} # (code, listener present, codec) -> serialized statuscode packet, see _get_code_packet
+        self.codecs = {} # Binary codecs a client can ask for in its type handshake: name -> (encode, decode)
+        if not msgpack == None:
+            self.codecs["msgpack"] = (msgpack.packb, msgpack.unpackb)
+        self.ulist_lock = threading.Lock() # Guards the username list and its caches
+        self.ulist_cache = None # Username list string, None when it needs a rebuild
+        self.ulist_packets = {} # Codec -> serialized ulist packet, emptied when the list changes
+        self.ulist_pending = {} # Username -> "add" / "remove" since the last broadcast
+        self.ulist_timer = None # Pending coalesced broadcast
+        self.ulist_window = 0.1 # Seconds to collect username list changes into one broadcast, 0 sends every change right away
+        self.ip_index = {} # IP address -> set of connected client IDs, guarded by ulist_lock
+        self.cluster = None # Link to the other processes serving the same port, see joinCluster
+        self.remote_usernames = {} # Username -> ID of the cluster node it is online on, guarded by ulist_lock
+        self.rooms = {} # Room (chat ID) -> set of member usernames, guarded by ulist_lock, see setRoom
         self.debug = debug # Print back specific data
         self.statedata = {} # Place to store other garbage for modes
         self.codes = { # Current set of CloudLink status/error self.codes
@@ -450,9 +823,64 @@ class CloudLink(API):
         else:
             return None
     
+    def _get_client_codec(self, client): # Gets the binary codec a client negotiated, None for JSON
+        obj = self.statedata["ulist"]["objs"].get(client["id"])
+        if obj == None:
+            return None
+        return obj.get("codec")
+    
+    def _set_client_codec(self, client, codec): # Switches a client to a binary codec, answers with the codec in use either way
+        if codec in self.codecs:
+            # Acknowledged in JSON, everything after it is sent as binary frames
+            self.wss.send_message(client, json.dumps({"cmd": "direct", "val": {"cmd": "codec", "val": codec}}))
+            self.statedata["ulist"]["objs"][client["id"]]["codec"] = codec
+            if self.debug:
+                print("Client {0} uses the {1} codec".format(client["id"], codec))
+        else:
+            if self.debug:
+                print("Client {0} asked for unavailable codec {1}, staying on JSON".format(client["id"], codec))
+            self.wss.send_message(client, json.dumps({"cmd": "direct", "val": {"cmd": "codec", "val": "json"}}))
+    
+    def _encode_packet(self, payload, codec=None): # Serializes a packet, as JSON text or with a binary codec
+        if codec == None:
+            return json.dumps(payload)
+        else:
+            return self.codecs[codec][0](payload)
+    
+    def _send_data(self, client, codec, data): # Sends an already serialized packet to one client
+        if codec == None:
+            self.wss.send_message(client, data)
+        else:
+            self.wss.send_binary(client, data)
+    
+    def _send_packet(self, client, payload): # Sends a packet to one client in its codec
+        codec = self._get_client_codec(client)
+        self._send_data(client, codec, self._encode_packet(payload, codec))
+    
+    def _group_by_codec(self, clients): # Splits clients by codec -> list of clients
+        groups = {}
+        for client in clients:
+            codec = self._get_client_codec(client)
+            if codec in groups:
+                groups[codec].append(client)
+            else:
+                groups[codec] = [client]
+        return groups
+    
+    def _send_encoded(self, clients, codec, data): # Sends an already serialized packet to clients that all use codec
+        if codec == None:
+            self.wss.send_message_to_many(clients, data)
+        else:
+            self.wss.send_binary_to_many(clients, data)
+    
+    def _send_to_many(self, clients, payload): # Sends a packet to many clients, serialized once per codec
+        for codec, group in self._group_by_codec(clients).items():
+            self._send_encoded(group, codec, self._encode_packet(payload, codec))
+    
     def _get_obj_of_username(self, client): # Helps mitigate packet spoofing
-        if client in self.statedata["ulist"]["usernames"]:
-            return self.statedata["ulist"]["objs"][self.statedata["ulist"]["usernames"][client]]["object"]
+        client_id = self.statedata["ulist"]["usernames"].get(client)
+        if client_id in self.statedata["ulist"]["objs"]:
+            return self.statedata["ulist"]["objs"][client_id]["object"]
         else:
             return None
     
@@ -470,7 +898,7 @@ class CloudLink(API):
     
     def _is_obj_trusted(self, obj): # Checks if a client is trusted on the link
         if self.statedata["secure_enable"]:
-            return ((obj in self.statedata["trusted"]) and (not self._is_obj_blocked(obj)))
+            return ((obj["id"] in self.statedata["trusted"]) and (not self._is_obj_blocked(obj)))
         else:
             return False
     
@@ -480,508 +908,484 @@ class CloudLink(API):
         else:
             return False
     
-    def _send_to_all(self, payload): # "Better" (?) send to all function
-        tmp_payload = payload
-        for client in self.wss.clients:
-            #print("sending {0} to {1}".format(payload, client["id"]))
+    def _send_to_all(self, payload): # Broadcasts a packet, serialized once for Scratch clients and once per codec for everyone else
+        clients = list(self.wss.clients)
+        if self.statedata["secure_enable"]:
+            clients = [client for client in clients if self._is_obj_trusted(client)]
+        self._send_to_clients(clients, payload)
+    
+    def _send_to_clients(self, clients, payload): # Sends a packet to many clients, serialized once for Scratch clients and once per codec for everyone else
+        scratch_clients = []
+        other_clients = []
+        for client in clients:
             if self._get_client_type(client) == "scratch":
-                #print("sending to all, {0} is a scratcher".format(client["id"]))
-                if ("val" in payload) and (type(payload["val"]) == dict):
-                    #print("stringifying nested json")
-                    tmp_payload["val"] = json.dumps(payload["val"])
-                if not self.statedata["secure_enable"]:
-                    self.wss.send_message(client, json.dumps(tmp_payload))
+                scratch_clients.append(client)
+            else:
+                other_clients.append(client)
+        
+        if len(other_clients) != 0:
+            self._send_to_many(other_clients, payload)
+        if len(scratch_clients) != 0:
+            if ("val" in payload) and (type(payload["val"]) == dict):
+                # Scratch can't read nested JSON, stringify it
+                scratch_payload = dict(payload)
+                scratch_payload["val"] = json.dumps(payload["val"])
+            else:
+                scratch_payload = payload
+            self.wss.send_message_to_many(scratch_clients, json.dumps(scratch_payload))
+    
+    def _get_code_packet(self, code, listener_detected=False, listener_id="", codec=None): # Returns a serialized statuscode packet, codes are only serialized once per codec
+        if codec == None:
+            encode = json.dumps
+        else:
+            encode = self.codecs[codec][0]
+        key = (code, listener_detected, codec)
+        cached = self.code_packets.get(key)
+        if (cached == None) or (not cached[0] == self.codes[code]): # Rebuild if the code's text was changed
+            if listener_detected:
+                # Split around an empty listener so the ID can be spliced in, listener is the last key
+                packet = encode({"cmd": "statuscode", "val": self.codes[code], "listener": ""})
+                if codec == None:
+                    cached = (self.codes[code],) + tuple(packet.rsplit('""', 1))
                 else:
-                    if self._is_obj_trusted(client):
-                        self.wss.send_message(client, json.dumps(tmp_payload))
+                    # Binary codecs end the map with the empty string itself
+                    cached = (self.codes[code], packet[:-len(encode(""))], b"")
             else:
-                if not self.statedata["secure_enable"]:
-                    self.wss.send_message(client, json.dumps(payload))
+                cached = (self.codes[code], encode({"cmd": "statuscode", "val": self.codes[code]}))
+            self.code_packets[key] = cached
+        if listener_detected:
+            return cached[1] + encode(listener_id) + cached[2]
+        else:
+            return cached[1]
+    
+    def _send_code(self, client, code, listener_detected=False, listener_id=""): # Replies to a client with a statuscode
+        codec = self._get_client_codec(client)
+        self._send_data(client, codec, self._get_code_packet(code, listener_detected, listener_id, codec))
+    
+    def _get_origin(self, client): # Returns the username of a client, or the client object if it has not set one
+        username = self._get_username_of_obj(client)
+        if len(username) == 0:
+            return client
+        else:
+            return username
+    
+    def _decode_scratch_val(self, client, packet): # Scratch clients send nested JSON as strings, decode it in place
+        if self._get_client_type(client) == "scratch":
+            packet.decode_val()
+    
+    def _get_recipient(self, client, packet): # Checks that msg["id"] can be sent to, returns the recipient or None after replying with the error
+        msg = packet.msg
+        if not msg["id"] in self.statedata["ulist"]["usernames"]:
+            if self.debug:
+                print('Error: ID Not found')
+            self._send_code(client, "IDNotFound", packet.listener_detected, packet.listener_id)
+            return None
+        otherclient = self._get_obj_of_username(msg["id"])
+        if client == otherclient:
+            if self.debug:
+                print('Error: Potential packet loop detected, aborting')
+            self._send_code(client, "Loop", packet.listener_detected, packet.listener_id)
+            return None
+        if len(self._get_username_of_obj(client)) == 0:
+            self._send_code(client, "IDRequired", packet.listener_detected, packet.listener_id)
+            return None
+        return otherclient
+    
+    def _cmd_gmsg(self, client, packet): # Handles global messages.
+        msg = packet.msg
+        self._decode_scratch_val(client, packet)
+        if self.debug:
+            print("message is {0} bytes".format(len(str(msg["val"]))))
+        self.statedata["gmsg"] = msg["val"]
+        # Send the packet to all clients.
+        self._send_to_all({"cmd": "gmsg", "val": msg["val"]})
+        self._send_code(client, "OK", packet.listener_detected, packet.listener_id)
+    
+    def _cmd_pmsg(self, client, packet): # Handles private messages.
+        msg = packet.msg
+        self._decode_scratch_val(client, packet)
+        otherclient = self._get_recipient(client, packet)
+        if otherclient == None:
+            return
+        origin = self._get_username_of_obj(client)
+        if (self._get_client_type(otherclient) == "scratch") and (packet.val_is_json()):
+            tmp_val = json.dumps(msg["val"])
+        else:
+            tmp_val = msg["val"]
+        if self.debug:
+            print('Sending {0} to {1}'.format(msg, msg["id"]))
+        self._send_packet(otherclient, {"cmd": "pmsg", "val": tmp_val, "origin": origin})
+        self._send_code(client, "OK", packet.listener_detected, packet.listener_id)
+    
+    def _cmd_setid(self, client, packet): # Sets the username of the client.
+        msg = packet.msg
+        if len(str(msg["val"])) == 0:
+            if self.debug:
+                print("Error: Packet is empty")
+            self._send_code(client, "EmptyPacket", packet.listener_detected, packet.listener_id)
+        elif not type(msg["val"]) == str:
+            if self.debug:
+                print('Error: Packet "val" datatype invalid: expecting <class "str">, got {0}'.format(type(msg["val"])))
+            self._send_code(client, "Datatype", packet.listener_detected, packet.listener_id)
+        elif not self.statedata["ulist"]["objs"][client['id']]["username"] == "":
+            if self.debug:
+                print('Error: Refusing to set username because username has already been set')
+            self._send_code(client, "IDSet", packet.listener_detected, packet.listener_id)
+        elif (msg["val"] in self.statedata["ulist"]["usernames"]) or (msg["val"] in self.remote_usernames):
+            if self.debug:
+                print('Error: Refusing to set username because it would cause a conflict')
+            self._send_code(client, "IDConflict", packet.listener_detected, packet.listener_id)
+        else:
+            # Add the username to the list
+            self._add_username(client, msg["val"])
+            self._send_code(client, "OK", packet.listener_detected, packet.listener_id)
+            if self.debug:
+                print("User {0} set username: {1}".format(client["id"], msg["val"]))
+    
+    def _cmd_direct(self, client, packet): # Direct packet handler for server.
+        msg = packet.msg
+        self._decode_scratch_val(client, packet)
+        
+        if (type(msg["val"]) == dict) and ("cmd" in msg["val"]):
+            if not "val" in msg["val"]:
+                if self.debug:
+                    print('Error: Packet missing parameters')
+                self._send_code(client, "Syntax", packet.listener_detected, packet.listener_id)
+            elif msg["val"]["cmd"] == "ulist_delta": # Opt in to ulist_add / ulist_remove packets instead of the full list on every change
+                self.statedata["ulist"]["objs"][client["id"]]["ulist_delta"] = (msg["val"]["val"] == True)
+            elif msg["val"]["cmd"] == "type":
+                if self.statedata["ulist"]["objs"][client["id"]]["type"] == None: # Prevent the client from changing types
+                    self.statedata["ulist"]["objs"][client["id"]]["type"] = msg["val"]["val"] # Set the client type
+                    if self.debug:
+                        if msg["val"]["val"] == "scratch":
+                            print("Client {0} is scratch type".format(client["id"]))
+                        elif msg["val"]["val"] == "py":
+                            print("Client {0} is python type".format(client["id"]))
+                        elif msg["val"]["val"] == "js":
+                            print("Client {0} is js type".format(client["id"]))
+                        else:
+                            print("Client {0} is of unknown client type, claims it's {1}".format(client["id"], (msg["val"]["val"])))
+                    # {"cmd": "type", "val": "js", "codec": "msgpack"} asks for binary frames, Scratch only speaks JSON
+                    if ("codec" in msg["val"]) and (not msg["val"]["val"] == "scratch"):
+                        self._set_client_codec(client, msg["val"]["codec"])
+            else:
+                origin = self._get_origin(client)
+                if msg["val"]["cmd"] in self.custom_commands:
+                    function = self.custom_commands[msg["val"]["cmd"]]
+                elif not self.callback_function["on_packet"] == None:
+                    function = self.callback_function["on_packet"]
+                else:
+                    return
+                if self.debug:
+                    print("Handling direct custom command from {0}".format(client["id"]))
+                if packet.listener_detected:
+                    function({"cmd": msg["val"]["cmd"], "val": msg["val"]["val"], "id": origin, "listener": packet.listener_id})
                 else:
-                    if self._is_obj_trusted(client):
-                        self.wss.send_message(client, json.dumps(payload))
+                    function({"cmd": msg["val"]["cmd"], "val": msg["val"]["val"], "id": origin})
+        elif not self.callback_function["on_packet"] == None:
+            origin = self._get_origin(client)
+            if self.debug:
+                print("Handling direct command from {0}".format(client["id"]))
+            if packet.listener_detected:
+                self.callback_function["on_packet"]({"val": msg["val"], "id": origin, "listener": packet.listener_id})
+            else:
+                self.callback_function["on_packet"]({"val": msg["val"], "id": origin})
+    
+    def _cmd_gvar(self, client, packet): # Handles global variables.
+        msg = packet.msg
+        self._decode_scratch_val(client, packet)
+        if len(str(msg["name"])) > 100:
+            if self.debug:
+                print('Error: Packet too large')
+            self._send_code(client, "TooLarge", packet.listener_detected, packet.listener_id)
+            return
+        # Send the packet to all clients.
+        self._send_to_all({"cmd": "gvar", "val": msg["val"], "name": msg["name"]})
+        self._send_code(client, "OK", packet.listener_detected, packet.listener_id)
     
-    def _server_packet_handler(self, client, server, message, listener_detected=False, listener_id=""): # The almighty packet handler, single-handedly responsible for over hundreds of lines of code
+    def _cmd_pvar(self, client, packet): # Handles private variables.
+        msg = packet.msg
+        self._decode_scratch_val(client, packet)
+        if len(str(msg["name"])) > 1000:
+            if self.debug:
+                print('Error: Packet too large')
+            self._send_code(client, "TooLarge", packet.listener_detected, packet.listener_id)
+            return
+        otherclient = self._get_recipient(client, packet)
+        if otherclient == None:
+            return
+        origin = self._get_username_of_obj(client)
+        if (self._get_client_type(otherclient) == "scratch") and (packet.val_is_json()):
+            tmp_val = json.dumps(msg["val"])
+        else:
+            tmp_val = msg["val"]
+        if self.debug:
+            print('Sending {0} to {1}'.format(msg, msg["id"]))
+        self._send_packet(otherclient, {"cmd": "pvar", "val": tmp_val, "name": msg["name"], "origin": origin})
+        self._send_code(client, "OK", packet.listener_detected, packet.listener_id)
+    
+    def _cmd_ping(self, client, packet): # Replies to pings
+        msg = packet.msg
+        if self.debug:
+            print("Ping from client {0}".format(client["id"]))
+        if packet.listener_detected:
+            self._send_packet(client, {"cmd": "ping", "val": self.codes["OK"], "listener": packet.listener_id})
+        else:
+            self._send_packet(client, {"cmd": "ping", "val": self.codes["OK"]})
+    
+    def _route_packet(self, client, packet): # Routes packets with unknown commands to another client using UPL.
+        msg = packet.msg
+        self._decode_scratch_val(client, packet)
+        otherclient = self._get_recipient(client, packet)
+        if otherclient == None:
+            return
+        msg["origin"] = self._get_username_of_obj(client)
+        if self.debug:
+            print('Routing {0} to {1}'.format(msg, msg["id"]))
+        del msg["id"]
+        self._send_packet(otherclient, msg)
+        self._send_code(client, "OK", packet.listener_detected, packet.listener_id)
+    
+    def _server_packet_handler(self, client, packet): # Validates a parsed packet and hands it to the handler registered in self.commands
         if not type(client) == type(None):
-            if not len(str(message)) == 0:
-                try:
-                    # Parse the JSON into a dict
-                    msg = json.loads(message)
-
-                    if ("id" in msg):
-                        if type(msg["id"]) != str:
-                            if (not type(msg["id"]) == dict) or (not type(msg["id"]) == list):
-                                msg["id"] = str(msg["id"])
-                            else:
-                                if self.debug:
-                                    print('Error: Packet "id" datatype invalid: expecting <class "str">, got {0}'.format(type(msg["cmd"])))
-                                if listener_detected:
-                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Datatype"], "listener": listener_id}))
-                                else:
-                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Datatype"]}))
-                                return
-                    
-                    # Handle the packet
-                    if "cmd" in msg: # Verify that the packet contains the command parameter, which is needed to work.
-                        if type(msg["cmd"]) == str:
-                            if msg["cmd"] in ["gmsg", "pmsg", "setid", "direct", "gvar", "pvar", "ping"]:
-                                if msg["cmd"] == "gmsg": # Handles global messages.
-                                    if False:
-                                        if "val" in msg: # Verify that the packet contains the required parameters.
-                                            if self._get_client_type(client) == "scratch":
-                                                if self._is_json(msg["val"]):
-                                                    msg["val"] = json.loads(msg["val"])
-                                            if True:
-                                                if self.debug:
-                                                    print("message is {0} bytes".format(len(str(msg["val"]))))
-                                                self.statedata["gmsg"] = msg["val"]
-                                                # Send the packet to all clients.
-                                                self._send_to_all({"cmd": "gmsg", "val": msg["val"]})
-                                                if listener_detected:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"], "listener": listener_id}))
-                                                else:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                            else:
-                                                if self.debug:
-                                                    print('Error: Packet too large')
-                                                if listener_detected:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"], "listener": listener_id}))
-                                                else:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"]}))
-                                        else:
-                                            if self.debug:
-                                                print('Error: Packet missing parameters')
-                                            if listener_detected:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                            else:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                                    else:
-                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Disabled"]}))
-
-                                if msg["cmd"] == "pmsg": # Handles private messages.
-                                    if ("val" in msg) and ("id" in msg): # Verify that the packet contains the required parameters.
-                                        if self._get_client_type(client) == "scratch":
-                                            if self._is_json(msg["val"]):
-                                                msg["val"] = json.loads(msg["val"])
-                                        if msg["id"] in self.statedata["ulist"]["usernames"]:
-                                            if True:
-                                                if not client == self._get_obj_of_username(msg["id"]):
-                                                    try:
-                                                        otherclient = self._get_obj_of_username(msg["id"])
-                                                        if not len(self._get_username_of_obj(client)) == 0:
-                                                            msg["origin"] = self._get_username_of_obj(client)
-                                                            if (self._get_client_type(otherclient) == "scratch") and (self._is_json(msg["val"])):
-                                                                tmp_val = json.dumps(msg["val"])
-                                                            else:
-                                                                tmp_val = msg["val"]
-
-                                                            if self.debug:
-                                                                print('Sending {0} to {1}'.format(msg, msg["id"]))
-                                                            del msg["id"]
-                                                            self.wss.send_message(otherclient, json.dumps({"cmd": "pmsg", "val": tmp_val, "origin": msg["origin"]}))
-                                                            if listener_detected:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"], "listener": listener_id}))
-                                                            else:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                                        else:
-                                                            if listener_detected:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDRequired"], "listener": listener_id}))
-                                                            else:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDRequired"]}))
-                                                    except Exception as e:
-                                                        if self.debug:
-                                                            print("Error on _server_packet_handler: {0}".format(e))
-                                                            if listener_detected:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"], "listener": listener_id}))
-                                                            else:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                                                else:
-                                                    if self.debug:
-                                                        print('Error: Potential packet loop detected, aborting')
-                                                    if listener_detected:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Loop"], "listener": listener_id}))
-                                                    else:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Loop"]}))
-                                            else:
-                                                if self.debug:
-                                                    print('Error: Packet too large')
-                                                if listener_detected:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"], "listener": listener_id}))
-                                                else:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"]}))
-                                        else:
-                                            if self.debug:
-                                                print('Error: ID Not found')
-                                            if listener_detected:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDNotFound"], "listener": listener_id}))
-                                            else:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDNotFound"]}))
-                                    else:
-                                        if self.debug:
-                                            print('Error: Packet missing parameters')
-                                        if listener_detected:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                        else:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-
-                                if msg["cmd"] == "setid": # Sets the username of the client.
-                                    if False:
-                                        if "val" in msg: # Verify that the packet contains the required parameters.
-                                            if not len(str(msg["val"])) == 0:
-                                                if True:
-                                                    if type(msg["val"]) == str:
-                                                        if self.statedata["ulist"]["objs"][client['id']]["username"] == "":
-                                                            if not msg["val"] in self.statedata["ulist"]["usernames"]:
-                                                                # Add the username to the list
-                                                                self.statedata["ulist"]["usernames"][msg["val"]] = client["id"]
-                                                                # Set the object's username info
-                                                                self.statedata["ulist"]["objs"][client['id']]["username"] = msg["val"]
-                                                                
-                                                                if listener_detected:
-                                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"], "listener": listener_id}))
-                                                                else:
-                                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                                                self._send_to_all({"cmd": "ulist", "val": self._get_ulist()})
-                                                                if self.debug:
-                                                                    print("User {0} set username: {1}".format(client["id"], msg["val"]))
-                                                            else:
-                                                                if self.debug:
-                                                                    print('Error: Refusing to set username because it would cause a conflict')
-                                                                if listener_detected:
-                                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDConflict"], "listener": listener_id}))
-                                                                else:
-                                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDConflict"]}))
-                                                        else:
-                                                            if self.debug:
-                                                                print('Error: Refusing to set username because username has already been set')
-                                                            if listener_detected:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDSet"], "listener": listener_id}))
-                                                            else:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDSet"]}))
-                                                    else:
-                                                        if self.debug:
-                                                            print('Error: Packet "val" datatype invalid: expecting <class "str">, got {0}'.format(type(msg["cmd"])))
-                                                        if listener_detected:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Datatype"], "listener": listener_id}))
-                                                        else:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Datatype"]}))
-                                                else:
-                                                    if self.debug:
-                                                        print('Error: Packet too large')
-                                                    if listener_detected:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"], "listener": listener_id}))
-                                                    else:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"]}))
-                                            else:
-                                                if self.debug:
-                                                    print("Error: Packet is empty")
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["EmptyPacket"]}))
-                                        else:
-                                            if self.debug:
-                                                print('Error: Packet missing parameters')
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                                    else:
-                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Disabled"]}))
-
-                                if msg["cmd"] == "direct": # Direct packet handler for server.
-                                    if self._get_client_type(client) == "scratch":
-                                        if ("val" in msg):
-                                            if (self._is_json(msg["val"])) and (type(msg["val"]) == str):
-                                                try:
-                                                    msg["val"] = json.loads(msg["val"])
-                                                except json.decoder.JSONDecodeError:
-                                                    if self.debug:
-                                                        print("Failed to decode JSON of direct's nested data")
-                                                    if listener_detected:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                                    else:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                                                    return
-                                    
-                                    if ("val" in msg):
-                                        if not self.callback_function["on_packet"] == None:
-                                            if "cmd" in msg["val"]:
-                                                if msg["val"]["cmd"] == "type":
-                                                    if "val" in msg["val"]:
-                                                        if self.statedata["ulist"]["objs"][client["id"]]["type"] == None: # Prevent the client from changing types
-                                                            self.statedata["ulist"]["objs"][client["id"]]["type"] = msg["val"]["val"] # Set the client type
-                                                            if self.debug:
-                                                                if msg["val"]["val"] == "scratch":
-                                                                    print("Client {0} is scratch type".format(client["id"]))
-                                                                elif msg["val"]["val"] == "py":
-                                                                    print("Client {0} is python type".format(client["id"]))
-                                                                elif msg["val"]["val"] == "js":
-                                                                    print("Client {0} is js type".format(client["id"]))
-                                                                else:
-                                                                    print("Client {0} is of unknown client type, claims it's {1}".format(client["id"], (msg["val"]["val"])))
-                                                            #self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                                    else:
-                                                        if self.debug:
-                                                            print('Error: Packet missing parameters')
-                                                        if listener_detected:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                                        else:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                                            
-                                                else:
-                                                    if "val" in msg["val"]:
-                                                        if len(self._get_username_of_obj(client)) == 0:
-                                                            origin = client
-                                                            if self.debug:
-                                                                print("Handling direct custom command from {0}".format(origin['id']))
-                                                        else:
-                                                            origin = self._get_username_of_obj(client)
-                                                            if self.debug:
-                                                                print("Handling direct custom command from {0}".format(origin))
-                                                        
-                                                        if listener_detected:
-                                                            self.callback_function["on_packet"]({"cmd": msg["val"]["cmd"], "val": msg["val"]["val"], "id": origin, "listener": listener_id})
-                                                        else:
-                                                            self.callback_function["on_packet"]({"cmd": msg["val"]["cmd"], "val": msg["val"]["val"], "id": origin})
-                                                    else:
-                                                        if self.debug:
-                                                            print('Error: Packet missing parameters')
-                                                        if listener_detected:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                                        else:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                                            else:
-                                                if len(self._get_username_of_obj(client)) == 0:
-                                                    origin = client
-                                                    if self.debug:
-                                                        print("Handling direct command from {0}".format(origin['id']))
-                                                else:
-                                                    origin = self._get_username_of_obj(client)
-                                                    if self.debug:
-                                                        print("Handling direct command from {0}".format(origin))
-                                                if listener_detected:
-                                                    self.callback_function["on_packet"]({"val": msg["val"], "id": origin, "listener": listener_id})
-                                                else:
-                                                    self.callback_function["on_packet"]({"val": msg["val"], "id": origin})
-                                    else:
-                                        if self.debug:
-                                            print('Error: Packet missing parameters')
-                                        if listener_detected:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                        else:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-
-                                if msg["cmd"] == "gvar": # Handles global variables.
-                                    if False:
-                                        if ("val" in msg) and ("name" in msg): # Verify that the packet contains the required parameters.
-                                            if self._get_client_type(client) == "scratch":
-                                                if self._is_json(msg["val"]):
-                                                    msg["val"] = json.loads(msg["val"])
-                                            if not len(str(msg["name"])) > 100:
-                                                # Send the packet to all clients.
-                                                self._send_to_all({"cmd": "gvar", "val": msg["val"], "name": msg["name"]})
-                                                
-                                                if listener_detected:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"], "listener": listener_id}))
-                                                else:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                            else:
-                                                if self.debug:
-                                                    print('Error: Packet too large')
-                                                if listener_detected:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"], "listener": listener_id}))
-                                                else:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"]}))
-                                        else:
-                                            if self.debug:
-                                                print('Error: Packet missing parameters')
-                                            if listener_detected:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                            else:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                                    else:
-                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Disabled"]}))
-                                
-                                if msg["cmd"] == "pvar": # Handles private variables.
-                                    if ("val" in msg) and ("id" in msg) and ("name" in msg): # Verify that the packet contains the required parameters.
-                                        if self._get_client_type(client) == "scratch":
-                                            if self._is_json(msg["val"]):
-                                                msg["val"] = json.loads(msg["val"])
-                                        if msg["id"] in self.statedata["ulist"]["usernames"]:
-                                            if not len(str(msg["name"])) > 1000:
-                                                if not client == self._get_obj_of_username(msg["id"]):
-                                                    try:
-                                                        otherclient = self._get_obj_of_username(msg["id"])
-                                                        if not len(self._get_username_of_obj(client)) == 0:
-                                                            msg["origin"] = self._get_username_of_obj(client)
-                                                            if (self._get_client_type(otherclient) == "scratch") and ((self._is_json(msg["val"])) or (type(msg["val"]) == dict)):
-                                                                tmp_val = json.dumps(msg["val"])
-                                                            else:
-                                                                tmp_val = msg["val"]
-                                                            if self.debug:
-                                                                print('Sending {0} to {1}'.format(msg, msg["id"]))
-                                                            del msg["id"]
-                                                            self.wss.send_message(otherclient, json.dumps({"cmd": "pvar", "val": tmp_val, "name": msg["name"], "origin": msg["origin"]}))
-                                                            if listener_detected:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"], "listener": listener_id}))
-                                                            else:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                                        else:
-                                                            if listener_detected:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDRequired"], "listener": listener_id}))
-                                                            else:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDRequired"]}))
-                                                    except Exception as e:
-                                                        if self.debug:
-                                                            print("Error on _server_packet_handler: {0}".format(e))
-                                                            if listener_detected:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"], "listener": listener_id}))
-                                                            else:
-                                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                                                else:
-                                                    if self.debug:
-                                                        print('Error: Potential packet loop detected, aborting')
-                                                    if listener_detected:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Loop"], "listener": listener_id}))
-                                                    else:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Loop"]}))
-                                            else:
-                                                if self.debug:
-                                                    print('Error: Packet too large')
-                                                if listener_detected:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"], "listener": listener_id}))
-                                                else:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"]}))
-                                        else:
-                                            if self.debug:
-                                                print('Error: ID Not found')
-                                            if listener_detected:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDNotFound"], "listener": listener_id}))
-                                            else:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDNotFound"]}))
-                                    else:
-                                        if self.debug:
-                                            print('Error: Packet missing parameters')
-                                        if listener_detected:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                        else:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                                
-                                if msg["cmd"] == "ping":
-                                    if self.debug:
-                                        print("Ping from client {0}".format(client["id"]))
-                                    if listener_detected:
-                                        self.wss.send_message(client, json.dumps({"cmd": "ping", "val": self.codes["OK"], "listener": listener_id}))
-                                    else:
-                                        self.wss.send_message(client, json.dumps({"cmd": "ping", "val": self.codes["OK"]}))
-                                
-                            else: # Route the packet using UPL.
-                                if ("val" in msg) and ("id" in msg): # Verify that the packet contains the required parameters.
-                                    if self._get_client_type(client) == "scratch":
-                                        if self._is_json(msg["val"]):
-                                            msg["val"] = json.loads(msg["val"])
-                                    if msg["id"] in self.statedata["ulist"]["usernames"]:
-                                        if True:
-                                            if not client == self._get_obj_of_username(msg["id"]):
-                                                try:
-                                                    otherclient = self._get_obj_of_username(msg["id"])
-                                                    if not len(self._get_username_of_obj(client)) == 0:
-                                                        msg["origin"] = self._get_username_of_obj(client)
-                                                        if (self._get_client_type(otherclient) == "scratch") and ((self._is_json(msg["val"])) or (type(msg["val"]) == dict)):
-                                                            tmp_val = json.dumps(msg["val"])
-                                                        else:
-                                                            tmp_val = msg["val"]
-
-                                                        if self.debug:
-                                                            print('Routing {0} to {1}'.format(msg, msg["id"]))
-                                                        del msg["id"]
-                                                        self.wss.send_message(otherclient, json.dumps(msg))
-                                                        
-                                                        if listener_detected:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"], "listener": listener_id}))
-                                                        else:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                                    else:
-                                                        if listener_detected:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDRequired"], "listener": listener_id}))
-                                                        else:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDRequired"]}))
-                                                except Exception as e:
-                                                    if self.debug:
-                                                        print("Error on _server_packet_handler: {0}".format(e))
-                                                    if listener_detected:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"], "listener": listener_id}))
-                                                    else:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                                            else:
-                                                if self.debug:
-                                                    print('Error: Potential packet loop detected, aborting')
-                                                if listener_detected:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Loop"], "listener": listener_id}))
-                                                else:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Loop"]}))
-                                        else:
-                                            if self.debug:
-                                                print('Error: Packet too large')
-                                            if listener_detected:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"], "listener": listener_id}))
-                                            else:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TooLarge"]}))
-                                    else:
-                                        if self.debug:
-                                            print('Error: ID Not found')
-                                        if listener_detected:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDNotFound"], "listener": listener_id}))
-                                        else:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IDNotFound"]}))
-                                else:
-                                    if self.debug:
-                                        print('Error: Packet missing parameters')
-                                    if listener_detected:
-                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                                    else:
-                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                        else:
-                            if self.debug:
-                                print('Error: Packet "cmd" datatype invalid: expecting <class "bool">, got {0}'.format(type(msg["cmd"])))
-                            if listener_detected:
-                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Datatype"], "listener": listener_id}))
-                            else:
-                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Datatype"]}))
-                    else:
-                        if self.debug:
-                            print('Error: Packet missing "cmd" parameter')
-                        if listener_detected:
-                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                        else:
-                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                except json.decoder.JSONDecodeError:
+            if not packet.error == None:
+                if self.debug:
+                    print("Error: Packet unusable: {0}".format(packet.error))
+                self._send_code(client, packet.error, packet.listener_detected, packet.listener_id)
+                return
+            try:
+                msg = packet.msg
+                
+                if ("id" in msg) and (type(msg["id"]) != str):
+                    msg["id"] = str(msg["id"])
+                
+                if not "cmd" in msg: # Verify that the packet contains the command parameter, which is needed to work.
                     if self.debug:
-                        print("Error: Failed to parse JSON")
-                    if listener_detected:
-                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
-                    else:
-                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                except Exception as e:
+                        print('Error: Packet missing "cmd" parameter')
+                    self._send_code(client, "Syntax", packet.listener_detected, packet.listener_id)
+                elif not type(msg["cmd"]) == str:
                     if self.debug:
-                        print("Error on _server_packet_handler: {0}".format(full_stack()))
-                    if listener_detected:
-                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"], "listener": listener_id}))
+                        print('Error: Packet "cmd" datatype invalid: expecting <class "str">, got {0}'.format(type(msg["cmd"])))
+                    self._send_code(client, "Datatype", packet.listener_detected, packet.listener_id)
+                elif msg["cmd"] in self.disabled_commands:
+                    self._send_code(client, "Disabled", packet.listener_detected, packet.listener_id)
+                else:
+                    if msg["cmd"] in self.commands:
+                        handler, params = self.commands[msg["cmd"]]
                     else:
-                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-            else:
+                        handler, params = self._route_packet, ("val", "id")
+                    
+                    # Verify that the packet contains the required parameters.
+                    for param in params:
+                        if not param in msg:
+                            if self.debug:
+                                print('Error: Packet missing parameters')
+                            self._send_code(client, "Syntax", packet.listener_detected, packet.listener_id)
+                            return
+                    handler(client, packet)
+            except Exception as e:
                 if self.debug:
-                    print("Error: Packet is empty")
-                if listener_detected:
-                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["EmptyPacket"], "listener": listener_id}))
-                else:
-                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["EmptyPacket"]}))
+                    print("Error on _server_packet_handler: {0}".format(full_stack()))
+                self._send_code(client, "InternalServerError", packet.listener_detected, packet.listener_id)
+    
+    def _is_packet_too_large(self, packet): # Checks a parsed packet against its command's size limit, before its val is decoded or it is queued
+        msg = packet.msg
+        cmd = msg.get("cmd")
+        val = msg.get("val")
+        if (cmd == "direct") and (type(val) == str) and (self._get_client_type(packet.client) == "scratch"):
+            # Scratch clients send the direct val as a JSON string, its command is only known once it is decoded
+            val = packet.decoded_val()
+        if (cmd == "direct") and (type(val) == dict) and (type(val.get("cmd")) == str) and (val["cmd"] in self.packet_size_limits):
+            limit = self.packet_size_limits[val["cmd"]]
+        elif (type(cmd) == str) and (cmd in self.packet_size_limits):
+            limit = self.packet_size_limits[cmd]
+        else:
+            limit = self.packet_size_limits.get(None, 0)
+        return (limit > 0) and (len(packet.raw) > limit)
     
-    def _get_ulist(self): # Generates username list
-        tmp_ulist = list((self.statedata["ulist"]["usernames"]).keys())
-        for item in tmp_ulist:
-            if item[0] == "%" and item[len(item)-1] == "%":
-                tmp_ulist.pop(tmp_ulist.index(item))
+    def _is_hidden_username(self, username): # Usernames wrapped in % are left out of the username list
+        return username.startswith("%") and username.endswith("%")
+    
+    def _get_ulist(self): # Returns the username list, only rebuilt after a username was removed
+        with self.ulist_lock:
+            return self._get_ulist_locked()
+    
+    def _get_ulist_locked(self): # _get_ulist for callers that already hold ulist_lock
+        if self.ulist_cache == None:
+            usernames = self.statedata["ulist"]["usernames"]
+            self.ulist_cache = "".join([username + ";" for username in usernames if not self._is_hidden_username(username)])
+            self.ulist_cache += "".join([username + ";" for username in self.remote_usernames if not (username in usernames or self._is_hidden_username(username))])
+        return self.ulist_cache
+    
+    def _get_ulist_packet(self, codec=None): # Returns the serialized ulist packet, shared by every client of a codec that gets the full list
+        with self.ulist_lock:
+            # List and packet in one lock hold, so a change in between can't leave a stale packet cached
+            if not codec in self.ulist_packets:
+                self.ulist_packets[codec] = self._encode_packet({"cmd": "ulist", "val": self._get_ulist_locked()}, codec)
+            return self.ulist_packets[codec]
+    
+    def _queue_ulist_change(self, username, change): # Records an "add" or "remove" for the next broadcast, caller holds ulist_lock
+        if self._is_hidden_username(username):
+            return
+        if change == "add":
+            if not self.ulist_cache == None:
+                self.ulist_cache = self.ulist_cache + username + ";"
+        else:
+            self.ulist_cache = None
+        self.ulist_packets = {}
         
-        output = ""
-        for item in tmp_ulist:
-            output = output + item + ";"
-        return output
+        # A username that comes and goes within one window cancels out
+        if username in self.ulist_pending:
+            del self.ulist_pending[username]
+        else:
+            self.ulist_pending[username] = change
+    
+    def _add_username(self, client, username): # Gives a client a username and queues the username list update
+        with self.ulist_lock:
+            obj = self.statedata["ulist"]["objs"][client["id"]]
+            old_username = obj["username"]
+            if old_username == username:
+                return
+            if self.statedata["ulist"]["usernames"].get(old_username) == client["id"]:
+                del self.statedata["ulist"]["usernames"][old_username]
+                if not old_username in self.remote_usernames:
+                    self._queue_ulist_change(old_username, "remove")
+                if not self.cluster == None:
+                    self.cluster.release(old_username, obj["claim"])
+            if not (username in self.statedata["ulist"]["usernames"] or username in self.remote_usernames):
+                self._queue_ulist_change(username, "add")
+            self.statedata["ulist"]["usernames"][username] = client["id"]
+            obj["username"] = username
+            if not self.cluster == None:
+                # The other processes drop their login of the username, or this one if they claim it later
+                obj["claim"] = self.cluster.claim(username)
+        self._schedule_ulist_broadcast()
+    
+    def _remove_username(self, client): # Takes a client's username off the username list and queues the update
+        with self.ulist_lock:
+            obj = self.statedata["ulist"]["objs"][client["id"]]
+            username = obj["username"]
+            if not self.statedata["ulist"]["usernames"].get(username) == client["id"]:
+                return
+            del self.statedata["ulist"]["usernames"][username]
+            if not username in self.remote_usernames:
+                self._queue_ulist_change(username, "remove")
+            if not self.cluster == None:
+                self.cluster.release(username, obj["claim"])
+        self._schedule_ulist_broadcast()
+    
+    def _get_clients_of_usernames(self, usernames): # Returns the clients of the usernames online here, and node -> usernames for the ones online on other processes of the cluster
+        with self.ulist_lock:
+            return self._get_clients_of_usernames_locked(usernames)
+    
+    def _get_clients_of_usernames_locked(self, usernames): # _get_clients_of_usernames for a caller holding ulist_lock, one lookup per username
+        clients = []
+        remote = {}
+        for username in usernames:
+            client_id = self.statedata["ulist"]["usernames"].get(username)
+            if not client_id == None:
+                clients.append(self.statedata["ulist"]["objs"][client_id]["object"])
+            elif username in self.remote_usernames:
+                remote.setdefault(self.remote_usernames[username], []).append(username)
+        return clients, remote
+    
+    def _send_to_remote_users(self, msg, remote): # Hands a packet to the cluster nodes of its users, one message per node naming its users
+        for node, usernames in remote.items():
+            self.cluster.publish("user_packet", {"packet": msg, "users": usernames}, node)
+    
+    def _on_cluster_packet(self, msg): # Delivers a broadcast from another process of the cluster to this one's clients
+        self._send_to_all(msg)
+    
+    def _on_cluster_user_packet(self, data): # Delivers a packet from another process of the cluster to the users it names, the ones that left in between miss it
+        clients, remote = self._get_clients_of_usernames(data["users"])
+        self._send_to_clients(clients, data["packet"])
+    
+    def _on_cluster_room(self, data): # Another process of the cluster set or deleted a room
+        with self.ulist_lock:
+            if data["users"] == None:
+                self.rooms.pop(data["room"], None)
+            else:
+                self.rooms[data["room"]] = set(data["users"])
+    
+    def _on_cluster_user_add(self, data): # A username went online on another process of the cluster
+        with self.ulist_lock:
+            username = data["user"]
+            if not (username in self.statedata["ulist"]["usernames"] or username in self.remote_usernames):
+                self._queue_ulist_change(username, "add")
+            self.remote_usernames[username] = data["node"]
+        self._schedule_ulist_broadcast()
+    
+    def _on_cluster_user_remove(self, data): # A username went offline on another process of the cluster
+        with self.ulist_lock:
+            username = data["user"]
+            if not self.remote_usernames.get(username) == data["node"]:
+                return
+            del self.remote_usernames[username]
+            if not username in self.statedata["ulist"]["usernames"]:
+                self._queue_ulist_change(username, "remove")
+        self._schedule_ulist_broadcast()
+    
+    def _on_cluster_drop(self, data): # Another process of the cluster took a username later, kicks the client that had it here
+        with self.ulist_lock:
+            username = data["user"]
+            client_id = self.statedata["ulist"]["usernames"].get(username)
+            obj = self.statedata["ulist"]["objs"].get(client_id)
+            if (obj == None) or (not obj.get("claim") == data["claim"]):
+                return # Since logged out, or in again
+            del self.statedata["ulist"]["usernames"][username]
+            obj["username"] = ""
+            if not username in self.remote_usernames:
+                self._queue_ulist_change(username, "remove")
+            client = obj["object"]
+        self._schedule_ulist_broadcast()
+        if self.debug:
+            print("Kicking {0} ({1}), logged in on another process".format(client["id"], username))
+        self._send_code(client, "IDConflict")
+        client["handler"].send_close(1000, bytes('', encoding='utf-8'))
+    
+    def _schedule_ulist_broadcast(self): # Coalesces username list changes into one broadcast per ulist_window seconds
+        if self.ulist_window <= 0:
+            self._broadcast_ulist()
+            return
+        with self.ulist_lock:
+            if not self.ulist_timer == None:
+                return
+            self.ulist_timer = threading.Timer(self.ulist_window, self._broadcast_ulist)
+            self.ulist_timer.daemon = True
+            self.ulist_timer.start()
+    
+    def _broadcast_ulist(self): # Sends pending username list changes: ulist_add / ulist_remove to clients that opted in, the full list to everyone else
+        try:
+            with self.ulist_lock:
+                self.ulist_timer = None
+                pending = self.ulist_pending
+                self.ulist_pending = {}
+            if len(pending) == 0:
+                return
+            
+            full_clients = []
+            delta_clients = []
+            for client in list(self.wss.clients):
+                if self.statedata["secure_enable"] and (not self._is_obj_trusted(client)):
+                    continue
+                obj = self.statedata["ulist"]["objs"].get(client["id"])
+                if (not obj == None) and obj.get("ulist_delta", False):
+                    delta_clients.append(client)
+                else:
+                    full_clients.append(client)
+            
+            for codec, clients in self._group_by_codec(full_clients).items():
+                self._send_encoded(clients, codec, self._get_ulist_packet(codec))
+            if len(delta_clients) != 0:
+                added = "".join([username + ";" for username, change in pending.items() if change == "add"])
+                removed = "".join([username + ";" for username, change in pending.items() if change == "remove"])
+                if len(added) != 0:
+                    self._send_to_many(delta_clients, {"cmd": "ulist_add", "val": added})
+                if len(removed) != 0:
+                    self._send_to_many(delta_clients, {"cmd": "ulist_remove", "val": removed})
+        except Exception as e:
+            if self.debug:
+                print("Error on _broadcast_ulist: {0}".format(full_stack()))
     
     def _on_connection_server(self, client, server): # Server-side new connection handler
         if not type(client) == type(None):
@@ -989,8 +1393,10 @@ class CloudLink(API):
                 if self.debug:
                     print("New connection: {0}".format(str(client['id'])))
 
-                # Add the client to the ulist object in memory.
-                self.statedata["ulist"]["objs"][client["id"]] = {"object": client, "username": "", "ip": client["handler"].ip, "type": None}
+                # Add the client to the ulist object in memory, and to the IP index.
+                with self.ulist_lock:
+                    self.statedata["ulist"]["objs"][client["id"]] = {"object": client, "username": "", "ip": client["handler"].ip, "type": None, "codec": None}
+                    self.ip_index.setdefault(client["handler"].ip, set()).add(client["id"])
 
                 # Send the MOTD if enabled.
                 if self.statedata["motd_enable"]:
@@ -1001,13 +1407,13 @@ class CloudLink(API):
 
                 if not self.statedata["secure_enable"]:
                     # Send the current username list.
-                    self.wss.send_message(client, json.dumps({"cmd": "ulist", "val": self._get_ulist()}))
+                    self.wss.send_message(client, self._get_ulist_packet())
 
                     # Send the current global data stream value.
                     self.wss.send_message(client, json.dumps({"cmd": "gmsg", "val": str(self.statedata["gmsg"])}))
                 else:
                     # Tell the client that the server is expecting a Trusted Access key.
-                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TAEnabled"]}))
+                    self._send_code(client, "TAEnabled")
 
                 if not self.callback_function["on_connect"] == None:
                     def run(*args):
@@ -1016,12 +1422,13 @@ class CloudLink(API):
                         except Exception as e:
                             if self.debug:
                                 print("Error on _on_connection_server: {0}".format(e))
-                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                    threading.Thread(target=run).start()
+                            self._send_code(client, "InternalServerError")
+                    # Queued like a packet so it runs before anything the client sends
+                    self.packet_workers.submit(client["id"], run)
             except Exception as e:
                 if self.debug:
                     print("Error on _on_connection_server: {0}".format(e))
-                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
+                self._send_code(client, "InternalServerError")
     
     def _closed_connection_server(self, client, server): # Server-side client closed connection handler
         if not type(client) == type(None):
@@ -1039,156 +1446,133 @@ class CloudLink(API):
                         if self.debug:
                             print("Error on _closed_connection_server: {0}".format(e))
                 
-                # Remove entries from username list and userlist objects
-                if self.statedata["ulist"]["objs"][client['id']]["username"] in self.statedata["ulist"]["usernames"]:
-                    del self.statedata["ulist"]["usernames"][self.statedata["ulist"]["objs"][client['id']]["username"]]
-                del self.statedata["ulist"]["objs"][client['id']]
+                # Drop packets the client still had queued
+                self.packet_workers.discard(client["id"])
+                
+                # Remove entries from username list, userlist objects and the IP index
+                self._remove_username(client)
+                with self.ulist_lock:
+                    ip = self.statedata["ulist"]["objs"].pop(client['id'])["ip"]
+                    self.ip_index[ip].discard(client['id'])
+                    if len(self.ip_index[ip]) == 0:
+                        del self.ip_index[ip]
 
                 if self.statedata["secure_enable"]:
-                    if client in self.statedata["trusted"]:
-                        self.statedata["trusted"].remove(client)
-
-                self._send_to_all({"cmd": "ulist", "val": self._get_ulist()})
+                    self.statedata["trusted"].discard(client["id"])
             except Exception as e:
                 if self.debug:
                     print("Error on _closed_connection_server: {0}".format(e))
     
-    def _on_packet_server(self, client, server, message): # Server-side new packet handler (Gives it's powers to _server_packet_handler)
+    def _on_binary_packet_server(self, client, server, message): # Server-side binary packet handler, decoded with the client's codec
+        if not type(client) == type(None):
+            codec = self._get_client_codec(client)
+            if codec == None:
+                if self.debug:
+                    print("Error: Binary packet from {0}, which has not negotiated a codec".format(client["id"]))
+                self._send_code(client, "Syntax")
+                return
+            self._on_packet_server(client, server, message, self.codecs[codec][1])
+    
+    def _on_packet_server(self, client, server, message, decode=None): # Server-side new packet handler (Gives it's powers to _server_packet_handler)
         if not type(client) == type(None):
+            packet = None
             try:
                 if self.debug:
                     print("New packet from {0}: {1} bytes".format(str(client['id']), str(len(message))))
+                
+                # A packet longer than any command takes isn't worth parsing
+                if self.packet_size_cap and (len(message) > self.packet_size_cap):
+                    if self.debug:
+                        print("Error: Packet from {0} too large".format(client["id"]))
+                    self._send_code(client, "TooLarge")
+                    return
+                
+                # Parse the packet once, everything after this reuses it
+                packet = Packet(client, message, decode)
+                
+                # The command's own limit needs the packet parsed, but is checked before anything else is done with it
+                if (packet.error == None) and self._is_packet_too_large(packet):
+                    if self.debug:
+                        print("Error: {0} packet from {1} too large".format(packet.msg.get("cmd"), client["id"]))
+                    self._send_code(client, "TooLarge", packet.listener_detected, packet.listener_id)
+                    return
+                
                 if self.statedata["secure_enable"]:
                     if not self._is_obj_trusted(client):
-                        try:
-                            msg = json.loads(message)
-                            listener_detected = (("listener" in msg) and (type(msg["listener"]) == str))
-                            listener_id = ""
-                            # Support listener IDs feature from CL Turbo
-                            if listener_detected: 
-                                listener_id = msg["listener"]
-                            
-                            if ("cmd" in msg) and ("val" in msg):
-                                if (msg["cmd"] == "direct") and (type(msg["val"]) == dict) and (msg["val"]["cmd"] in ["ip", "type"]):
+                        msg = packet.msg
+                        if not packet.error == None:
+                            if self.debug:
+                                print("Error on _on_packet_server: Failed to parse JSON")
+                            self._send_code(client, "Syntax")
+                        elif ("cmd" in msg) and ("val" in msg):
+                            if (msg["cmd"] == "direct") and (type(msg["val"]) == dict) and (msg["val"]["cmd"] in ["ip", "type"]):
+                                if self._is_obj_blocked(client):
+                                    if self.debug:
+                                        print("User {0} is IP blocked, not trusting".format(client["id"]))
+                                    # Tell the client it is IP blocked
+                                    self._send_code(client, "Blocked", packet.listener_detected, packet.listener_id)
+                                else:
+                                    self._server_packet_handler(client, packet)
+                            else:
+                                if (msg["cmd"] == "direct") or (msg["cmd"] == "gmsg"):
                                     if self._is_obj_blocked(client):
                                         if self.debug:
                                             print("User {0} is IP blocked, not trusting".format(client["id"]))
                                         # Tell the client it is IP blocked
-                                        if listener_detected:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Blocked"], "listener": listener_id}))
-                                        else:
-                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Blocked"]}))
+                                        self._send_code(client, "Blocked", packet.listener_detected, packet.listener_id)
                                     else:
-                                        self._server_packet_handler(client, server, message, listener_detected, listener_id)
-                                else:
-                                    if (msg["cmd"] == "direct") or (msg["cmd"] == "gmsg"):
-                                        if self._is_obj_blocked(client):
-                                            if self.debug:
-                                                print("User {0} is IP blocked, not trusting".format(client["id"]))
-                                            # Tell the client it is IP blocked
-                                            if listener_detected:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Blocked"], "listener": listener_id}))
-                                            else:
-                                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Blocked"]}))
-                                        else:
-                                            if type(msg["val"]) == str:
-                                                if msg["val"] in self.statedata["secure_keys"]:
-                                                    if self._get_ip_of_obj(client) == None:
-                                                        if self.debug:
-                                                            print("User {0} has not set their IP address, not trusting".format(client["id"]))
-                                                        if listener_detected:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IPRequred"], "listener": listener_id}))
-                                                        else:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IPRequred"]}))
-                                                    else:
-                                                        self.statedata["trusted"].append(client)
-                                                        if self.debug:
-                                                            print("Trusting user {0}".format(client["id"]))
+                                        if type(msg["val"]) == str:
+                                            if msg["val"] in self.statedata["secure_keys"]:
+                                                if self._get_ip_of_obj(client) == None:
+                                                    if self.debug:
+                                                        print("User {0} has not set their IP address, not trusting".format(client["id"]))
+                                                    self._send_code(client, "IPRequred", packet.listener_detected, packet.listener_id)
+                                                else:
+                                                    self.statedata["trusted"].add(client["id"])
+                                                    if self.debug:
+                                                        print("Trusting user {0}".format(client["id"]))
 
-                                                        # Send the current username list.
-                                                        self.wss.send_message(client, json.dumps({"cmd": "ulist", "val": self._get_ulist()}))
+                                                    # Send the current username list.
+                                                    codec = self._get_client_codec(client)
+                                                    self._send_data(client, codec, self._get_ulist_packet(codec))
 
-                                                        # Send the current global data stream value.
-                                                        self.wss.send_message(client, json.dumps({"cmd": "gmsg", "val": str(self.statedata["gmsg"])}))
+                                                    # Send the current global data stream value.
+                                                    self._send_packet(client, {"cmd": "gmsg", "val": str(self.statedata["gmsg"])})
 
-                                                        # Tell the client it has been trusted
-                                                        if listener_detected:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"], "listener": listener_id}))
-                                                        else:
-                                                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                                else:
-                                                    if listener_detected:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TAInvalid"], "listener": listener_id}))
-                                                    else:
-                                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["TAInvalid"]}))
+                                                    # Tell the client it has been trusted
+                                                    self._send_code(client, "OK", packet.listener_detected, packet.listener_id)
                                             else:
-                                                if listener_detected:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Datatype"], "listener": listener_id}))
-                                                else:
-                                                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Datatype"]}))
-                                    else:
-                                        self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Refused"]}))
-                            else:
-                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                        except json.decoder.JSONDecodeError:
-                            if self.debug:
-                                print("Error on _on_packet_server: Failed to parse JSON")
-                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
-                    else:
-                        try:
-                            msg = json.loads(message)
-                            listener_detected = (("listener" in msg) and (type(msg["listener"]) == str))
-                            listener_id = ""
-                            # Support listener IDs feature from CL Turbo
-                            if listener_detected: 
-                                listener_id = msg["listener"]
-                        except:
-                            listener_detected = False
-                            listener_id = ""
-                        def run(*args):
-                            try:
-                                self._server_packet_handler(client, server, message, listener_detected, listener_id)
-                            except Exception as e:
-                                if self.debug:
-                                    print("Error on _on_packet_server: {0}".format(e))
-                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                        threading.Thread(target=run).start()
-                else:
-                    def run(*args):
-                        try:
-                            msg = json.loads(message)
-                            listener_detected = (("listener" in msg) and (type(msg["listener"]) == str))
-                            listener_id = ""
-                            # Support listener IDs feature from CL Turbo
-                            if listener_detected: 
-                                listener_id = msg["listener"]
-                        except:
-                            listener_detected = False
-                            listener_id = ""
-                        try:
-                            self._server_packet_handler(client, server, message, listener_detected, listener_id)
-                        except Exception as e:
-                            if self.debug:
-                                print("Error on _on_packet_server: {0}".format(e))
-                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                    threading.Thread(target=run).start()
+                                                self._send_code(client, "TAInvalid", packet.listener_detected, packet.listener_id)
+                                        else:
+                                            self._send_code(client, "Datatype", packet.listener_detected, packet.listener_id)
+                                else:
+                                    self._send_code(client, "Refused")
+                        else:
+                            self._send_code(client, "Syntax")
+                        return
+                
+                def run(*args):
+                    try:
+                        self._server_packet_handler(client, packet)
+                    except Exception as e:
+                        if self.debug:
+                            print("Error on _on_packet_server: {0}".format(e))
+                        self._send_code(client, "InternalServerError")
+                self._queue_packet(client, packet, run)
             except Exception as e:
-                try:
-                    msg = json.loads(message)
-                    listener_detected = (("listener" in msg) and (type(msg["listener"]) == str))
-                    listener_id = ""
-                    # Support listener IDs feature from CL Turbo
-                    if listener_detected: 
-                        listener_id = msg["listener"]
-                except:
-                    listener_detected = False
-                    listener_id = ""
                 if self.debug:
                     print("Error on _on_packet_server: {0}".format(e))
-                if listener_detected:
-                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"], "listener": listener_id}))
+                if not packet == None:
+                    self._send_code(client, "InternalServerError", packet.listener_detected, packet.listener_id)
                 else:
-                    self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
+                    self._send_code(client, "InternalServerError")
+    
+    def _queue_packet(self, client, packet, run): # Hands a packet to the worker pool, handling a full per-client queue
+        if not self.packet_workers.submit(client["id"], run):
+            if self.debug:
+                print("Error: Packet queue full for client {0}, {1}".format(client["id"], self.packet_workers.overflow))
+            if self.packet_workers.overflow == "ratelimit":
+                self._send_code(client, "RateLimit", packet.listener_detected, packet.listener_id)
     
     def _on_connection_client(self, ws): # Client-side connection handler
         try:
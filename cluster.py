@@ -0,0 +1,480 @@
+import os
+import sys
+import json
+import hmac
+import queue
+import socket
+import hashlib
+import ipaddress
+import tempfile
+import threading
+import multiprocessing
+import time
+import traceback
+
+"""
+
+CloudLink cluster
+
+Runs one server over several processes, on one machine (sharing a port with
+SO_REUSEPORT) or on several. A hub passes messages between the nodes of the
+cluster and decides which node owns a username, each node talks to it
+through an event bus:
+    Broker + SocketBus    the hub listens on a Unix socket or a TCP port,
+                          for the processes of one machine or for several
+                          machines
+    LocalHub + LocalBus   everything in one process, for tests or for
+                          several servers run by the same program
+
+Messages are {"topic": ..., "data": ...}, one JSON object per line on a
+socket. A message with a "node" goes to that node only, everything else to
+every other node. Topics are the application's own except for these, which
+the hub handles itself:
+    claim, release    node -> hub, a username is taken or given up
+    challenge, auth   hub -> node, node -> hub, the handshake when the
+                      cluster has a shared secret, see below
+    welcome           hub -> node, the ID the node was given
+    user_add, user_remove
+                      hub -> nodes, a username is now owned by a node or
+                      not anymore
+    drop              hub -> node, another node claimed a username after
+                      this one did, the older login has to go
+
+The Broker writes to each node from a thread of its own, so a node that
+reads slowly never holds up the others. A node that falls
+NODE_QUEUE_LIMIT bytes behind is disconnected, and its usernames are
+released like those of a node that stopped.
+
+A node that joins a Broker can claim any username, send packets to any
+user and drop logged in users, so nodes have to prove they know the
+cluster's shared secret (CLOUDLINK_CLUSTER_SECRET in the environment of
+the Broker and of every node, or the secret argument): the Broker sends a
+challenge with a random nonce, the node answers with the HMAC-SHA256 of
+the nonce, and only then gets a welcome. Without a secret a Broker only
+listens on a Unix socket or a loopback address. The secret doesn't
+encrypt anything and nodes don't check the Broker, so between machines
+keep the Broker on a private network or a VPN as well.
+
+"""
+
+NODE_QUEUE_LIMIT = 64 * 1024 * 1024 # Bytes a Broker queues for a node before it drops the node
+SECRET_ENV = "CLOUDLINK_CLUSTER_SECRET" # Environment variable the shared secret is read from when none is given
+HANDSHAKE_TIMEOUT = 10 # Seconds a node has to answer the Broker's challenge
+
+def get_secret(secret=None): # The shared secret as bytes, the one in SECRET_ENV if secret is None, b"" for none
+    if secret == None:
+        secret = os.environ.get(SECRET_ENV, "")
+    if type(secret) == str:
+        secret = secret.encode()
+    return secret
+
+def sign_nonce(secret, nonce): # A node's answer to the Broker's challenge
+    return hmac.new(secret, nonce.encode(), hashlib.sha256).hexdigest()
+
+def is_loopback(address): # Checks if a Broker address can only be reached from this machine
+    if type(address) == str:
+        return True # Unix socket
+    host, port = address
+    if host in ("", None):
+        return False # Every interface
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0].split("%")[0]).is_loopback for info in infos)
+
+class Hub: # Passes messages between the nodes of a cluster and decides which node owns a username, see Broker and LocalHub
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.lock = threading.Lock() # Guards everything below, held while passing messages on so every node sees changes in the same order
+        self.nodes = {} # Node ID -> whatever _send_to needs to reach it
+        self.owners = {} # Username -> (node ID, claim number), the last claim wins
+        self.last_node = 0
+
+    def _send_to(self, node, message): # Sends a message to a node without waiting on it, implemented by each hub, caller holds lock
+        raise NotImplementedError
+
+    def _add_node(self, connection): # Registers a node, caller holds lock, returns its ID
+        self.last_node += 1
+        node = self.last_node
+        self.nodes[node] = connection
+        # Tell the new node who it is and who is already online elsewhere
+        self._send_to(node, {"topic": "welcome", "data": {"node": node}})
+        for username, owner in self.owners.items():
+            self._send_to(node, {"topic": "user_add", "data": {"user": username, "node": owner[0]}})
+        return node
+
+    def _remove_node(self, node): # Forgets a node and releases its usernames, caller holds lock
+        del self.nodes[node]
+        for username, owner in list(self.owners.items()):
+            if owner[0] == node:
+                del self.owners[username]
+                self._relay(node, "user_remove", {"user": username, "node": node})
+
+    def _receive(self, node, message): # Handles a message from a node, caller holds lock
+        topic = message["topic"]
+        if topic == "claim":
+            self._claim(node, message["data"])
+        elif topic == "release":
+            self._release(node, message["data"])
+        elif "node" in message:
+            # Meant for the users of one node only
+            if message["node"] in self.nodes:
+                self._send_to(message["node"], {"topic": topic, "data": message["data"], "from": node})
+        else:
+            self._relay(node, topic, message["data"])
+
+    def _claim(self, node, data): # Gives a username to the node that claimed it last, caller holds lock
+        username = data["user"]
+        previous = self.owners.get(username)
+        self.owners[username] = (node, data["claim"])
+        if (previous == None) or (not previous[0] == node):
+            self._relay(node, "user_add", {"user": username, "node": node})
+        if (not previous == None) and (not previous[0] == node) and (previous[0] in self.nodes):
+            # After the user_add, so the old owner never sees the username go missing in between
+            self._send_to(previous[0], {"topic": "drop", "data": {"user": username, "claim": previous[1]}})
+
+    def _release(self, node, data): # Frees a username, unless a newer claim took it already, caller holds lock
+        username = data["user"]
+        if self.owners.get(username) == (node, data["claim"]):
+            del self.owners[username]
+            self._relay(node, "user_remove", {"user": username, "node": node})
+
+    def _relay(self, sender, topic, data): # Sends a message to every node but the sender, caller holds lock
+        for node in self.nodes:
+            if not node == sender:
+                self._send_to(node, {"topic": topic, "data": data, "from": sender})
+
+class NodeConnection: # A node's socket on a Broker, written to by a thread of its own so sending to it never waits on the node
+    def __init__(self, conn, queue_limit=NODE_QUEUE_LIMIT):
+        self.conn = conn
+        self.queue_limit = queue_limit # 0 for no limit
+        self.ready = threading.Condition()
+        self.queue = [] # Encoded messages for the writer thread, guarded by ready
+        self.queued = 0 # Bytes in queue
+        self.closed = False
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def send(self, data): # Queues data for the node, returns False if the node fell queue_limit bytes behind and was disconnected
+        with self.ready:
+            if self.closed:
+                return True # Already gone, its reader cleans up
+            if self.queue_limit and (self.queued + len(data) > self.queue_limit):
+                self._close()
+                return False
+            self.queue.append(data)
+            self.queued += len(data)
+            self.ready.notify()
+            return True
+
+    def close(self): # Disconnects the node, its reader then sees it leave
+        with self.ready:
+            self._close()
+
+    def _close(self): # Caller holds ready
+        self.closed = True
+        self.queue = []
+        self.queued = 0
+        self.ready.notify()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self): # Writes out everything queued since the last write in one go
+        while True:
+            with self.ready:
+                while (not self.queue) and (not self.closed):
+                    self.ready.wait()
+                if self.closed:
+                    return
+                data = b"".join(self.queue)
+                self.queue = []
+                self.queued = 0
+            try:
+                self.conn.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+class Broker(Hub): # A hub the nodes connect to with a SocketBus, address is a Unix socket path or a (host, port) tuple
+    def __init__(self, address, debug=False, queue_limit=NODE_QUEUE_LIMIT, secret=None):
+        Hub.__init__(self, debug)
+        self.address = address # The bound (host, port) once started, for a TCP port 0
+        self.queue_limit = queue_limit # Bytes a node can fall behind before it is dropped, see NodeConnection
+        self.secret = get_secret(secret) # Shared secret nodes have to prove they know, see get_secret
+        self.sock = None
+
+    def start(self): # Starts listening for nodes, on a thread of its own. Raises ValueError for an address other machines can reach when there is no secret
+        if (not self.secret) and (not is_loopback(self.address)):
+            raise ValueError("A Broker on {0} can be reached from other machines, it needs a shared secret (set {1})".format(self.address, SECRET_ENV))
+        if type(self.address) == str:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.address)
+        else:
+            self.sock = socket.create_server(tuple(self.address))
+            self.address = self.sock.getsockname()[:2]
+        self.sock.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def stop(self): # Stops listening and disconnects every node
+        self.sock.close()
+        with self.lock:
+            for connection in self.nodes.values():
+                connection.close()
+        if (type(self.address) == str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            if not conn.family == socket.AF_UNIX:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn): # Lets a node in once it has answered the challenge, then reads its messages until it disconnects
+        node = None
+        reader = conn.makefile("rb")
+        try:
+            if self.secret and (not self._authenticate(conn, reader)):
+                if self.debug:
+                    print("Refused a node that failed the handshake")
+                return
+            with self.lock:
+                node = self._add_node(NodeConnection(conn, self.queue_limit))
+            for line in reader:
+                message = json.loads(line)
+                with self.lock:
+                    self._receive(node, message)
+        except (OSError, ValueError):
+            if self.debug:
+                print("Error on Broker: {0}".format(traceback.format_exc()))
+        finally:
+            if not node == None:
+                with self.lock:
+                    self.nodes[node].close()
+                    self._remove_node(node)
+            conn.close()
+
+    def _authenticate(self, conn, reader): # Sends a node the challenge, returns True if it answered with the nonce signed with the secret
+        nonce = os.urandom(32).hex()
+        conn.settimeout(HANDSHAKE_TIMEOUT)
+        conn.sendall(json.dumps({"topic": "challenge", "data": {"nonce": nonce}}).encode() + b"\n")
+        line = reader.readline(1024) # An answer is far shorter, don't buffer whatever an intruder sends
+        conn.settimeout(None)
+        try:
+            answer = json.loads(line)["data"]["hmac"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return (type(answer) == str) and hmac.compare_digest(answer, sign_nonce(self.secret, nonce))
+
+    def _send_to(self, node, message): # Only queues the message, so a slow node never holds up the lock
+        if not self.nodes[node].send(json.dumps(message).encode() + b"\n"):
+            # Its reader sees it leave and releases its usernames
+            if self.debug:
+                print("Node {0} fell {1} bytes behind, dropping it".format(node, self.queue_limit))
+
+class LocalHub(Hub): # A hub for nodes in the same process, see LocalBus
+    def connect(self, bus): # Returns the node ID of a new LocalBus
+        with self.lock:
+            return self._add_node(bus)
+
+    def disconnect(self, node):
+        with self.lock:
+            if node in self.nodes:
+                self._remove_node(node)
+
+    def receive(self, node, message):
+        with self.lock:
+            if node in self.nodes:
+                self._receive(node, message)
+
+    def _send_to(self, node, message):
+        # A copy, like a message that went through a socket
+        self.nodes[node].inbox.put(json.loads(json.dumps(message)))
+
+class EventBus: # A node's connection to the rest of its cluster, see CloudLink.joinCluster. Implemented by SocketBus and LocalBus
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.node = None # ID the hub gave this node
+        self.subscribers = {} # Topic -> functions called with the data of messages from the hub
+        self.claim_lock = threading.Lock()
+        self.last_claim = 0
+
+    def start(self): # Joins the cluster
+        raise NotImplementedError
+
+    def stop(self): # Leaves the cluster, the hub releases every username of this node
+        raise NotImplementedError
+
+    def _put(self, message): # Hands a message to the hub without waiting on it, implemented by each bus
+        raise NotImplementedError
+
+    def subscribe(self, topic, function): # Calls function(data) for every message on topic, on the bus' own thread
+        self.subscribers.setdefault(topic, []).append(function)
+
+    def publish(self, topic, data, node=None): # Sends data to the subscribers of topic on every other node, or on node only
+        message = {"topic": topic, "data": data}
+        if not node == None:
+            message["node"] = node
+        self._put(message)
+
+    def claim(self, username): # Takes a username for this node, returns the claim number to release it with
+        with self.claim_lock:
+            self.last_claim += 1
+            claim = self.last_claim
+            # Handed on under the lock, so the hub sees claims in the order of their numbers
+            self._put({"topic": "claim", "data": {"user": username, "claim": claim}})
+        return claim
+
+    def release(self, username, claim): # Gives up a username taken by claim
+        self._put({"topic": "release", "data": {"user": username, "claim": claim}})
+
+    def _deliver(self, message): # Runs the subscribers of a message from the hub
+        for function in self.subscribers.get(message["topic"], []):
+            try:
+                function(message["data"])
+            except Exception as e:
+                if self.debug:
+                    print("Error on EventBus: {0}".format(traceback.format_exc()))
+
+class SocketBus(EventBus): # Connects to a Broker, address is its Unix socket path or (host, port)
+    def __init__(self, address, debug=False, secret=None):
+        EventBus.__init__(self, debug)
+        self.address = address
+        self.secret = get_secret(secret) # Answers the Broker's challenge, see get_secret
+        self.outbox = queue.Queue() # Messages for the sender thread, so publishing never waits on the socket
+        self.sock = None
+
+    def start(self, timeout=10): # Connects to the Broker, retrying for up to timeout seconds while it starts up
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if type(self.address) == str:
+                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.sock.connect(self.address)
+                else:
+                    self.sock = socket.create_connection(tuple(self.address))
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                break
+            except OSError:
+                if not self.sock == None:
+                    self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        reader = self.sock.makefile("rb")
+        welcome = json.loads(reader.readline())
+        if welcome["topic"] == "challenge":
+            if not self.secret:
+                self.sock.close()
+                raise ConnectionRefusedError("The Broker at {0} needs the cluster's shared secret (set {1})".format(self.address, SECRET_ENV))
+            self.sock.sendall(json.dumps({"topic": "auth", "data": {"hmac": sign_nonce(self.secret, welcome["data"]["nonce"])}}).encode() + b"\n")
+            line = reader.readline()
+            if len(line) == 0:
+                self.sock.close()
+                raise ConnectionRefusedError("The Broker at {0} refused the shared secret".format(self.address))
+            welcome = json.loads(line)
+        self.node = welcome["data"]["node"]
+        if self.debug:
+            print("Joined the cluster as node {0}".format(self.node))
+        threading.Thread(target=self._send_loop, daemon=True).start()
+        threading.Thread(target=self._receive_loop, args=(reader,), daemon=True).start()
+
+    def stop(self):
+        self.outbox.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _put(self, message):
+        self.outbox.put(message)
+
+    def _send_loop(self):
+        while True:
+            message = self.outbox.get()
+            if message == None:
+                return
+            try:
+                self.sock.sendall(json.dumps(message).encode() + b"\n")
+            except OSError:
+                return
+
+    def _receive_loop(self, reader):
+        try:
+            for line in reader:
+                self._deliver(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        if self.debug:
+            print("Left the cluster")
+
+class LocalBus(EventBus): # Connects to a LocalHub in the same process
+    def __init__(self, hub, debug=False):
+        EventBus.__init__(self, debug)
+        self.hub = hub
+        self.inbox = queue.Queue() # Messages from the hub, delivered on the bus' own thread like a SocketBus does
+
+    def start(self):
+        self.node = self.hub.connect(self)
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+
+    def stop(self):
+        self.hub.disconnect(self.node)
+        self.inbox.put(None)
+
+    def _put(self, message):
+        self.hub.receive(self.node, message)
+
+    def _receive_loop(self):
+        while True:
+            message = self.inbox.get()
+            if message == None:
+                return
+            self._deliver(message)
+
+def parse_address(address): # "host:port" -> (host, port), anything else is a Unix socket path
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host, int(port))
+    return address
+
+def run_workers(count, target, address=None): # Runs target(worker, address) in count processes, with a Broker on address unless it is given (then one is already running), returns once they have all exited
+    broker = None
+    if address == None:
+        address = os.path.join(tempfile.mkdtemp(), "cluster.sock")
+        broker = Broker(address)
+        broker.start()
+    processes = [multiprocessing.Process(target=target, args=(worker, address)) for worker in range(count)]
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+    finally:
+        if not broker == None:
+            broker.stop()
+
+if __name__ == "__main__":
+    # Standalone Broker for the nodes of a cluster on several machines: python3 cluster.py HOST:PORT
+    # Nodes have to know the secret in CLOUDLINK_CLUSTER_SECRET, without one it only listens on loopback
+    broker = Broker(parse_address(sys.argv[1]), debug=True)
+    try:
+        broker.start()
+    except ValueError as e:
+        sys.exit(str(e))
+    print("Broker listening on {0}".format(broker.address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        broker.stop()
@@ -0,0 +1,167 @@
+import re
+import bisect
+from better_profanity import profanity
+from better_profanity.constants import ALLOWED_CHARACTERS
+from better_profanity.utils import read_wordlist, get_complete_path_of_file
+
+"""
+
+Meower profanity filter
+
+Censors what better_profanity censors, with its look-alike characters
+("@" or "4" for "a" and so on) and its phrases of several words, but
+compiles the word list once into an automaton instead of comparing every
+word of a message with every word of the list, and checks the default and
+the custom words in the same pass. A WordFilter is never changed once
+built, build a new one when the lists change.
+
+"""
+
+DEFAULT_WORDLIST = get_complete_path_of_file("profanity_wordlist.txt")
+CHARS_MAPPING = profanity.CHARS_MAPPING # Character of a listed word -> characters that can stand for it in a message
+
+WORD = re.compile("[{0}]+".format("".join(re.escape(char) for char in sorted(ALLOWED_CHARACTERS)))) # A word, as better_profanity splits messages
+
+class WordFilter:
+    def __init__(self, blacklist=[], whitelist=[]): # Censors the default word list and blacklist, except the words of whitelist
+        whitelist = set(word.lower() for word in whitelist)
+        words = set(word.lower() for word in read_wordlist(DEFAULT_WORDLIST))
+        words.update(word.lower() for word in blacklist)
+        words.difference_update(whitelist)
+        self.words = words
+
+        # Longest phrase, in words after the first
+        self.max_combinations = 1
+        for word in words:
+            self.max_combinations = max(self.max_combinations, len([char for char in word if not char in ALLOWED_CHARACTERS]))
+
+        # Trie of the words, node -> {character: node}
+        trie = [{}]
+        ends = set()
+        for word in words:
+            node = 0
+            for char in word:
+                if not char in trie[node]:
+                    trie[node][char] = len(trie)
+                    trie.append({})
+                node = trie[node][char]
+            ends.add(node)
+
+        # Turn it into an automaton on the characters of a message, where a state is the set of trie nodes the message so far could be at
+        self.transitions = [] # State -> {character: state}
+        self.accepting = set() # States at the end of a word
+        states = {frozenset([0]): 0}
+        queue = [frozenset([0])]
+        for nodes in queue:
+            moves = {}
+            for node in nodes:
+                for word_char, child in trie[node].items():
+                    for char in CHARS_MAPPING.get(word_char, (word_char,)):
+                        moves.setdefault(char, set()).add(child)
+            for char, children in moves.items():
+                children = frozenset(children)
+                if not children in states:
+                    states[children] = len(states)
+                    queue.append(children)
+                moves[char] = states[children]
+            self.transitions.append(moves)
+            if not nodes.isdisjoint(ends):
+                self.accepting.add(len(self.transitions) - 1)
+
+    def _walk(self, state, text): # The state after text, None once no word can match anymore
+        transitions = self.transitions
+        for char in text:
+            if state == None:
+                return None
+            state = transitions[state].get(char)
+        return state
+
+    def is_word(self, text): # Checks if text is a censored word
+        return self._walk(0, text.lower()) in self.accepting
+
+    def censor(self, text, censor_char="*"): # Replaces the censored words of text with 4 censor_char
+        if not isinstance(text, str):
+            text = str(text)
+        replacement = censor_char * 4
+
+        # If there are no words in the text, return it as it is
+        match = WORD.search(text)
+        if (match == None) or (match.start() >= len(text) - 1):
+            return text
+        censored = [text[:match.start()]]
+        text = text[match.start():]
+
+        # Find every word once, the rest is lookups
+        words = [match.span() for match in WORD.finditer(text)]
+        starts = [start for start, end in words]
+        ends = dict(words)
+
+        cur_word = ""
+        skip_index = -1
+        index = 0
+        while index < len(text):
+            end = ends.get(index)
+            if (end == None) and (text[index] in ALLOWED_CHARACTERS):
+                end = index + 1 # Inside a word, past the end of a censored phrase
+            if not end == None:
+                cur_word += text[index:end]
+                index = end
+                continue
+            char = text[index]
+
+            # Skip separators that follow each other
+            if cur_word.strip() == "":
+                censored.append(char)
+                cur_word = ""
+                index += 1
+                continue
+
+            state = self._walk(0, cur_word.lower())
+            if not state == None:
+                # Could be the start of a censored phrase, check the words that follow
+                end_index = self._phrase_end(state, self._next_words(text, starts, ends, index, self.max_combinations))
+                if not end_index == None:
+                    cur_word = replacement
+                    skip_index = end_index
+                    char = ""
+                    state = self._walk(0, cur_word)
+            if state in self.accepting:
+                cur_word = replacement
+
+            censored.append(cur_word + char)
+            cur_word = ""
+            index = max(index + 1, skip_index)
+
+        # The last word
+        if (not cur_word == "") and (skip_index < len(text) - 1):
+            if self.is_word(cur_word):
+                cur_word = replacement
+            censored.append(cur_word)
+        return "".join(censored)
+
+    def _next_words(self, text, starts, ends, start, count): # The count words after start, each as (word, end index) and (separators and word, end index)
+        next_word = bisect.bisect_left(starts, start)
+        if (next_word == len(starts)) or (starts[next_word] >= len(text) - 1):
+            return [("", len(text)), ("", len(text))]
+        word_start = starts[next_word]
+        word = text[word_start:ends[word_start]]
+        # Index of the separator after the word, or of its last character at the end of the text
+        end_index = min(ends[word_start], len(text) - 1)
+        words = [(word, end_index), (text[start:word_start] + word, end_index)]
+        if count > 1:
+            words.extend(self._next_words(text, starts, ends, end_index, count - 1))
+        return words
+
+    def _phrase_end(self, state, next_words): # End index of the censored phrase that starts with the word that led to state, with or without its separators, None if there is none
+        with_separators = state
+        for index in range(0, len(next_words), 2):
+            if (state == None) and (with_separators == None):
+                return None # Not the start of any listed phrase
+            word, end_index = next_words[index]
+            if word == "":
+                continue
+            state = self._walk(state, word.lower())
+            with_separators = self._walk(with_separators, next_words[index + 1][0].lower())
+            if (state in self.accepting) or (with_separators in self.accepting):
+                return end_index
+        return None
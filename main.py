@@ -1,10 +1,14 @@
 from cloudlink import CloudLink
+from cluster import SocketBus, run_workers, parse_address
 from supporter import Supporter
+from ratelimit import SharedRateLimiter
 from security import Security
 from files import Files
 from meower import Meower
 from rest_api import app as rest_api_app
 from threading import Thread
+from functools import partial
+import argparse
 
 """
 
@@ -23,13 +27,38 @@ Dependencies:
 
 """
 
+# Longest packet, in characters, each command takes. Posts may be 4000 characters and JSON escapes
+# a character to up to 12 (a surrogate pair), everything else is small
+PACKET_SIZE_LIMITS = {
+    None: 8 * 1024,
+    "post_home": 64 * 1024,
+    "post_chat": 64 * 1024,
+    "update_config": 16 * 1024
+}
+
+# A character takes up to 4 bytes in UTF-8, clients that send more than that are disconnected without reading it
+MAX_MESSAGE_SIZE = 4 * max(PACKET_SIZE_LIMITS.values())
+
+# Seconds a client may stay quiet before it is pinged, and may leave the ping unanswered before it is
+# disconnected. Phones and closed Scratch tabs often drop off without closing their connection
+PING_INTERVAL = 30
+PING_TIMEOUT = 20
+
 class Main:
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, worker=None, cluster_address=None, ratelimit_path=None):
         # Initalize libraries
         self.cl = CloudLink(debug=debug) # CloudLink Server
+        if not cluster_address == None:
+            # One of several processes serving Meower, see run_worker
+            self.cl.joinCluster(SocketBus(cluster_address, debug=debug))
+        ratelimiter = None
+        if not ratelimit_path == None:
+            # Rate limits shared with the other processes on this machine
+            ratelimiter = SharedRateLimiter(ratelimit_path)
         self.supporter = Supporter( # Support functionality
             cl = self.cl,
-            packet_callback = self.handle_packet
+            packet_callback = self.handle_packet,
+            ratelimiter = ratelimiter
         )
         self.filesystem = Files( # Filesystem/Database I/O
             logger = self.supporter.log,
@@ -52,6 +81,54 @@ class Main:
             files = self.filesystem
         )
         
+        # Register Meower's commands with CloudLink
+        for command in [
+            "ping",
+            "version_chk", 
+            "get_ulist", 
+            "authpswd", 
+            "gen_account", 
+            "get_profile", 
+            "update_config",
+            "change_pswd", 
+            "del_tokens",
+            "del_account",
+            "get_home", 
+            "get_inbox", 
+            "post_home",
+            "get_post", 
+            "get_peak_users", 
+            "search_user_posts",
+            "report",
+            "close_report",
+            "clear_home",
+            "clear_user_posts",
+            "alert",
+            "announce",
+            "block",
+            "unblock",
+            "kick",
+            "get_user_ip",
+            "get_ip_data",
+            "get_user_data",
+            "ban",
+            "pardon",
+            "terminate",
+            "repair_mode",
+            "delete_post",
+            "post_chat",
+            "set_chat_state",
+            "create_chat",
+            "leave_chat",
+            "get_chat_list",
+            "get_chat_data",
+            "get_chat_posts",
+            "add_to_chat",
+            "remove_from_chat"
+        ]:
+            self.supporter.registerCommand(command, getattr(self.meower, command), PACKET_SIZE_LIMITS.get(command))
+        self.cl.setPacketSizeLimit(PACKET_SIZE_LIMITS[None])
+        
         # Load trust keys
         result, payload = self.filesystem.load_item("config", "trust_keys")
         if result:
@@ -66,71 +143,42 @@ class Main:
         # Set server MOTD
         self.cl.setMOTD("Meower Social Media Platform Server", True)
         
-        # Run REST API
-        Thread(target=rest_api_app.run, kwargs={"host": "0.0.0.0", "port": 3001, "debug": False, "use_reloader": False}).start()
+        # Run REST API, in the first process only when there are several
+        if not worker:
+            Thread(target=rest_api_app.run, kwargs={"host": "0.0.0.0", "port": 3001, "debug": False, "use_reloader": False}).start()
 
-        # Run CloudLink server
-        self.cl.server(port=3000, ip="0.0.0.0")
+        # Run CloudLink server, feeds and user lists are repetitive JSON so compress them for clients that support it
+        self.cl.server(port=3000, ip="0.0.0.0", compression=True, max_message_size=MAX_MESSAGE_SIZE, max_frame_size=MAX_MESSAGE_SIZE, ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT, reuse_port=(not cluster_address == None))
     
     def returnCode(self, client, code, listener_detected, listener_id):
-        self.supporter.sendPacket({"cmd": "statuscode", "val": self.cl.codes[str(code)], "id": client}, listener_detected = listener_detected, listener_id = listener_id)
+        self.cl.sendCode(client, str(code), listener_detected = listener_detected, listener_id = listener_id)
     
     def handle_packet(self, cmd, ip, val, listener_detected, listener_id, client, clienttype):
-        try:
-            commands = set([
-                "ping",
-                "version_chk", 
-                "get_ulist", 
-                "authpswd", 
-                "gen_account", 
-                "get_profile", 
-                "update_config",
-                "change_pswd", 
-                "del_tokens",
-                "del_account",
-                "get_home", 
-                "get_inbox", 
-                "post_home",
-                "get_post", 
-                "get_peak_users", 
-                "search_user_posts",
-                "report",
-                "close_report",
-                "clear_home",
-                "clear_user_posts",
-                "alert",
-                "announce",
-                "block",
-                "unblock",
-                "kick",
-                "get_user_ip",
-                "get_ip_data",
-                "get_user_data",
-                "ban",
-                "pardon",
-                "terminate",
-                "repair_mode",
-                "delete_post",
-                "post_chat",
-                "set_chat_state",
-                "create_chat",
-                "leave_chat",
-                "get_chat_list",
-                "get_chat_data",
-                "get_chat_posts",
-                "add_to_chat",
-                "remove_from_chat"
-            ])
-            if cmd in commands:
-                getattr(self.meower, cmd)(client, val, listener_detected, listener_id)
-            else:
-                # Catch-all error code
-                self.returnCode(code = "Invalid", client = client, listener_detected = listener_detected, listener_id = listener_id)
-        except Exception:
-            self.supporter.log("{0}".format(self.supporter.full_stack()))
+        # Meower commands are registered with CloudLink, anything that reaches here is unknown
+        self.returnCode(code = "Invalid", client = client, listener_detected = listener_detected, listener_id = listener_id)
 
-            # Catch-all error code
-            self.returnCode(code = "InternalServerError", client = client, listener_detected = listener_detected, listener_id = listener_id)
+def run_worker(worker, cluster_address, ratelimit_path=None):
+    Main(debug=True, worker=worker, cluster_address=cluster_address, ratelimit_path=ratelimit_path)
 
 if __name__ == "__main__":
-    Main(debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Meower server")
+    parser.add_argument("--workers", type=int, default=1, help="processes to serve port 3000 with, they share broadcasts and the user list")
+    parser.add_argument("--cluster", help="HOST:PORT (or Unix socket path) of the broker of a cluster of several machines, see cluster.py")
+    parser.add_argument("--shared-ratelimit", action="store_true", help="have the processes on this machine share their rate limits through shared memory, instead of each keeping its own")
+    args = parser.parse_args()
+    cluster_address = None
+    if not args.cluster == None:
+        cluster_address = parse_address(args.cluster)
+    if (args.workers > 1) or (not cluster_address == None):
+        ratelimit_path = None
+        if args.shared_ratelimit:
+            # One table for every worker, made before they start and removed once they have all exited
+            table = SharedRateLimiter()
+            ratelimit_path = table.path
+        try:
+            run_workers(args.workers, partial(run_worker, ratelimit_path=ratelimit_path), cluster_address)
+        finally:
+            if not ratelimit_path == None:
+                table.remove()
+    else:
+        Main(debug=True)
\ No newline at end of file
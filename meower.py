@@ -17,9 +17,11 @@ class Meower:
         self.accounts = accounts
         self.filesystem = files
         self.sendPacket = self.supporter.sendPacket
-        result, self.supporter.filter = self.filesystem.load_item("config", "filter")
+        result, filter_doc = self.filesystem.load_item("config", "filter")
         if not result:
             self.log("Failed to load profanity filter, default will be used as fallback!")
+            filter_doc = None
+        self.supporter.load_filter(filter_doc)
         result, self.supporter.status = self.filesystem.load_item("config", "status")
         if not result:
             self.log("Failed to load status, server will enable repair mode!")
@@ -109,7 +111,7 @@ class Meower:
                 if user == "Server":
                     self.filesystem.db["usersv0"].update_many({"unread_inbox": False}, {"$set": {"unread_inbox": True}})
                     self.cl.sendPacket({"cmd": "direct", "val": payload})
-                elif user in self.cl.getUsernames():
+                elif self.cl.isUsernameInCluster(user):
                     self.filesystem.db["usersv0"].update_many({"_id": user, "unread_inbox": False}, {"$set": {"unread_inbox": True}})
                     self.cl.sendPacket({"cmd": "direct", "val": payload, "id": user})
                 return True
@@ -131,9 +133,7 @@ class Meower:
                     payload = post_data
                     payload["state"] = 2
 
-                    for member in chat_data["members"]:
-                        if member in self.cl.getUsernames():
-                            self.cl.sendPacket({"cmd": "direct", "val": payload, "id": member})
+                    self.cl.sendPacketToRoom({"cmd": "direct", "val": payload}, post_origin, chat_data["members"])
                     return True
                 else:
                     return False
@@ -155,7 +155,7 @@ class Meower:
                 self.filesystem.delete_item("reports", _id)
 
     def returnCode(self, client, code, listener_detected, listener_id):
-        self.sendPacket({"cmd": "statuscode", "val": self.cl.codes[str(code)], "id": client}, listener_detected = listener_detected, listener_id = listener_id)
+        self.cl.sendCode(client, str(code), listener_detected = listener_detected, listener_id = listener_id)
     
     # Networking/client utilities
     
@@ -841,8 +841,9 @@ class Meower:
                                 # Kick all clients
                                 FileRead, netlog = self.filesystem.load_item("netlog", val)
                                 if FileRead:
-                                    for user in netlog["users"]:
-                                        if user in self.cl.getUsernames() and (self.cl.statedata["ulist"]["objs"][self.cl.statedata["ulist"]["usernames"][user]]["ip"] == val):
+                                    for obj in self.cl.getClientsOfIP(val):
+                                        user = self.cl._get_username_of_obj(obj)
+                                        if user in netlog["users"]:
                                             try:
                                                 self.supporter.kickUser(user, "Blocked")
                                             except:
@@ -920,7 +921,7 @@ class Meower:
             if FileCheck and FileRead:
                 if accountData["lvl"] >= 1:
                     if type(val) == str:
-                        if val in self.cl.getUsernames():
+                        if self.cl.isUsernameInCluster(val):
                             # Revoke sessions
                             FileCheck, FileRead, FileWrite = self.accounts.update_setting(val, {"tokens": []}, forceUpdate=True)
                             if FileCheck and FileRead and FileWrite:
@@ -1351,8 +1352,10 @@ class Meower:
             if type(val) == str:
                 if not len(val) > 20:
                     val = self.supporter.wordfilter(val)
-                    result = self.filesystem.create_item("chats", str(uuid.uuid4()), {"nickname": val, "owner": client, "members": [client], "last_active": int(time.time())})
+                    chatid = str(uuid.uuid4())
+                    result = self.filesystem.create_item("chats", chatid, {"nickname": val, "owner": client, "members": [client], "last_active": int(time.time())})
                     if result:
+                        self.cl.setRoom(chatid, [client])
                         self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
                     else:
                         # Some other error, raise an internal error.
@@ -1378,9 +1381,8 @@ class Meower:
                             if client in payload["members"]:
                                 if payload["owner"] == client:
                                     result = self.filesystem.delete_item("chats", val)
-                                    for member in payload["members"]:
-                                        if member in self.cl.getUsernames():
-                                            self.sendPacket({"cmd": "direct", "val": {"mode": "delete", "id": payload["_id"]}, "id": member})
+                                    self.cl.sendPacketToRoom({"cmd": "direct", "val": {"mode": "delete", "id": payload["_id"]}}, val, payload["members"])
+                                    self.cl.deleteRoom(val)
                                     if result:
                                         self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
                                     else:
@@ -1389,6 +1391,7 @@ class Meower:
                                     payload["members"].remove(client)
                                     result = self.filesystem.write_item("chats", val, payload)
                                     if result:
+                                        self.cl.setRoom(val, payload["members"])
                                         self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
                                     else:
                                         self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
@@ -1545,8 +1548,7 @@ class Meower:
         if chatid == "livechat":
             self.sendPacket({"cmd": "direct", "val": post_w_metadata})
         else:
-            for member in chatdata["members"]:
-                self.sendPacket({"cmd": "direct", "val": post_w_metadata, "id": member})
+            self.cl.sendPacketToRoom({"cmd": "direct", "val": post_w_metadata}, chatid, chatdata["members"])
         
         # Tell client message was sent
         self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
@@ -1620,6 +1622,8 @@ class Meower:
                                             FileWrite = self.filesystem.write_item("chats", chatid, chatdata)
 
                                             if FileWrite:
+                                                self.cl.setRoom(chatid, chatdata["members"])
+
                                                 # Inbox message to say the user was added to the group chat
                                                 self.createPost("inbox", username, "You have been added to the group chat '{0}' by @{1}!".format(chatdata["nickname"], client))
 
@@ -1674,6 +1678,8 @@ class Meower:
                                     result = self.filesystem.write_item("chats", chatid, chatdata)
 
                                     if result:
+                                        self.cl.setRoom(chatid, chatdata["members"])
+
                                         # Inbox message to say the user was removed from the group chat
                                         self.createPost("inbox", username, "You have been removed from the group chat '{0}' by @{1}!".format(chatdata["nickname"], client))
 
@@ -1809,12 +1815,12 @@ class Meower:
                                         for chat in chat_index:
                                             if chat["owner"] == client:
                                                 self.filesystem.delete_item("chats", chat["_id"])
-                                                for member in chat["members"]:
-                                                    if member in self.cl.getUsernames():
-                                                        self.sendPacket({"cmd": "direct", "val": {"mode": "delete", "id": chat["_id"]}, "id": member})
+                                                self.cl.sendPacketToRoom({"cmd": "direct", "val": {"mode": "delete", "id": chat["_id"]}}, chat["_id"], chat["members"])
+                                                self.cl.deleteRoom(chat["_id"])
                                             else:
                                                 chat["members"].remove(client)
-                                                self.filesystem.write_item("chats", chat["_id"], chat)
+                                                if self.filesystem.write_item("chats", chat["_id"], chat):
+                                                    self.cl.setRoom(chat["_id"], chat["members"])
                                         netlog_index = self.getIndex(location="netlog", query={"users": {"$all": [client]}}, truncate=False)["index"]
                                         for ip in netlog_index:
                                             ip["users"].remove(client)
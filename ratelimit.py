@@ -0,0 +1,187 @@
+import os
+import mmap
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Not on Windows, SharedRateLimiter needs it
+
+"""
+
+Meower rate limiter
+
+A token bucket per type and key (a username or an IP address): a key gets
+burst tokens, one more every seconds / burst seconds, and each allowed
+action takes one. Each bucket is kept as one number, the time it is full
+again (the "generic cell rate algorithm"), so a check is one clock read
+and a dictionary lookup, and a key whose bucket is full again is the same
+as a key never seen and can be forgotten. A sweeper thread does that in
+the background, so memory follows the keys that were busy recently
+instead of every key ever seen.
+
+RateLimiter is per process. SharedRateLimiter keeps the same buckets in a
+table in shared memory instead, so the worker processes of one machine
+(main.py --workers N --shared-ratelimit) share their limits rather than
+each allowing the full burst. Keys are placed in the table by a hash keyed
+with a random salt from the table's header, so nobody can pick keys that
+land in the group of someone else's bucket. A key whose group has no
+free slot is limited rather than taking the slot of a bucket in use, so
+filling a group never resets a bucket.
+
+"""
+
+SWEEP_CHUNK = 10000 # Keys looked at per hold of the lock while sweeping
+
+# SharedRateLimiter's table: a header, then groups of slots, a key lives in the group its hash picks
+HEADER = struct.Struct("<8s16s") # MAGIC, salt of the hash of type and key
+MAGIC = b"MEOWRL1\0"
+SLOT = struct.Struct("<Qd") # Hash of type and key (0 for an empty slot), time.monotonic() at which its bucket is full again
+SLOTS_PER_GROUP = 16
+GROUP = struct.Struct("<" + "Qd" * SLOTS_PER_GROUP)
+LOCK_STRIPES = 64 # Thread locks per SharedRateLimiter, each guards every LOCK_STRIPES-th group
+
+class RateLimiter:
+    def __init__(self, sweep_interval=60):
+        self.lock = threading.Lock()
+        self.buckets = {} # Type -> {key: time.monotonic() at which its bucket is full again}, guarded by lock
+        self.sweep_interval = sweep_interval # Seconds between sweeps
+        self.swept = 0 # Keys forgotten so far
+        self.sweeper = None
+
+    def check(self, type, key, burst=1, seconds=1): # Takes a token from the bucket of key, returns True when there was none left (rate limited)
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.buckets.get(type)
+            if buckets == None:
+                buckets = self.buckets[type] = {}
+                if self.sweeper == None:
+                    self._start_sweeper()
+            full_at = buckets.get(key, now)
+            if full_at < now:
+                full_at = now
+            full_at += seconds / burst
+            # No token left when taking one would put the bucket more than seconds from full, give or take rounding
+            if full_at - now > seconds + 1e-6:
+                return True
+            buckets[key] = full_at
+            return False
+
+    def sweep(self, now=None): # Forgets the keys whose buckets are full again, returns how many
+        if now == None:
+            now = time.monotonic()
+        swept = 0
+        with self.lock:
+            types = list(self.buckets.items())
+        for type, buckets in types:
+            with self.lock:
+                keys = list(buckets)
+            for start in range(0, len(keys), SWEEP_CHUNK):
+                with self.lock:
+                    for key in keys[start:start + SWEEP_CHUNK]:
+                        if buckets.get(key, now) <= now:
+                            buckets.pop(key, None)
+                            swept += 1
+        with self.lock:
+            self.swept += swept
+        return swept
+
+    def get_stats(self): # Keys tracked per type, and keys forgotten so far
+        with self.lock:
+            return {
+                "keys": dict((type, len(buckets)) for type, buckets in self.buckets.items()),
+                "swept": self.swept
+            }
+
+    def _start_sweeper(self): # Caller holds lock
+        self.sweeper = threading.Thread(target=self._sweep_loop, daemon=True)
+        self.sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.sweep()
+
+class SharedRateLimiter: # RateLimiter on a table in shared memory, for the processes of one machine (Unix only)
+    def __init__(self, path=None, groups=16384): # Opens the table at path, or makes a new one of groups * 16 keys, see path
+        if path == None:
+            # On tmpfs where there is one, the table never needs to be written out
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            fd, path = tempfile.mkstemp(prefix="meower-ratelimit-", dir=directory)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.path = path # For the other processes to open the same table with
+        self.fd = fd
+        # The first process to open the table sets it up, the header's lock keeps the others waiting until it has
+        fcntl.lockf(fd, fcntl.LOCK_EX, HEADER.size, 0)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                size = HEADER.size + groups * GROUP.size
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, os.urandom(16)), 0)
+            magic, self.salt = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, HEADER.size, 0)
+        if not magic == MAGIC:
+            os.close(fd)
+            raise ValueError("{0} is not a rate limit table".format(path))
+        self.groups = (size - HEADER.size) // GROUP.size
+        self.memory = mmap.mmap(fd, size)
+        # fcntl locks belong to a process and keep other processes out, these keep this process' threads apart
+        self.locks = [threading.Lock() for i in range(LOCK_STRIPES)]
+        self.full_groups = 0 # Checks limited because their key's group had no free slot, in this process
+
+    def check(self, type, key, burst=1, seconds=1): # Same as RateLimiter.check
+        now = time.monotonic() # The same clock in every process
+        hash = int.from_bytes(hashlib.blake2b("{0}\0{1}".format(type, key).encode(), digest_size=8, key=self.salt).digest(), "little") or 1
+        group = hash % self.groups
+        offset = HEADER.size + group * GROUP.size
+        with self.locks[group % LOCK_STRIPES]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, GROUP.size, offset)
+            try:
+                values = GROUP.unpack_from(self.memory, offset)
+                slot = None
+                free = None
+                for i in range(SLOTS_PER_GROUP):
+                    if values[2 * i] == hash:
+                        slot = i
+                        break
+                    if (free == None) and (values[2 * i + 1] <= now):
+                        free = i # Empty, or a bucket that is full again
+                if slot == None:
+                    if free == None:
+                        # Every bucket of the group is in use, taking one would reset it, so the new key waits instead
+                        self.full_groups += 1
+                        return True
+                    slot = free
+                    full_at = now
+                else:
+                    full_at = max(values[2 * slot + 1], now)
+                full_at += seconds / burst
+                if full_at - now > seconds + 1e-6:
+                    return True
+                SLOT.pack_into(self.memory, offset + slot * SLOT.size, hash, full_at)
+                return False
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, GROUP.size, offset)
+
+    def get_stats(self): # Keys tracked and room in the table, counted without locking, and checks of this process limited by a full group
+        now = time.monotonic()
+        keys = 0
+        for offset in range(HEADER.size, HEADER.size + self.groups * GROUP.size, SLOT.size):
+            hash, full_at = SLOT.unpack_from(self.memory, offset)
+            if (not hash == 0) and (full_at > now):
+                keys += 1
+        return {"keys": keys, "slots": self.groups * SLOTS_PER_GROUP, "full_groups": self.full_groups}
+
+    def close(self):
+        self.memory.close()
+        os.close(self.fd)
+
+    def remove(self): # Closes the table and deletes it, once no process uses it anymore
+        self.close()
+        os.unlink(self.path)
@@ -1,10 +1,12 @@
 from datetime import datetime
-from better_profanity import profanity
+from filter import WordFilter
+from ratelimit import RateLimiter
 import time
 import traceback
 import sys
 import string
-from threading import Thread
+from threading import Thread, Lock
+from collections import OrderedDict
 
 """
 
@@ -16,16 +18,22 @@ This keeps the main.py clean and more understandable.
 """
 
 class Supporter:
-    def __init__(self, cl=None, packet_callback=None):
-        self.filter = None
-        self.last_packet = dict()
-        self.burst_amount = dict()
-        self.ratelimits = dict()
+    def __init__(self, cl=None, packet_callback=None, ratelimiter=None):
+        self.filter = None # The config/filter document the profanity filter was built from, see load_filter
+        self.filter_engine = WordFilter() # Default word list until load_filter
+        self.filter_cache = OrderedDict() # Message -> censored message, least recently used first, emptied by load_filter
+        self.filter_cache_size = 2048 # Most results kept
+        self.filter_cache_max_length = 2000 # Longer messages aren't cached
+        self.filter_cache_hits = 0
+        self.filter_cache_misses = 0
+        self.filter_cache_lock = Lock() # Guards the filter engine and the cache
+        self.ratelimiter = ratelimiter # See check_for_spam, a SharedRateLimiter when the processes of a cluster share their limits
+        if self.ratelimiter == None:
+            self.ratelimiter = RateLimiter()
         self.good_ips = set()
         self.known_vpns = set()
         self.status = {"repair_mode": True, "is_deprecated": False}
         self.cl = cl
-        self.profanity = profanity
         self.packet_handler = packet_callback
         self.listener_detected = False
         self.listener_id = None
@@ -47,19 +55,9 @@ class Supporter:
             self.cl.codes["ChatNotFound"] = "E:022 | Chat not found"
             self.cl.codes["ChatFull"] = "E:023 | Chat full"
         
-        # Create permitted lists of characters
-        self.permitted_chars_username = []
-        self.permitted_chars_post = []
-        for char in string.ascii_letters:
-            self.permitted_chars_username.append(char)
-            self.permitted_chars_post.append(char)
-        for char in string.digits:
-            self.permitted_chars_username.append(char)
-            self.permitted_chars_post.append(char)
-        for char in string.punctuation:
-            self.permitted_chars_post.append(char)
-        self.permitted_chars_username.extend(["_", "-"])
-        self.permitted_chars_post.append(" ")
+        # Create permitted sets of characters
+        self.permitted_chars_username = frozenset(string.ascii_letters + string.digits + "_-")
+        self.permitted_chars_post = frozenset(string.ascii_letters + string.digits + string.punctuation + " ")
         
         # Peak number of users logger
         self.peak_users_logger = {
@@ -80,6 +78,11 @@ class Supporter:
             self.cl.callback("on_packet", self.on_packet)
             self.cl.callback("on_close", self.on_close)
             self.cl.callback("on_connect", self.on_connect)
+            
+            # Kicks and peaks from the other processes of a cluster
+            if not self.cl.cluster == None:
+                self.cl.cluster.subscribe("kick", self.on_cluster_kick)
+                self.cl.cluster.subscribe("peak", self.on_cluster_peak)
         
         self.log("Supporter initialized!")
     
@@ -160,6 +163,8 @@ class Supporter:
                     "timestamp": self.timestamp(1)
                 }
                 self.log("New peak in # of concurrent users: {0}".format(current_users))
+                if not self.cl.cluster == None:
+                    self.cl.cluster.publish("peak", self.peak_users_logger)
                 #self.create_system_message("Yay! New peak in # of concurrent users: {0}".format(current_users))
                 payload = {
                     "mode": "peak",
@@ -167,6 +172,11 @@ class Supporter:
                 }
                 self.sendPacket({"cmd": "direct", "val": payload})
     
+    def on_cluster_peak(self, peak_users_logger):
+        # Peak counted by another process of the cluster, it has sent the packet already
+        if peak_users_logger["count"] > self.peak_users_logger["count"]:
+            self.peak_users_logger = peak_users_logger
+    
     def on_close(self, client):
         if not self.cl == None:
             if type(client) == dict:
@@ -217,6 +227,22 @@ class Supporter:
             if not self.packet_handler == None:
                 self.packet_handler(cmd, ip, val, self.listener_detected, self.listener_id, client, clienttype)
     
+    def registerCommand(self, cmd, function, max_size=None): # Lets CloudLink call function(client, val, listener_detected, listener_id) directly for cmd, packets longer than max_size are refused before function runs
+        if not self.cl == None:
+            def run(message):
+                listener_detected = ("listener" in message)
+                listener_id = None
+                if listener_detected:
+                    listener_id = message["listener"]
+                try:
+                    function(message["id"], message["val"], listener_detected, listener_id)
+                except Exception:
+                    self.log("{0}".format(self.full_stack()))
+
+                    # Catch-all error code
+                    self.cl.sendCode(message["id"], "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+            self.cl.registerCommand(cmd, run, max_size)
+
     def timestamp(self, ttype):
         today = datetime.now()
         if ttype == 1:
@@ -242,18 +268,52 @@ class Supporter:
         # Rate limiter
         self.modify_client_statedata(client, "last_packet", int(time.time()))
     
-    def wordfilter(self, message):
-        # Word censor
-        if self.filter != None:
-            self.profanity.load_censor_words(whitelist_words=self.filter["whitelist"])
-            message = self.profanity.censor(message)
-            self.profanity.load_censor_words(whitelist_words=self.filter["whitelist"], custom_words=self.filter["blacklist"])
-            message = self.profanity.censor(message)
+    def load_filter(self, filter_doc):
+        # Build the profanity filter from the config/filter document, None for the default word list
+        if filter_doc == self.filter:
+            return
+        if filter_doc != None:
+            engine = WordFilter(blacklist=filter_doc["blacklist"], whitelist=filter_doc["whitelist"])
         else:
-            self.log("Failed loading profanity filter : Using default filter as fallback")
-            self.profanity.load_censor_words()
-            message = self.profanity.censor(message)
-        return message
+            engine = WordFilter()
+        with self.filter_cache_lock:
+            # The filter is loaded once at startup, a new one makes every cached result stale
+            self.filter_engine = engine
+            self.filter_cache.clear()
+            self.filter = filter_doc
+    
+    def wordfilter(self, message):
+        # Word censor, see filter.py. Usernames and repeated messages come back often, so results are kept in an LRU cache
+        if len(message) > self.filter_cache_max_length:
+            return self.filter_engine.censor(message)
+        with self.filter_cache_lock:
+            engine = self.filter_engine
+            result = self.filter_cache.get(message)
+            if result != None:
+                self.filter_cache.move_to_end(message)
+                self.filter_cache_hits += 1
+                return result
+            self.filter_cache_misses += 1
+        result = engine.censor(message)
+        with self.filter_cache_lock:
+            # Unless load_filter replaced the filter in the meantime
+            if engine is self.filter_engine:
+                self.filter_cache[message] = result
+                if len(self.filter_cache) > self.filter_cache_size:
+                    self.filter_cache.popitem(last=False)
+        return result
+    
+    def get_wordfilter_stats(self):
+        # Hit rate of the wordfilter cache, to size filter_cache_size with
+        with self.filter_cache_lock:
+            lookups = self.filter_cache_hits + self.filter_cache_misses
+            return {
+                "hits": self.filter_cache_hits,
+                "misses": self.filter_cache_misses,
+                "hit_rate": (self.filter_cache_hits / lookups) if lookups else 0.0,
+                "entries": len(self.filter_cache),
+                "size": self.filter_cache_size
+            }
     
     def isAuthenticated(self, client):
         if not self.cl == None:
@@ -265,34 +325,30 @@ class Supporter:
     
     def checkForBadCharsUsername(self, value):
         # Check for profanity in username, will return '*' if there's profanity which will be blocked as an illegal character
-        value = self.wordfilter(value)
-
-        badchars = False
-        for char in value:
-            if not char in self.permitted_chars_username:
-                badchars = True
-                break
-        return badchars
+        return self.checkForBadCharsAndFilter(value, self.permitted_chars_username)[0]
         
     def checkForBadCharsPost(self, value):
-        badchars = False
-        for char in value:
-            if not char in self.permitted_chars_post:
-                badchars = True
-                break
-        return badchars
+        return not self.permitted_chars_post.issuperset(value)
+    
+    def checkForBadCharsAndFilter(self, value, permitted_chars):
+        # Checks value for characters outside permitted_chars and censors it in one step, returns (bad characters found, censored value). A value with bad characters comes back as it is
+        if not permitted_chars.issuperset(value):
+            # Rejected anyway, no need to filter it
+            return True, value
+        filtered = self.wordfilter(value)
+        if filtered == value:
+            return False, value
+        return (not permitted_chars.issuperset(filtered)), filtered
     
     def autoID(self, client, username):
         if not self.cl == None:
             # really janky code that automatically sets user ID
-            self.modify_client_statedata(client, "username", username)
-            self.cl.statedata["ulist"]["usernames"][username] = client["id"]
-            self.sendPacket({"cmd": "ulist", "val": self.cl._get_ulist()})
+            self.cl.setUsername(client, username)
             self.log("{0} autoID given".format(username))
     
     def kickUser(self, username, status="Kicked"):
         if not self.cl == None:
-            if username in self.cl.getUsernames():
+            if self.cl.isUsernameOnline(username):
                 self.log("Kicking {0}".format(username))
 
                 # Tell client it's going to get kicked
@@ -301,41 +357,21 @@ class Supporter:
                 # Unauthenticate client
                 client = self.cl.statedata["ulist"]["objs"][self.cl.statedata["ulist"]["usernames"][username]]["object"]
                 self.cl._closed_connection_server(client, None)
-                self.sendPacket({"cmd": "ulist", "val": self.cl._get_ulist()})
                 
                 # Thread final closing
                 def run(client):
                     time.sleep(1)
                     client["handler"].send_close(1000, bytes('', encoding='utf-8'))
                 Thread(target=run, args=(client,)).start()
+            elif self.cl.isUsernameInCluster(username):
+                # Online on another process of the cluster, which kicks it
+                self.log("Kicking {0} on another process".format(username))
+                self.cl.cluster.publish("kick", {"username": username, "status": status}, self.cl.remote_usernames.get(username))
+    
+    def on_cluster_kick(self, val):
+        if self.cl.isUsernameOnline(val["username"]):
+            self.kickUser(val["username"], val["status"])
     
     def check_for_spam(self, type, client, burst=1, seconds=1):
-        # Check if type and client are in ratelimit dictionary
-        if not (type in self.last_packet):
-            self.last_packet[type] = {}
-            self.burst_amount[type] = {}
-            self.ratelimits[type] = {}
-        if client not in self.last_packet[type]:
-            self.last_packet[type][client] = 0
-            self.burst_amount[type][client] = 0
-            self.ratelimits[type][client] = 0
-
-        # Check if user is currently ratelimited
-        if self.ratelimits[type][client] > time.time():
-            return True
-
-        # Check if max burst has expired
-        if (self.last_packet[type][client] + seconds) < time.time():
-            self.burst_amount[type][client] = 0
-
-        # Set last packet time and add to burst amount
-        self.last_packet[type][client] = time.time()
-        self.burst_amount[type][client] += 1
-
-        # Check if burst amount is over max burst
-        if self.burst_amount[type][client] > burst:
-            self.ratelimits[type][client] = (time.time() + seconds)
-            self.burst_amount[type][client] = 0
-            return True
-        else:
-            return False
\ No newline at end of file
+        # Allows burst actions of a type per client (a username or an IP) and then one every seconds / burst seconds, returns True when rate limited
+        return self.ratelimiter.check(type, client, burst, seconds)
\ No newline at end of file
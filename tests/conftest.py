@@ -0,0 +1,131 @@
+import json
+
+import pytest
+
+# Add path to source code
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from cloudlink import CloudLink, msgpack
+
+
+class Handler():
+    def __init__(self, ip):
+        self.ip = ip
+        self.client_address = (ip, 0)
+        self.closes = []  # status of every CLOSE sent
+
+    def send_close(self, status=1000, reason=b''):
+        self.closes.append(status)
+
+
+class RecordingServer():
+    """
+    Stands in for the websocket server, records what CloudLink sends to
+    each client instead of writing it to a socket
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self.id_counter = 0
+        self.sent = {}  # client id -> list of str (text frames) and bytes (binary frames)
+
+    @property
+    def clients(self):
+        return list(self._clients.values())
+
+    def connect(self, cl, ip='127.0.0.1'):
+        self.id_counter += 1
+        handler = Handler(ip)
+        client = {'id': self.id_counter, 'handler': handler, 'address': handler.client_address}
+        self._clients[handler] = client
+        self.sent[client['id']] = []
+        cl._on_connection_server(client, self)
+        return client
+
+    def disconnect(self, cl, client):
+        cl._closed_connection_server(client, self)
+        del self._clients[client['handler']]
+
+    def send_message(self, client, msg):
+        self.sent[client['id']].append(msg)
+
+    def send_binary(self, client, data):
+        self.sent[client['id']].append(data)
+
+    def send_message_to_many(self, clients, msg):
+        for client in clients:
+            self.send_message(client, msg)
+
+    def send_binary_to_many(self, clients, data):
+        for client in clients:
+            self.send_binary(client, data)
+
+    def received(self, client):
+        """
+        Everything sent to a client since the last call, decoded
+        """
+        messages = self.sent[client['id']]
+        self.sent[client['id']] = []
+        return [json.loads(message) if isinstance(message, str) else msgpack.unpackb(message) for message in messages]
+
+
+class Link():
+    """
+    A server-side CloudLink on a RecordingServer, packets run right away
+    instead of on the worker pool
+    """
+
+    def __init__(self):
+        self.cl = CloudLink()
+        self.cl.state = 1
+        self.cl.wss = RecordingServer()
+        self.cl.statedata = {
+            "ulist": {"usernames": {}, "objs": {}},
+            "secure_enable": False,
+            "secure_keys": [],
+            "gmsg": "",
+            "motd_enable": False,
+            "motd": "",
+            "trusted": set(),
+            "ip_blocklist": set([""]),
+        }
+        self.cl.ulist_window = 0
+        self.cl.packet_workers.submit = lambda client_id, function: function() or True
+
+    def connect(self, ip='127.0.0.1'):
+        client = self.cl.wss.connect(self.cl, ip)
+        self.received(client)  # Drop the greeting
+        return client
+
+    def disconnect(self, client):
+        self.cl.wss.disconnect(self.cl, client)
+
+    def send(self, client, packet):
+        if isinstance(packet, (str, bytes)):
+            message = packet
+        else:
+            message = json.dumps(packet)
+        if isinstance(message, bytes):
+            self.cl._on_binary_packet_server(client, self.cl.wss, message)
+        else:
+            self.cl._on_packet_server(client, self.cl.wss, message)
+
+    def received(self, client):
+        return self.cl.wss.received(client)
+
+    def set_username(self, client, username):
+        self.cl.setUsername(client, username)
+        self.received(client)
+
+
+@pytest.fixture
+def link():
+    return Link()
+
+
+@pytest.fixture
+def make_link():
+    """
+    For tests that need more than one link
+    """
+    return Link
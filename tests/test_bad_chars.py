@@ -0,0 +1,46 @@
+import string
+
+import pytest
+
+from supporter import Supporter
+
+
+@pytest.fixture(scope="module")
+def supporter():
+    return Supporter()
+
+
+def old_check_username(supporter, value):
+    # checkForBadCharsUsername before it used sets
+    value = supporter.wordfilter(value)
+    permitted = list(string.ascii_letters) + list(string.digits) + ["_", "-"]
+    return any(not char in permitted for char in value)
+
+
+@pytest.mark.parametrize("value", ["", "meower", "Meower_Bot-2", "shit", "sh1t", "shitposter", "blow-job", "has space", "dot.", "ümlaut", "日本", "*"])
+def test_username_check_unchanged(supporter, value):
+    assert supporter.checkForBadCharsUsername(value) == old_check_username(supporter, value)
+
+
+@pytest.mark.parametrize("value, bad", [
+    ("Hello, world! (it's 5 o'clock)", False),
+    ("~`{}|\\", False),
+    ("tab\there", True),
+    ("new\nline", True),
+    ("emoji 🐱", True),
+    ("", False),
+])
+def test_post_check(supporter, value, bad):
+    assert supporter.checkForBadCharsPost(value) == bad
+
+
+def test_check_and_filter(supporter):
+    assert supporter.checkForBadCharsAndFilter("what the shit", supporter.permitted_chars_post) == (False, "what the ****")
+    assert supporter.checkForBadCharsAndFilter("shit", supporter.permitted_chars_username) == (True, "****")
+    assert supporter.checkForBadCharsAndFilter("fine", supporter.permitted_chars_username) == (False, "fine")
+
+
+def test_bad_characters_skip_the_filter(supporter):
+    misses = supporter.get_wordfilter_stats()["misses"]
+    assert supporter.checkForBadCharsAndFilter("bad\tshit", supporter.permitted_chars_post) == (True, "bad\tshit")
+    assert supporter.get_wordfilter_stats()["misses"] == misses
@@ -0,0 +1,30 @@
+def test_clients_of_ip(link):
+    first = link.connect("10.0.0.1")
+    second = link.connect("10.0.0.1")
+    other = link.connect("10.0.0.2")
+    assert sorted(client["id"] for client in link.cl.getClientsOfIP("10.0.0.1")) == [first["id"], second["id"]]
+    assert link.cl.getClientsOfIP("10.0.0.2") == [other]
+    assert link.cl.getClientsOfIP("10.0.0.3") == []
+
+
+def test_clients_of_ip_after_close(link):
+    first = link.connect("10.0.0.1")
+    second = link.connect("10.0.0.1")
+    link.disconnect(first)
+    assert link.cl.getClientsOfIP("10.0.0.1") == [second]
+    link.disconnect(second)
+    assert link.cl.getClientsOfIP("10.0.0.1") == []
+    assert link.cl.ip_index == {}
+
+
+def test_username_online(link):
+    client = link.connect()
+    assert not link.cl.isUsernameOnline("alice")
+    link.cl.setUsername(client, "alice")
+    assert link.cl.isUsernameOnline("alice")
+    assert link.cl._get_obj_of_username("alice") == client
+    assert link.cl.getIPofUsername("alice") == "127.0.0.1"
+    link.disconnect(client)
+    assert not link.cl.isUsernameOnline("alice")
+    assert link.cl._get_obj_of_username("alice") is None
+
@@ -0,0 +1,24 @@
+import pytest
+
+from cloudlink import CloudLink
+
+
+@pytest.mark.parametrize("backend", ["threaded", "asyncio"])
+def test_server_options_are_passed_on(backend):
+    cl = CloudLink()
+    cl.server(port=0, threaded=True, backend=backend, send_queue_limit=1000,
+              compression=True, compression_threshold=64, compression_context_takeover=True,
+              max_message_size=5000, max_frame_size=2000, ping_interval=15, ping_timeout=5)
+    try:
+        assert cl.wss.send_queue_limit == 1000
+        assert cl.wss.compression
+        assert cl.wss.compression_threshold == 64
+        assert cl.wss.compression_context_takeover
+        assert cl.wss.max_message_size == 5000
+        assert cl.wss.max_frame_size == 2000
+        assert cl.wss.ping_interval == 15
+        assert cl.wss.ping_timeout == 5
+        assert cl.getHeartbeatStats() == {"ping_interval": 15, "ping_timeout": 5, "pings_sent": 0, "reaped": 0}
+    finally:
+        cl.wss.shutdown_abruptly()
+        cl.wss.server_close()
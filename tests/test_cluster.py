@@ -0,0 +1,330 @@
+import os
+import json
+import socket
+import tempfile
+from time import sleep, monotonic
+
+import pytest
+
+from cluster import Broker, SocketBus, LocalHub, LocalBus, parse_address, SECRET_ENV
+
+
+def wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while True:
+        result = condition()
+        if result or monotonic() > deadline:
+            return result
+        sleep(0.02)
+
+
+@pytest.fixture
+def broker():
+    broker = Broker(os.path.join(tempfile.mkdtemp(), "cluster.sock"))
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture(params=["unix", "tcp", "local"])
+def new_bus(request):
+    """
+    Makes the buses of the nodes of one cluster, over each kind of hub
+    """
+    if request.param == "local":
+        hub = LocalHub()
+        yield lambda: LocalBus(hub)
+        return
+    if request.param == "unix":
+        hub = Broker(os.path.join(tempfile.mkdtemp(), "cluster.sock"))
+    else:
+        hub = Broker(("127.0.0.1", 0))
+    hub.start()
+    yield lambda: SocketBus(hub.address)
+    hub.stop()
+
+
+def join(new_bus, make_link):
+    link = make_link()
+    link.cl.joinCluster(new_bus())
+    link.cl.cluster.start()
+    return link
+
+
+@pytest.fixture
+def workers(new_bus, make_link):
+    links = [join(new_bus, make_link) for i in range(3)]
+    yield links
+    for link in links:
+        link.cl.cluster.stop()
+
+
+def test_broadcast_reaches_other_workers(workers):
+    a, b, c = workers
+    client_a = a.connect()
+    client_b = b.connect()
+    a.cl.sendPacket({"cmd": "direct", "val": {"mode": 1, "p": "hello"}})
+    assert a.received(client_a) == [{"cmd": "direct", "val": {"mode": 1, "p": "hello"}}]
+    assert wait_for(lambda: b.cl.wss.sent[client_b["id"]])
+    assert b.received(client_b) == [{"cmd": "direct", "val": {"mode": 1, "p": "hello"}}]
+
+
+def test_packets_for_a_user_go_to_its_node_only(workers):
+    a, b, c = workers
+    alice = b.connect()
+    b.set_username(alice, "alice")
+    client_c = c.connect()
+    assert wait_for(lambda: a.cl.isUsernameInCluster("alice") and c.received(client_c))
+    received = []
+    c.cl.cluster.subscribe("user_packet", received.append)
+
+    a.cl.sendPacket({"cmd": "direct", "val": {"mode": "inbox_message", "payload": {}}, "id": "alice"})
+    assert wait_for(lambda: b.received(alice)) == [{"cmd": "direct", "val": {"mode": "inbox_message", "payload": {}}}]
+    sleep(0.1)
+    assert received == []
+    assert c.received(client_c) == []
+
+
+def test_send_packet_to_users(workers):
+    a, b, c = workers
+    members = {}
+    for link, names in [(a, ["alice", "amy"]), (b, ["bob"]), (c, ["carol"])]:
+        for name in names:
+            members[name] = (link, link.connect())
+            link.set_username(members[name][1], name)
+    outsider = c.connect()
+    assert wait_for(lambda: len(a.cl.getUsernames()) == 4)
+    sent = []
+    a.cl.cluster.publish = lambda topic, data, node=None, publish=a.cl.cluster.publish: sent.append(node) or publish(topic, data, node)
+    for link, client in members.values():
+        link.received(client)
+    c.received(outsider)
+
+    a.cl.sendPacketToUsers({"cmd": "direct", "val": {"state": 2, "p": "hi"}}, ["alice", "bob", "carol", "offline"])
+    assert sorted(sent) == sorted([b.cl.cluster.node, c.cl.cluster.node])
+    for name in ["alice", "bob", "carol"]:
+        link, client = members[name]
+        assert wait_for(lambda: link.received(client)) == [{"cmd": "direct", "val": {"state": 2, "p": "hi"}}]
+    sleep(0.1)
+    assert a.received(members["amy"][1]) == []
+    assert c.received(outsider) == []
+
+
+def test_ulist_spans_workers(workers):
+    a, b, c = workers
+    client_a = a.connect()
+    client_b = b.connect()
+    a.set_username(client_a, "alice")
+    assert wait_for(lambda: b.received(client_b)) == [{"cmd": "ulist", "val": "alice;"}]
+    assert b.cl.isUsernameInCluster("alice")
+    assert not b.cl.isUsernameOnline("alice")
+
+    b.set_username(client_b, "bob")
+    assert wait_for(lambda: a.received(client_a) == [{"cmd": "ulist", "val": "alice;bob;"}])
+    assert sorted(a.cl.getUsernames()) == ["alice", "bob"]
+    assert sorted(b.cl.getUsernames()) == ["alice", "bob"]
+
+    a.disconnect(client_a)
+    assert wait_for(lambda: b.received(client_b)) == [{"cmd": "ulist", "val": "bob;"}]
+    assert not b.cl.isUsernameInCluster("alice")
+
+
+def test_setid_conflicts_with_other_workers(workers):
+    a, b, c = workers
+    a.set_username(a.connect(), "alice")
+    assert wait_for(lambda: b.cl.isUsernameInCluster("alice"))
+    client_b = b.connect()
+    b.cl.disabled_commands.discard("setid")
+    b.send(client_b, {"cmd": "setid", "val": "alice"})
+    assert b.received(client_b) == [{"cmd": "statuscode", "val": b.cl.codes["IDConflict"]}]
+
+
+def test_later_login_wins(workers):
+    a, b, c = workers
+    client_a = a.connect()
+    client_b = b.connect()
+    a.set_username(client_a, "alice")
+    assert wait_for(lambda: b.cl.isUsernameInCluster("alice"))
+
+    # The same user logs in on the other worker, the older login gets kicked
+    b.set_username(client_b, "alice")
+    assert wait_for(lambda: client_a["handler"].closes)
+    assert client_a["handler"].closes == [1000]
+    assert {"cmd": "statuscode", "val": a.cl.codes["IDConflict"]} in a.received(client_a)
+    assert not a.cl.isUsernameOnline("alice")
+    assert a.cl.isUsernameInCluster("alice")
+    assert b.cl.isUsernameOnline("alice")
+    assert client_b["handler"].closes == []
+
+    # The kicked client leaving doesn't take the username away from the new login
+    a.disconnect(client_a)
+    sleep(0.2)
+    assert a.cl.isUsernameInCluster("alice")
+    assert a.cl.getUsernames() == ["alice"]
+
+
+def test_usernames_of_a_dead_worker_are_released(workers):
+    a, b, c = workers
+    a.set_username(a.connect(), "alice")
+    assert wait_for(lambda: b.cl.isUsernameInCluster("alice"))
+    a.cl.cluster.stop()
+    assert wait_for(lambda: not b.cl.isUsernameInCluster("alice"))
+
+
+def test_new_worker_gets_the_usernames(new_bus, workers, make_link):
+    a, b, c = workers
+    a.set_username(a.connect(), "alice")
+    b.set_username(b.connect(), "%hidden%")
+    assert wait_for(lambda: c.cl.isUsernameInCluster("alice") and c.cl.isUsernameInCluster("%hidden%"))
+    d = join(new_bus, make_link)
+    try:
+        assert wait_for(lambda: d.cl.isUsernameInCluster("alice") and d.cl.isUsernameInCluster("%hidden%"))
+        assert d.cl._get_ulist() == "alice;"
+    finally:
+        d.cl.cluster.stop()
+
+
+def test_app_topics_are_relayed(workers):
+    a, b, c = workers
+    kicks = []
+    b.cl.cluster.subscribe("kick", kicks.append)
+    a.cl.cluster.publish("kick", {"username": "alice", "status": "Kicked"})
+    assert wait_for(lambda: kicks)
+    assert kicks == [{"username": "alice", "status": "Kicked"}]
+
+
+def test_broker_keeps_the_last_claim(broker):
+    conns = []
+    for i in range(2):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(broker.address)
+        conns.append((conn, conn.makefile("rb")))
+    a, b = [json.loads(reader.readline())["data"]["node"] for conn, reader in conns]
+
+    def send(i, topic, data):
+        conns[i][0].sendall(json.dumps({"topic": topic, "data": data}).encode() + b"\n")
+
+    def read(i):
+        return json.loads(conns[i][1].readline())
+
+    send(0, "claim", {"user": "alice", "claim": 1})
+    assert read(1) == {"topic": "user_add", "data": {"user": "alice", "node": a}, "from": a}
+    send(1, "claim", {"user": "alice", "claim": 7})
+    assert read(0) == {"topic": "user_add", "data": {"user": "alice", "node": b}, "from": b}
+    assert read(0) == {"topic": "drop", "data": {"user": "alice", "claim": 1}}
+    assert broker.owners == {"alice": (b, 7)}
+
+    # A release of the claim that lost changes nothing
+    send(0, "release", {"user": "alice", "claim": 1})
+    send(1, "release", {"user": "alice", "claim": 7})
+    assert read(0) == {"topic": "user_remove", "data": {"user": "alice", "node": b}, "from": b}
+    assert broker.owners == {}
+    for conn, reader in conns:
+        conn.close()
+
+
+def test_broker_drops_a_node_that_falls_behind():
+    broker = Broker(os.path.join(tempfile.mkdtemp(), "cluster.sock"), queue_limit=64 * 1024)
+    broker.start()
+    try:
+        conns = []
+        for i in range(3):
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(broker.address)
+            conns.append((conn, conn.makefile("rb")))
+        sender, receiver, stalled = [json.loads(reader.readline())["data"]["node"] for conn, reader in conns]
+
+        # The stalled node reads nothing more, the others keep going while the Broker drops it
+        message = json.dumps({"topic": "news", "data": "x" * 10000}).encode() + b"\n"
+        for i in range(200):
+            conns[0][0].sendall(message)
+            assert json.loads(conns[1][1].readline())["topic"] == "news"
+        assert wait_for(lambda: not stalled in broker.nodes)
+        conns[0][0].sendall(json.dumps({"topic": "claim", "data": {"user": "alice", "claim": 1}}).encode() + b"\n")
+        assert json.loads(conns[1][1].readline())["topic"] == "user_add"
+        assert set(broker.nodes) == {sender, receiver}
+        for conn, reader in conns:
+            conn.close()
+    finally:
+        broker.stop()
+
+
+@pytest.fixture
+def secret_broker():
+    broker = Broker(("127.0.0.1", 0), secret="meow")
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+def test_nodes_with_the_secret_join(secret_broker):
+    buses = [SocketBus(secret_broker.address, secret="meow") for i in range(2)]
+    for bus in buses:
+        bus.start()
+    received = []
+    buses[1].subscribe("news", received.append)
+    buses[0].publish("news", "hello")
+    assert wait_for(lambda: received) == ["hello"]
+    for bus in buses:
+        bus.stop()
+
+
+@pytest.mark.parametrize("secret", ["", "woof"])
+def test_nodes_without_the_secret_are_refused(secret_broker, secret):
+    with pytest.raises(ConnectionRefusedError):
+        SocketBus(secret_broker.address, secret=secret).start()
+    assert secret_broker.nodes == {}
+
+
+def test_node_that_skips_the_handshake_gets_nothing(secret_broker):
+    conn = socket.create_connection(secret_broker.address)
+    reader = conn.makefile("rb")
+    assert json.loads(reader.readline())["topic"] == "challenge"
+    conn.sendall(json.dumps({"topic": "claim", "data": {"user": "alice", "claim": 1}}).encode() + b"\n")
+    assert reader.readline() == b""
+    assert secret_broker.owners == {}
+    conn.close()
+
+
+def test_secret_from_the_environment(monkeypatch):
+    monkeypatch.setenv(SECRET_ENV, "meow")
+    broker = Broker(("127.0.0.1", 0))
+    broker.start()
+    try:
+        bus = SocketBus(broker.address)
+        bus.start()
+        assert wait_for(lambda: broker.nodes)
+        bus.stop()
+    finally:
+        broker.stop()
+
+
+def test_broker_needs_a_secret_off_loopback(monkeypatch):
+    monkeypatch.delenv(SECRET_ENV, raising=False)
+    with pytest.raises(ValueError):
+        Broker(("0.0.0.0", 0)).start()
+    broker = Broker(("0.0.0.0", 0), secret="meow")
+    broker.start()
+    broker.stop()
+
+
+def test_parse_address():
+    assert parse_address("10.0.0.2:4000") == ("10.0.0.2", 4000)
+    assert parse_address("[::1]:4000") == ("[::1]", 4000)
+    assert parse_address("/tmp/cluster.sock") == "/tmp/cluster.sock"
+
+
+def test_rooms_are_shared(workers):
+    a, b, c = workers
+    bob = b.connect()
+    b.set_username(bob, "bob")
+    client_c = c.connect()
+    assert wait_for(lambda: a.cl.isUsernameInCluster("bob") and c.received(client_c))
+    a.cl.setRoom("chat1", ["alice", "bob"])
+    assert wait_for(lambda: b.cl.rooms.get("chat1") == {"alice", "bob"} and c.cl.rooms.get("chat1") == {"alice", "bob"})
+
+    c.cl.sendPacketToRoom({"cmd": "direct", "val": "hi"}, "chat1")
+    assert wait_for(lambda: b.received(bob)) == [{"cmd": "direct", "val": "hi"}]
+
+    a.cl.deleteRoom("chat1")
+    assert wait_for(lambda: not ("chat1" in b.cl.rooms or "chat1" in c.cl.rooms))
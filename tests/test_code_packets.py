@@ -0,0 +1,29 @@
+import json
+
+
+def test_code_packet(link):
+    assert json.loads(link.cl._get_code_packet("OK")) == {"cmd": "statuscode", "val": link.cl.codes["OK"]}
+
+
+def test_listener_is_spliced_in(link):
+    for listener in ["a", "", 'quote " and \\ backslash', "ünïcode"]:
+        packet = link.cl._get_code_packet("IDNotFound", True, listener)
+        assert json.loads(packet) == {"cmd": "statuscode", "val": link.cl.codes["IDNotFound"], "listener": listener}
+
+
+def test_code_packets_are_cached(link):
+    assert link.cl._get_code_packet("OK") is link.cl._get_code_packet("OK")
+
+
+def test_changed_code_is_rebuilt(link):
+    link.cl._get_code_packet("OK")
+    link.cl._get_code_packet("OK", True, "x")
+    link.cl.codes["OK"] = "I:100 | Fine"
+    assert json.loads(link.cl._get_code_packet("OK")) == {"cmd": "statuscode", "val": "I:100 | Fine"}
+    assert json.loads(link.cl._get_code_packet("OK", True, "x")) == {"cmd": "statuscode", "val": "I:100 | Fine", "listener": "x"}
+
+
+def test_send_code(link):
+    client = link.connect()
+    link.cl.sendCode(client, "Refused", True, "k")
+    assert link.received(client) == [{"cmd": "statuscode", "val": link.cl.codes["Refused"], "listener": "k"}]
@@ -0,0 +1,115 @@
+import json
+
+import msgpack
+
+import cloudlink
+
+
+def negotiate(link, client, codec="msgpack", client_type="js"):
+    link.send(client, {"cmd": "direct", "val": {"cmd": "type", "val": client_type, "codec": codec}})
+    return link.cl.wss.sent[client["id"]][:]
+
+
+def test_negotiate_msgpack(link):
+    client = link.connect()
+    assert negotiate(link, client) == [json.dumps({"cmd": "direct", "val": {"cmd": "codec", "val": "msgpack"}})]
+    link.received(client)
+    link.send(client, {"cmd": "ping", "listener": "p"})
+    sent = link.cl.wss.sent[client["id"]]
+    assert isinstance(sent[0], bytes)
+    assert msgpack.unpackb(sent[0]) == {"cmd": "ping", "val": link.cl.codes["OK"], "listener": "p"}
+
+
+def test_no_codecs_without_msgpack(monkeypatch):
+    monkeypatch.setattr(cloudlink, "msgpack", None)
+    assert cloudlink.CloudLink().codecs == {}
+
+
+def test_fallback_to_json_without_msgpack(link):
+    link.cl.codecs = {}  # As set up when msgpack can't be imported
+    client = link.connect()
+    assert negotiate(link, client) == [json.dumps({"cmd": "direct", "val": {"cmd": "codec", "val": "json"}})]
+    link.received(client)
+    link.send(client, {"cmd": "ping"})
+    assert link.cl.wss.sent[client["id"]] == [json.dumps({"cmd": "ping", "val": link.cl.codes["OK"]})]
+
+
+def test_unknown_codec_stays_on_json(link):
+    client = link.connect()
+    assert negotiate(link, client, "cbor") == [json.dumps({"cmd": "direct", "val": {"cmd": "codec", "val": "json"}})]
+    assert link.cl._get_client_codec(client) is None
+
+
+def test_scratch_stays_on_json(link):
+    client = link.connect()
+    assert negotiate(link, client, client_type="scratch") == []
+    assert link.cl._get_client_codec(client) is None
+
+
+def test_type_is_only_set_once(link):
+    client = link.connect()
+    link.send(client, {"cmd": "direct", "val": {"cmd": "type", "val": "js"}})
+    assert negotiate(link, client) == []
+    assert link.cl._get_client_codec(client) is None
+
+
+def test_binary_packets_are_decoded(link):
+    calls = []
+    link.cl.registerCommand("post_home", calls.append)
+    client = link.connect()
+    negotiate(link, client)
+    link.send(client, msgpack.packb({"cmd": "direct", "val": {"cmd": "post_home", "val": "hi"}}))
+    assert calls == [{"cmd": "post_home", "val": "hi", "id": client}]
+
+
+def test_bad_binary_packet(link):
+    client = link.connect()
+    negotiate(link, client)
+    link.received(client)
+    link.send(client, b"\xc1")
+    assert link.received(client) == [{"cmd": "statuscode", "val": link.cl.codes["Syntax"]}]
+
+
+def test_binary_packet_without_codec(link):
+    client = link.connect()
+    link.send(client, msgpack.packb({"cmd": "ping"}))
+    assert link.cl.wss.sent[client["id"]] == [link.cl._get_code_packet("Syntax")]
+
+
+def test_listener_is_spliced_into_msgpack(link):
+    for listener in ["a", "", "x" * 40, "ünïcode"]:
+        packet = link.cl._get_code_packet("OK", True, listener, "msgpack")
+        assert msgpack.unpackb(packet) == {"cmd": "statuscode", "val": link.cl.codes["OK"], "listener": listener}
+    link.cl.codes["OK"] = "I:100 | Fine"
+    assert msgpack.unpackb(link.cl._get_code_packet("OK", codec="msgpack")) == {"cmd": "statuscode", "val": "I:100 | Fine"}
+
+
+def test_broadcast_is_encoded_once_per_codec(link):
+    encoded = []
+    packb = link.cl.codecs["msgpack"][0]
+    link.cl.codecs["msgpack"] = (lambda payload: encoded.append(payload) or packb(payload), link.cl.codecs["msgpack"][1])
+    json_clients = [link.connect() for i in range(2)]
+    packed_clients = [link.connect() for i in range(3)]
+    for client in packed_clients:
+        negotiate(link, client)
+        link.received(client)
+    link.cl.sendPacket({"cmd": "direct", "val": {"mode": 1, "p": "hello"}})
+    assert len(encoded) == 1
+    sent = set()
+    for client in packed_clients:
+        sent.add(link.cl.wss.sent[client["id"]][0])
+        assert link.received(client) == [{"cmd": "direct", "val": {"mode": 1, "p": "hello"}}]
+    assert len(sent) == 1
+    for client in json_clients:
+        assert link.received(client) == [{"cmd": "direct", "val": {"mode": 1, "p": "hello"}}]
+
+
+def test_ulist_in_client_codec(link):
+    packed = link.connect()
+    plain = link.connect()
+    negotiate(link, packed)
+    link.received(packed)
+    link.cl.setUsername(plain, "alice")
+    assert isinstance(link.cl.wss.sent[packed["id"]][0], bytes)
+    assert link.received(packed) == [{"cmd": "ulist", "val": "alice;"}]
+    assert link.received(plain) == [{"cmd": "ulist", "val": "alice;"}]
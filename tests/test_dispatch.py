@@ -0,0 +1,91 @@
+def status(link, code, listener=None):
+    packet = {"cmd": "statuscode", "val": link.cl.codes[code]}
+    if listener is not None:
+        packet["listener"] = listener
+    return packet
+
+
+def test_missing_parameter_is_syntax(link):
+    client = link.connect()
+    link.send(client, {"cmd": "pmsg", "val": "hi"})
+    assert link.received(client) == [status(link, "Syntax")]
+
+
+def test_missing_cmd_is_syntax(link):
+    client = link.connect()
+    link.send(client, {"val": "hi", "listener": "x"})
+    assert link.received(client) == [status(link, "Syntax", "x")]
+
+
+def test_cmd_datatype(link):
+    client = link.connect()
+    link.send(client, {"cmd": 5, "val": "hi"})
+    assert link.received(client) == [status(link, "Datatype")]
+
+
+def test_unparsable_packet(link):
+    client = link.connect()
+    link.send(client, "{not json")
+    link.send(client, "")
+    assert link.received(client) == [status(link, "Syntax"), status(link, "EmptyPacket")]
+
+
+def test_disabled_commands(link):
+    client = link.connect()
+    for cmd in ["gmsg", "setid", "gvar"]:
+        link.send(client, {"cmd": cmd, "val": "x", "name": "x", "listener": cmd})
+        assert link.received(client) == [status(link, "Disabled", cmd)]
+
+
+def test_enabled_command_runs(link):
+    link.cl.disabled_commands.discard("gmsg")
+    alice = link.connect()
+    bob = link.connect()
+    link.send(alice, {"cmd": "gmsg", "val": "hello"})
+    assert link.received(alice) == [{"cmd": "gmsg", "val": "hello"}, status(link, "OK")]
+    assert link.received(bob) == [{"cmd": "gmsg", "val": "hello"}]
+
+
+def test_ping(link):
+    client = link.connect()
+    link.send(client, {"cmd": "ping", "listener": "p"})
+    assert link.received(client) == [{"cmd": "ping", "val": link.cl.codes["OK"], "listener": "p"}]
+
+
+def test_pmsg_to_unknown_id(link):
+    client = link.connect()
+    link.set_username(client, "alice")
+    link.send(client, {"cmd": "pmsg", "val": "hi", "id": "nobody"})
+    assert link.received(client) == [status(link, "IDNotFound")]
+
+
+def test_unknown_command_is_routed(link):
+    alice = link.connect()
+    bob = link.connect()
+    link.set_username(alice, "alice")
+    link.set_username(bob, "bob")
+    link.received(alice)
+    link.send(alice, {"cmd": "custom", "val": {"a": 1}, "id": "bob"})
+    assert link.received(bob) == [{"cmd": "custom", "val": {"a": 1}, "origin": "alice"}]
+    assert link.received(alice) == [status(link, "OK")]
+
+
+def test_registered_command(link):
+    calls = []
+    other = []
+    link.cl.registerCommand("get_home", calls.append)
+    link.cl.callback("on_packet", other.append)
+    client = link.connect()
+    link.send(client, {"cmd": "direct", "val": {"cmd": "get_home", "val": {"page": 2}}, "listener": "h"})
+    link.send(client, {"cmd": "direct", "val": {"cmd": "something_else", "val": 1}})
+    assert calls == [{"cmd": "get_home", "val": {"page": 2}, "id": client, "listener": "h"}]
+    assert other == [{"cmd": "something_else", "val": 1, "id": client}]
+
+
+def test_registered_command_error(link):
+    def broken(message):
+        raise RuntimeError("broken")
+    link.cl.registerCommand("broken", broken)
+    client = link.connect()
+    link.send(client, {"cmd": "direct", "val": {"cmd": "broken", "val": None}, "listener": "b"})
+    assert link.received(client) == [status(link, "InternalServerError", "b")]
@@ -0,0 +1,136 @@
+import random
+
+import pytest
+
+from better_profanity import Profanity
+from better_profanity.utils import read_wordlist
+
+from filter import WordFilter, DEFAULT_WORDLIST
+from supporter import Supporter
+
+
+BLACKLIST = ["meowbad", "cat food", "doge-coin"]
+WHITELIST = ["Hell", "damn"]
+
+
+@pytest.fixture(scope="module")
+def word_filter():
+    return WordFilter(blacklist=BLACKLIST, whitelist=WHITELIST)
+
+
+@pytest.fixture(scope="module")
+def reference():
+    """
+    better_profanity with the same words, the filter has to censor exactly what it does
+    """
+    words = list(read_wordlist(DEFAULT_WORDLIST)) + BLACKLIST
+    profanity = Profanity(words)
+    profanity.load_censor_words(custom_words=words, whitelist_words=list(WHITELIST))
+    return profanity
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "a",
+    "  ",
+    "hello world",
+    "shit",
+    "what the shit is this",
+    "$h1t and f*ck",
+    "SHIT!!",
+    "sh1t.",
+    "blow job",
+    "blow-job",
+    "2 girls 1 cup",
+    "my cat food is meowbad",
+    "doge-coin",
+    "hell no, damn",
+    "ass-fucker",
+    "x shit",
+    "shit x",
+    "shitshit shit",
+    "Straße shit 日本",
+])
+def test_same_as_better_profanity(word_filter, reference, text):
+    assert word_filter.censor(text) == reference.censor(text)
+
+
+def test_same_as_better_profanity_on_random_posts(word_filter, reference):
+    rng = random.Random(0)
+    words = list(read_wordlist(DEFAULT_WORDLIST))[:200] + BLACKLIST + WHITELIST + ["hello", "the", "a", "cat", "food", "ok"]
+    leet = {"a": "@4", "i": "1l", "o": "0", "e": "3", "s": "$5", "t": "7"}
+    separators = [" ", "  ", ", ", ".", "-", "_", "!", "\n", ""]
+    for i in range(300):
+        text = "".join(
+            "".join(rng.choice(leet[char]) if char in leet and rng.random() < 0.3 else char for char in rng.choice(words)) + rng.choice(separators)
+            for j in range(rng.randint(0, 8))
+        )
+        assert word_filter.censor(text) == reference.censor(text), text
+
+
+def test_whitelist_and_blacklist(word_filter):
+    assert word_filter.is_word("meowbad")
+    assert word_filter.is_word("MEOWB@D")
+    assert not word_filter.is_word("hell")
+    assert word_filter.censor("hell meowbad") == "hell ****"
+
+
+def test_censor_char(word_filter):
+    assert word_filter.censor("shit", censor_char="#") == "####"
+
+
+def test_supporter_rebuilds_only_when_the_document_changes():
+    supporter = Supporter()
+    assert supporter.wordfilter("meowbad shit") == "meowbad ****"
+
+    supporter.load_filter({"_id": "filter", "whitelist": [], "blacklist": ["meowbad"]})
+    engine = supporter.filter_engine
+    assert supporter.wordfilter("meowbad shit") == "**** ****"
+    supporter.load_filter({"_id": "filter", "whitelist": [], "blacklist": ["meowbad"]})
+    assert supporter.filter_engine is engine
+
+    supporter.load_filter({"_id": "filter", "whitelist": ["shit"], "blacklist": []})
+    assert supporter.wordfilter("meowbad shit") == "meowbad shit"
+
+
+def test_supporter_caches_results():
+    supporter = Supporter()
+    supporter.filter_cache_size = 2
+    censor = supporter.filter_engine.censor
+    calls = []
+    supporter.filter_engine.censor = lambda message: calls.append(message) or censor(message)
+    assert supporter.wordfilter("shit") == "****"
+    assert supporter.wordfilter("shit") == "****"
+    assert calls == ["shit"]
+    supporter.wordfilter("hello")
+    supporter.wordfilter("shit")  # Makes "hello" the least recently used
+    supporter.wordfilter("world")
+    assert list(supporter.filter_cache) == ["shit", "world"]
+    assert supporter.get_wordfilter_stats() == {"hits": 2, "misses": 3, "hit_rate": 0.4, "entries": 2, "size": 2}
+
+    # Too long to keep
+    supporter.wordfilter("a" * (supporter.filter_cache_max_length + 1))
+    assert supporter.get_wordfilter_stats()["entries"] == 2
+
+
+def test_new_filter_empties_the_cache():
+    supporter = Supporter()
+    assert supporter.wordfilter("meowbad") == "meowbad"
+    supporter.load_filter({"_id": "filter", "whitelist": [], "blacklist": ["meowbad"]})
+    assert supporter.get_wordfilter_stats()["entries"] == 0
+    assert supporter.wordfilter("meowbad") == "****"
+    assert supporter.get_wordfilter_stats()["misses"] == 2
+
+
+def test_result_of_a_replaced_filter_is_not_cached():
+    supporter = Supporter()
+    censor = supporter.filter_engine.censor
+
+    def censor_while_reloading(message):
+        # load_filter runs on another thread while the old filter censors
+        supporter.load_filter({"_id": "filter", "whitelist": [], "blacklist": ["meowbad"]})
+        return censor(message)
+    supporter.filter_engine.censor = censor_while_reloading
+    assert supporter.wordfilter("meowbad") == "meowbad"
+    assert supporter.get_wordfilter_stats()["entries"] == 0
+    assert supporter.wordfilter("meowbad") == "****"
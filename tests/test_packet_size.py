@@ -0,0 +1,70 @@
+import json
+
+
+def test_no_limits_by_default(link):
+    client = link.connect()
+    link.send(client, {"cmd": "ping", "val": "a" * 100000})
+    assert link.received(client) == [{"cmd": "ping", "val": link.cl.codes["OK"]}]
+
+
+def test_packet_over_every_limit_is_not_parsed(link, monkeypatch):
+    link.cl.setPacketSizeLimit(100)
+    client = link.connect()
+    parsed = []
+    monkeypatch.setattr(json, "loads", lambda *args, **kwargs: parsed.append(args))
+    link.cl._on_packet_server(client, link.cl.wss, json.dumps({"cmd": "ping", "val": "a" * 200}))
+    assert parsed == []
+    assert link.cl.wss.sent[client["id"]] == [link.cl._get_code_packet("TooLarge")]
+
+
+def test_direct_command_limit(link):
+    calls = []
+    link.cl.registerCommand("post_home", calls.append, 200)
+    link.cl.setPacketSizeLimit(100)
+    client = link.connect()
+    link.send(client, {"cmd": "direct", "val": {"cmd": "post_home", "val": "a" * 120}})
+    assert len(calls) == 1
+    link.send(client, {"cmd": "direct", "val": {"cmd": "post_home", "val": "a" * 250}, "listener": "l"})
+    assert len(calls) == 1
+    # Past every limit, so refused before the listener is known
+    assert link.received(client) == [{"cmd": "statuscode", "val": link.cl.codes["TooLarge"]}]
+    # The bigger limit of post_home doesn't carry over to other commands
+    link.send(client, {"cmd": "direct", "val": {"cmd": "get_home", "val": "a" * 120}, "listener": "l"})
+    assert link.received(client) == [{"cmd": "statuscode", "val": link.cl.codes["TooLarge"], "listener": "l"}]
+
+
+def test_direct_command_limit_for_scratch(link):
+    # Scratch sends the direct val as a JSON string, the limit of its command still applies
+    calls = []
+    link.cl.registerCommand("post_home", calls.append, 16000)
+    link.cl.setPacketSizeLimit(8000)
+    scratch = link.connect()
+    link.send(scratch, {"cmd": "direct", "val": {"cmd": "type", "val": "scratch"}})
+    js = link.connect()
+    post = {"cmd": "post_home", "val": '"' * 3000}
+    link.send(scratch, {"cmd": "direct", "val": json.dumps(post), "listener": "l"})
+    link.send(js, {"cmd": "direct", "val": post, "listener": "l"})
+    assert len(calls) == 2
+    assert calls[0]["val"] == calls[1]["val"]
+    # A string val from anyone else isn't decoded, so it is held to the default limit
+    link.received(js)
+    link.send(js, {"cmd": "direct", "val": json.dumps(post), "listener": "l"})
+    assert link.received(js) == [{"cmd": "statuscode", "val": link.cl.codes["TooLarge"], "listener": "l"}]
+
+
+def test_top_level_command_limit(link):
+    link.cl.setPacketSizeLimit(100, "ping")
+    client = link.connect()
+    link.send(client, {"cmd": "ping", "val": "a" * 200})
+    assert link.received(client) == [{"cmd": "statuscode", "val": link.cl.codes["TooLarge"]}]
+    # Commands without a limit of their own take anything while there is no default
+    assert link.cl.packet_size_cap == 0
+    link.send(client, {"cmd": "pmsg", "val": "a" * 200, "id": "nobody"})
+    assert link.received(client) == [{"cmd": "statuscode", "val": link.cl.codes["IDNotFound"]}]
+
+
+def test_remove_limit(link):
+    link.cl.setPacketSizeLimit(100)
+    link.cl.setPacketSizeLimit(0)
+    assert link.cl.packet_size_limits == {}
+    assert link.cl.packet_size_cap == 0
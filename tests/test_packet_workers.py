@@ -0,0 +1,81 @@
+import threading
+import time
+
+from cloudlink import PacketWorkerPool
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_packets_run_in_order_per_client():
+    pool = PacketWorkerPool(workers=4, queue_depth=1000)
+    pool.start()
+    ran = {1: [], 2: [], 3: []}
+    for i in range(200):
+        for client_id in ran:
+            pool.submit(client_id, lambda client_id=client_id, i=i: ran[client_id].append(i))
+    wait_for(lambda: pool.get_stats()["processed"] == 600)
+    for client_id in ran:
+        assert ran[client_id] == list(range(200))
+
+
+def test_full_queue_rejects_packets():
+    pool = PacketWorkerPool(workers=1, queue_depth=2, overflow="drop")
+    pool.start()
+    release = threading.Event()
+    ran = []
+    assert pool.submit(1, release.wait)
+    wait_for(lambda: pool.get_stats()["queued"] == 0)  # Running, not queued
+    assert pool.submit(1, lambda: ran.append(1))
+    assert pool.submit(1, lambda: ran.append(2))
+    assert not pool.submit(1, lambda: ran.append(3))
+    # Other clients have their own queue
+    assert pool.submit(2, lambda: ran.append("other"))
+    release.set()
+    wait_for(lambda: len(ran) == 3)
+    assert [value for value in ran if value != "other"] == [1, 2]
+    assert pool.get_stats()["dropped"] == 1
+
+
+def test_discard_drops_pending_packets():
+    pool = PacketWorkerPool(workers=1, queue_depth=10)
+    pool.start()
+    release = threading.Event()
+    ran = []
+    pool.submit(1, release.wait)
+    pool.submit(1, lambda: ran.append(1))
+    pool.submit(1, lambda: ran.append(2))
+    pool.discard(1)
+    release.set()
+    wait_for(lambda: pool.get_stats()["clients"] == 0)
+    assert ran == []
+    # The client can be scheduled again afterwards
+    pool.submit(1, lambda: ran.append(3))
+    wait_for(lambda: ran == [3])
+
+
+def test_overflow_ratelimit_replies(link):
+    link.cl.packet_workers.submit = lambda client_id, function: False
+    client = link.connect()
+    link.send(client, {"cmd": "ping", "listener": "a"})
+    assert link.received(client) == [{"cmd": "statuscode", "val": link.cl.codes["RateLimit"], "listener": "a"}]
+
+
+def test_overflow_drop_is_silent(link):
+    link.cl.packet_workers.submit = lambda client_id, function: False
+    link.cl.packet_workers.overflow = "drop"
+    client = link.connect()
+    link.send(client, {"cmd": "ping"})
+    assert link.received(client) == []
+
+
+def test_disconnect_discards_queued_packets(link):
+    discarded = []
+    link.cl.packet_workers.discard = discarded.append
+    client = link.connect()
+    link.disconnect(client)
+    assert discarded == [client["id"]]
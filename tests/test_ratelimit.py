@@ -0,0 +1,77 @@
+import pytest
+
+import ratelimit
+from ratelimit import RateLimiter
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def limiter(clock):
+    limiter = RateLimiter()
+    limiter.sweeper = True  # Sweeps run by hand
+    return limiter
+
+
+def test_burst_then_limited(limiter):
+    assert [limiter.check("login", "alice", burst=5, seconds=60) for i in range(6)] == [False] * 5 + [True]
+
+
+def test_tokens_come_back(limiter, clock):
+    for i in range(6):
+        limiter.check("posts", "alice", burst=6, seconds=5)
+    assert limiter.check("posts", "alice", burst=6, seconds=5)
+    clock.now += 5 / 6
+    assert not limiter.check("posts", "alice", burst=6, seconds=5)
+    assert limiter.check("posts", "alice", burst=6, seconds=5)
+    clock.now += 5
+    assert [limiter.check("posts", "alice", burst=6, seconds=5) for i in range(7)] == [False] * 6 + [True]
+
+
+def test_limited_checks_take_no_token(limiter, clock):
+    limiter.check("signup", "1.2.3.4", burst=1, seconds=10)
+    for i in range(5):
+        assert limiter.check("signup", "1.2.3.4", burst=1, seconds=10)
+    clock.now += 10
+    assert not limiter.check("signup", "1.2.3.4", burst=1, seconds=10)
+
+
+def test_types_and_keys_are_separate(limiter):
+    assert not limiter.check("login", "alice")
+    assert limiter.check("login", "alice")
+    assert not limiter.check("login", "bob")
+    assert not limiter.check("posts", "alice")
+
+
+def test_sweep_forgets_full_buckets(limiter, clock):
+    limiter.check("login", "alice", burst=5, seconds=60)
+    limiter.check("posts", "bob", burst=6, seconds=5)
+    clock.now += 6
+    assert limiter.sweep() == 1
+    assert limiter.get_stats() == {"keys": {"login": 1, "posts": 0}, "swept": 1}
+    clock.now += 60
+    assert limiter.sweep() == 1
+    assert limiter.get_stats()["keys"] == {"login": 0, "posts": 0}
+
+
+def test_sweeper_starts_with_the_first_check():
+    limiter = RateLimiter(sweep_interval=3600)
+    assert limiter.sweeper is None
+    limiter.check("login", "alice")
+    assert limiter.sweeper.daemon
@@ -0,0 +1,75 @@
+def test_room_packet_reaches_online_members_only(link):
+    alice = link.connect()
+    bob = link.connect()
+    carol = link.connect()
+    link.set_username(alice, "alice")
+    link.set_username(bob, "bob")
+    link.set_username(carol, "carol")
+    for client in (alice, bob, carol):
+        link.received(client)
+    link.cl.setRoom("chat1", ["alice", "bob", "offline"])
+
+    link.cl.sendPacketToRoom({"cmd": "direct", "val": {"state": 2, "p": "hi"}}, "chat1")
+    assert link.received(alice) == [{"cmd": "direct", "val": {"state": 2, "p": "hi"}}]
+    assert link.received(bob) == [{"cmd": "direct", "val": {"state": 2, "p": "hi"}}]
+    assert link.received(carol) == []
+
+
+def test_room_packet_is_encoded_once(link):
+    clients = [link.connect() for i in range(5)]
+    for i, client in enumerate(clients):
+        link.set_username(client, "user{0}".format(i))
+        link.received(client)
+    link.cl.setRoom("chat1", ["user{0}".format(i) for i in range(5)])
+    calls = []
+    send_message_to_many = link.cl.wss.send_message_to_many
+    link.cl.wss.send_message_to_many = lambda clients, msg: calls.append(len(clients)) or send_message_to_many(clients, msg)
+
+    link.cl.sendPacketToRoom({"cmd": "direct", "val": "typing"}, "chat1")
+    assert calls == [5]
+
+
+def test_members_fill_in_an_unknown_room(link):
+    alice = link.connect()
+    link.set_username(alice, "alice")
+    link.received(alice)
+
+    # Without members a room that was never set gets nothing
+    link.cl.sendPacketToRoom({"cmd": "direct", "val": "lost"}, "chat1")
+    assert link.received(alice) == []
+
+    link.cl.sendPacketToRoom({"cmd": "direct", "val": "first"}, "chat1", ["alice"])
+    assert link.received(alice) == [{"cmd": "direct", "val": "first"}]
+    # Once set, the room's own members win over stale ones
+    link.cl.setRoom("chat1", [])
+    link.cl.sendPacketToRoom({"cmd": "direct", "val": "second"}, "chat1", ["alice"])
+    assert link.received(alice) == []
+
+
+def test_membership_changes(link):
+    alice = link.connect()
+    bob = link.connect()
+    link.set_username(alice, "alice")
+    link.set_username(bob, "bob")
+    link.received(alice)
+    link.cl.setRoom("chat1", ["alice"])
+    link.cl.setRoom("chat1", ["alice", "bob"])
+    link.cl.sendPacketToRoom({"cmd": "direct", "val": "added"}, "chat1")
+    assert link.received(bob) == [{"cmd": "direct", "val": "added"}]
+
+    link.cl.setRoom("chat1", ["alice"])
+    link.cl.sendPacketToRoom({"cmd": "direct", "val": "removed"}, "chat1")
+    assert link.received(bob) == []
+    assert link.received(alice) == [{"cmd": "direct", "val": "added"}, {"cmd": "direct", "val": "removed"}]
+
+    link.cl.deleteRoom("chat1")
+    assert "chat1" not in link.cl.rooms
+
+
+def test_member_that_logs_in_later_gets_room_packets(link):
+    link.cl.setRoom("chat1", ["alice"])
+    alice = link.connect()
+    link.set_username(alice, "alice")
+    link.received(alice)
+    link.cl.sendPacketToRoom({"cmd": "direct", "val": "hi"}, "chat1")
+    assert link.received(alice) == [{"cmd": "direct", "val": "hi"}]
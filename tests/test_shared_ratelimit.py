@@ -0,0 +1,117 @@
+import multiprocessing
+
+import pytest
+
+import ratelimit
+from ratelimit import SharedRateLimiter, SLOTS_PER_GROUP
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def table():
+    table = SharedRateLimiter(groups=64)
+    yield table
+    table.remove()
+
+
+def test_burst_then_limited(table, clock):
+    assert [table.check("login", "alice", burst=5, seconds=60) for i in range(6)] == [False] * 5 + [True]
+    assert not table.check("login", "bob", burst=5, seconds=60)
+    assert not table.check("signup", "alice", burst=5, seconds=60)
+    clock.now += 12
+    assert not table.check("login", "alice", burst=5, seconds=60)
+    assert table.check("login", "alice", burst=5, seconds=60)
+
+
+def test_processes_share_the_table(table, clock):
+    other = SharedRateLimiter(table.path)
+    try:
+        assert other.groups == table.groups
+        for i in range(3):
+            table.check("login", "alice", burst=5, seconds=60)
+        assert [other.check("login", "alice", burst=5, seconds=60) for i in range(3)] == [False, False, True]
+        assert table.get_stats() == {"keys": 1, "slots": 64 * SLOTS_PER_GROUP, "full_groups": 0}
+    finally:
+        other.close()
+
+
+def test_full_buckets_free_their_slots(clock):
+    table = SharedRateLimiter(groups=1)
+    try:
+        for i in range(SLOTS_PER_GROUP):
+            table.check("login", i, burst=5, seconds=60)
+        clock.now += 60
+        assert table.get_stats()["keys"] == 0
+        for i in range(SLOTS_PER_GROUP):
+            table.check("posts", i, burst=6, seconds=5)
+        assert table.get_stats()["keys"] == SLOTS_PER_GROUP
+    finally:
+        table.remove()
+
+
+def test_full_group_limits_new_keys(clock):
+    table = SharedRateLimiter(groups=1)
+    try:
+        assert [table.check("login", "victim", burst=5, seconds=60) for i in range(5)] == [False] * 5
+        for i in range(SLOTS_PER_GROUP - 1):
+            table.check("login", i, burst=1, seconds=60)
+        # No bucket is full again, so a new key can't have a slot and nobody's bucket is reset
+        assert table.check("login", "new", burst=1, seconds=60)
+        assert table.check("login", "victim", burst=5, seconds=60)
+        assert table.get_stats()["full_groups"] == 1
+        # Once a bucket is full again its slot is free
+        clock.now += 60
+        assert not table.check("login", "new", burst=1, seconds=60)
+    finally:
+        table.remove()
+
+
+def test_hash_is_salted_per_table(table):
+    other = SharedRateLimiter(table.path)
+    new = SharedRateLimiter(groups=64)
+    try:
+        assert len(table.salt) == 16
+        assert other.salt == table.salt
+        assert not new.salt == table.salt
+    finally:
+        other.close()
+        new.remove()
+
+
+def test_not_a_table(tmp_path):
+    path = tmp_path / "table"
+    path.write_bytes(b"x" * 1000)
+    with pytest.raises(ValueError):
+        SharedRateLimiter(str(path))
+
+
+def attempt_logins(path, results):
+    table = SharedRateLimiter(path)
+    results.put(sum(1 for i in range(5) if not table.check("login", "alice", burst=5, seconds=60)))
+    table.close()
+
+
+def test_worker_processes_share_a_limit(table):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=attempt_logins, args=(table.path, results)) for i in range(4)]
+    for process in processes:
+        process.start()
+    allowed = sum(results.get(timeout=10) for process in processes)
+    for process in processes:
+        process.join()
+    assert allowed == 5
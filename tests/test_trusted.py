@@ -0,0 +1,45 @@
+def trusted_link(link):
+    link.cl.trustedAccess(True, ["key"])
+    return link
+
+
+def trust(link, client):
+    link.send(client, {"cmd": "direct", "val": "key"})
+    link.received(client)  # Drop the ulist, gmsg and statuscode
+
+
+def test_broadcast_only_reaches_trusted_clients(link):
+    trusted_link(link)
+    alice = link.connect()
+    bob = link.connect()
+    eve = link.connect()
+    trust(link, alice)
+    trust(link, bob)
+    link.cl.sendPacket({"cmd": "gmsg", "val": "hello"})
+    assert link.received(alice) == [{"cmd": "gmsg", "val": "hello"}]
+    assert link.received(bob) == [{"cmd": "gmsg", "val": "hello"}]
+    assert link.received(eve) == []
+
+
+def test_trusted_clients_are_kept_by_id(link):
+    trusted_link(link)
+    alice = link.connect()
+    trust(link, alice)
+    assert link.cl.statedata["trusted"] == {alice["id"]}
+
+    link.cl.untrust(alice)
+    assert link.cl.statedata["trusted"] == set()
+    trust(link, alice)
+    link.disconnect(alice)
+    assert link.cl.statedata["trusted"] == set()
+
+
+def test_blocked_ip_is_not_trusted(link):
+    trusted_link(link)
+    alice = link.connect(ip="10.0.0.1")
+    trust(link, alice)
+    link.cl.blockIP("10.0.0.1")
+    link.cl.sendPacket({"cmd": "gmsg", "val": "hello"})
+    assert link.received(alice) == []
+    assert link.cl.getIPBlocklist() == ["10.0.0.1"]
+    assert link.cl.getIPBlocklist() == ["10.0.0.1"]
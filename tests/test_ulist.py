@@ -0,0 +1,89 @@
+import time
+
+
+def ulists(messages):
+    return [message for message in messages if message["cmd"] in ("ulist", "ulist_add", "ulist_remove")]
+
+
+def test_ulist_broadcast(link):
+    alice = link.connect()
+    bob = link.connect()
+    link.cl.setUsername(alice, "alice")
+    assert ulists(link.received(bob)) == [{"cmd": "ulist", "val": "alice;"}]
+    assert ulists(link.received(alice)) == [{"cmd": "ulist", "val": "alice;"}]
+    link.cl.setUsername(bob, "bob")
+    assert ulists(link.received(alice)) == [{"cmd": "ulist", "val": "alice;bob;"}]
+
+
+def test_hidden_usernames_are_left_out(link):
+    alice = link.connect()
+    bob = link.connect()
+    link.cl.setUsername(alice, "%hidden%")
+    assert ulists(link.received(bob)) == []
+    assert link.cl._get_ulist() == ""
+
+
+def test_changes_are_coalesced(link):
+    link.cl.ulist_window = 0.05
+    watcher = link.connect()
+    clients = [link.connect() for i in range(3)]
+    for i, client in enumerate(clients):
+        link.cl.setUsername(client, "user{0}".format(i))
+    time.sleep(0.2)
+    assert ulists(link.received(watcher)) == [{"cmd": "ulist", "val": "user0;user1;user2;"}]
+
+
+def test_add_then_remove_cancels_out(link):
+    link.cl.ulist_window = 0.05
+    watcher = link.connect()
+    client = link.connect()
+    link.cl.setUsername(client, "flicker")
+    link.disconnect(client)
+    time.sleep(0.2)
+    assert ulists(link.received(watcher)) == []
+    assert link.cl.ulist_pending == {}
+
+
+def test_deltas(link):
+    full = link.connect()
+    delta = link.connect()
+    link.send(delta, {"cmd": "direct", "val": {"cmd": "ulist_delta", "val": True}})
+    alice = link.connect()
+    bob = link.connect()
+    link.cl.setUsername(alice, "alice")
+    link.cl.setUsername(bob, "bob")
+    assert ulists(link.received(delta)) == [{"cmd": "ulist_add", "val": "alice;"}, {"cmd": "ulist_add", "val": "bob;"}]
+    link.disconnect(alice)
+    assert ulists(link.received(delta)) == [{"cmd": "ulist_remove", "val": "alice;"}]
+    assert ulists(link.received(full))[-1] == {"cmd": "ulist", "val": "bob;"}
+
+
+def test_deltas_are_coalesced(link):
+    link.cl.ulist_window = 0.05
+    delta = link.connect()
+    link.send(delta, {"cmd": "direct", "val": {"cmd": "ulist_delta", "val": True}})
+    alice = link.connect()
+    bob = link.connect()
+    link.cl.setUsername(alice, "alice")
+    time.sleep(0.2)
+    link.received(delta)
+    link.cl.setUsername(bob, "bob")
+    link.disconnect(alice)
+    time.sleep(0.2)
+    assert ulists(link.received(delta)) == [{"cmd": "ulist_add", "val": "bob;"}, {"cmd": "ulist_remove", "val": "alice;"}]
+
+
+def test_new_client_gets_current_list(link):
+    alice = link.connect()
+    link.cl.setUsername(alice, "alice")
+    client = link.cl.wss.connect(link.cl)
+    assert {"cmd": "ulist", "val": "alice;"} in link.received(client)
+
+
+def test_packet_follows_list_changes(link):
+    # The serialized packet is cached until the next change and rebuilt from the list as it is then
+    alice = link.connect()
+    link.cl.setUsername(alice, "alice")
+    assert link.cl._get_ulist_packet() is link.cl._get_ulist_packet()
+    link.cl._add_username(alice, "alice2")
+    assert link.cl._get_ulist_packet() == '{"cmd": "ulist", "val": "alice2;"}'
@@ -1 +1,2 @@
 from .websocket_server import *
+from .async_websocket_server import AsyncWebsocketServer, AsyncWebSocketHandler
@@ -0,0 +1,412 @@
+# License: MIT
+
+import sys
+import ssl
+import time
+import struct
+import socket
+import asyncio
+import logging
+import threading
+
+from websocket_server.websocket_server import (
+    WebsocketServerBase, WebSocketHandler, MessageAssembler, unmask, encode_message, encode_binary, make_payload_frame, make_close_frame,
+    FIN, RSV1, OPCODE, MASKED, PAYLOAD_LEN, OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY,
+    OPCODE_CLOSE_CONN, OPCODE_PING, OPCODE_PONG, CLOSE_STATUS_NORMAL,
+    DEFAULT_CLOSE_REASON, DEFAULT_SEND_QUEUE_LIMIT, DEFAULT_COMPRESSION_THRESHOLD,
+    DEFAULT_MAX_MESSAGE_SIZE, DEFAULT_MAX_FRAME_SIZE, DEFAULT_PING_TIMEOUT,
+)
+from websocket_server.thread import WebsocketServerThread
+from websocket_server.deflate import PerMessageDeflate
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWebsocketServer(WebsocketServerBase):
+    """
+    A websocket server running all of its clients on one asyncio event loop,
+    instead of one OS thread per connection.
+
+    Takes the same arguments and exposes the same API as WebsocketServer.
+    Callbacks run on the event loop thread, so they should hand long work off
+    to other threads. Sending to a client is safe from any thread.
+
+    A client's send queue is its transport's write buffer, the event loop
+    drains it as the socket becomes writable.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, loglevel=logging.WARNING, key=None, cert=None, send_queue_limit=DEFAULT_SEND_QUEUE_LIMIT,
+                 compression=False, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, compression_context_takeover=False,
+                 max_message_size=DEFAULT_MAX_MESSAGE_SIZE, max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 ping_interval=0, ping_timeout=DEFAULT_PING_TIMEOUT, reuse_port=False):
+        logger.setLevel(loglevel)
+        self.socket = socket.create_server((host, port), reuse_port=reuse_port)
+        self.server_address = self.socket.getsockname()
+        self.host = host
+        self.port = self.server_address[1]
+
+        self.key = key
+        self.cert = cert
+
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self.id_counter = 0
+        self.thread = None
+        self.loop = None
+
+        self.send_queue_limit = send_queue_limit
+        self.evictions = 0
+
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_context_takeover = compression_context_takeover
+        self.max_message_size = max_message_size
+        self.max_frame_size = max_frame_size
+
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.pings_sent = 0
+        self.reaped = 0
+
+        self._deny_clients = False
+        self._server = None
+        self._stop = None
+        self._tasks = set()
+        self._started = threading.Event()
+        self._is_shut_down = threading.Event()
+
+    def _run_forever(self, threaded):
+        cls_name = self.__class__.__name__
+        try:
+            logger.info("Listening on port %d for clients.." % self.port)
+            if threaded:
+                self.thread = WebsocketServerThread(target=self._serve_forever, daemon=True, logger=logger)
+                logger.info(f"Starting {cls_name} on thread {self.thread.name}.")
+                self.thread.start()
+                self._started.wait()
+            else:
+                self.thread = threading.current_thread()
+                logger.info(f"Starting {cls_name} on main thread.")
+                self._serve_forever()
+        except KeyboardInterrupt:
+            self.server_close()
+            logger.info("Server terminated.")
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            sys.exit(1)
+
+    def _serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+            self._is_shut_down.set()
+
+    async def _serve(self):
+        ssl_context = None
+        if self.key and self.cert:
+            try:
+                ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                ssl_context.load_cert_chain(certfile=self.cert, keyfile=self.key)
+            except Exception:
+                ssl_context = None
+                logger.warning("SSL not available (are the paths {} and {} correct for the key and cert?)".format(self.key, self.cert))
+
+        self._stop = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle_connection, sock=self.socket, ssl=ssl_context)
+        heartbeat = None
+        if self.ping_interval:
+            heartbeat = asyncio.create_task(self._heartbeat_loop())
+        self._started.set()
+        await self._stop.wait()
+
+        if heartbeat is not None:
+            heartbeat.cancel()
+        self._server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _heartbeat_loop(self):
+        period = self._heartbeat_period_()
+        while True:
+            await asyncio.sleep(period)
+            try:
+                self._heartbeat_(time.monotonic())
+            except Exception as e:
+                logger.error(str(e), exc_info=True)
+
+    async def _handle_connection(self, reader, writer):
+        handler = AsyncWebSocketHandler(self, reader, writer)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await handler.handle()
+        finally:
+            self._tasks.discard(task)
+
+    def _in_loop(self):
+        return self.thread is not None and threading.get_ident() == self.thread.ident
+
+    def _call_in_loop(self, fn, *args):
+        """
+        Run fn on the event loop thread, right away when already on it
+        """
+        if self._in_loop():
+            fn(*args)
+        elif self.loop is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(fn, *args)
+            except RuntimeError:  # Loop closed in between
+                pass
+
+    def _terminate_client_handler(self, handler):
+        handler.keep_alive = False
+        handler.finish()
+        self._call_in_loop(handler.writer.close)
+
+    def shutdown(self):
+        """
+        Stop the event loop and wait until it has finished
+        """
+        if self.loop is None:
+            return
+        self._call_in_loop(self._stop.set)
+        if not self._in_loop():
+            self._is_shut_down.wait()
+
+    def server_close(self):
+        if self._server is not None:
+            self._call_in_loop(self._server.close)
+        if self._in_loop() or self.loop is None or self.loop.is_closed():
+            self.socket.close()
+        else:
+            self._call_in_loop(self.socket.close)
+
+
+class AsyncWebSocketHandler():
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info('peername')
+        self.keep_alive = True
+        self.handshake_done = False
+        self.valid_client = False
+        self.denied = None
+        self.deflate = None
+        self._message = MessageAssembler()
+        self.max_message_size = None  # None uses the server's limits
+        self.max_frame_size = None
+        self.last_seen = time.monotonic()  # when the client last sent a frame
+        self.ping_sent = None  # when the server sent a ping still unanswered
+        self._finished = False
+
+    async def handle(self):
+        try:
+            await self.handshake()
+            while self.keep_alive and self.valid_client:
+                await self.read_next_message()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info("Client closed connection.")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.keep_alive = False
+            self.finish()
+            # Behind any write another thread already queued, like a CLOSE
+            self.server.loop.call_soon(self.writer.close)
+
+    async def read_next_message(self):
+        b1, b2 = await self.reader.readexactly(2)
+        self.last_seen = time.monotonic()
+
+        fin    = b1 & FIN
+        rsv1   = b1 & RSV1
+        opcode = b1 & OPCODE
+        masked = b2 & MASKED
+        payload_length = b2 & PAYLOAD_LEN
+
+        if opcode == OPCODE_CLOSE_CONN:
+            logger.info("Client asked to close connection.")
+            self.keep_alive = 0
+            return
+        if not masked:
+            logger.warning("Client must always be masked.")
+            self.keep_alive = 0
+            return
+        if opcode in (OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY):
+            opcode_handler = None
+        elif opcode == OPCODE_PING:
+            opcode_handler = self.server._ping_received_
+        elif opcode == OPCODE_PONG:
+            opcode_handler = self.server._pong_received_
+        else:
+            logger.warning("Unknown opcode %#x." % opcode)
+            self.keep_alive = 0
+            return
+
+        if payload_length == 126:
+            payload_length = struct.unpack(">H", await self.reader.readexactly(2))[0]
+        elif payload_length == 127:
+            payload_length = struct.unpack(">Q", await self.reader.readexactly(8))[0]
+
+        # Checked before the payload is read, so a huge length is never buffered
+        status = self._message.check_frame(fin, opcode, rsv1, payload_length, self.deflate, *self.server._size_limits_(self))
+        if status:
+            self._fail(status)
+            return
+
+        masks = await self.reader.readexactly(4)
+        payload = unmask(masks, await self.reader.readexactly(payload_length))
+        if opcode_handler is not None:
+            opcode_handler(self, payload.decode('utf8'))
+            return
+
+        message = self._message.add_frame(fin, opcode, rsv1, payload)
+        if message is not None:
+            status = self.server._data_message_received_(self, *message)
+            if status:
+                self._fail(status)
+
+    def _fail(self, status):
+        """
+        Close the connection because of something the client sent, status
+        is one of the CLOSE codes of RFC 6455 section 7.4.1
+        """
+        self.send_close(status)
+        self.keep_alive = 0
+
+    def send_message(self, message):
+        self.send_text(message)
+
+    def send_binary(self, data):
+        payload = encode_binary(data)
+        if payload is False:
+            return False
+        if self.deflate and self.deflate.wants(payload):
+            self.send_deflated(payload, OPCODE_BINARY)
+        else:
+            self._write(make_payload_frame(payload, OPCODE_BINARY))
+
+    def send_pong(self, message):
+        self.send_text(message, OPCODE_PONG)
+
+    def send_close(self, status=CLOSE_STATUS_NORMAL, reason=DEFAULT_CLOSE_REASON):
+        """
+        Send CLOSE to client
+
+        Args:
+            status: Status as defined in https://datatracker.ietf.org/doc/html/rfc6455#section-7.4.1
+            reason: Text with reason of closing the connection
+        """
+        if status < CLOSE_STATUS_NORMAL or status > 1015:
+            raise Exception(f"CLOSE status must be between 1000 and 1015, got {status}")
+        self._write(make_close_frame(status, reason))
+
+    def send_text(self, message, opcode=OPCODE_TEXT):
+        payload = encode_message(message)
+        if payload is False:
+            return False
+        if opcode == OPCODE_TEXT and self.deflate and self.deflate.wants(payload):
+            self.send_deflated(payload)
+        else:
+            self._write(make_payload_frame(payload, opcode))
+
+    def send_deflated(self, payload, opcode=OPCODE_TEXT):
+        """
+        Compress and write a text or binary message, see PerMessageDeflate
+        """
+        if not self.deflate.context_takeover:
+            self._write(make_payload_frame(self.deflate.compress(payload), opcode, RSV1))
+        else:
+            # On the loop, so the compressor sees the messages in the order they are written
+            self.server._call_in_loop(self._write_deflated_now, payload, opcode)
+
+    def _write_deflated_now(self, payload, opcode):
+        self._write_now(make_payload_frame(self.deflate.compress(payload), opcode, RSV1))
+
+    def send_frame(self, *buffers):
+        if len(buffers) == 1:
+            self._write(buffers[0])
+        else:
+            self._write(b''.join(buffers))
+
+    def _write(self, data):
+        self.server._call_in_loop(self._write_now, data)
+
+    def _write_now(self, data):
+        if self.writer.is_closing():
+            return
+        limit = self.server.send_queue_limit
+        buffered = self.writer.transport.get_write_buffer_size()
+        if limit and buffered and buffered + len(data) > limit:
+            self.server._evict_client_(self)
+            return
+        self.writer.write(data)
+
+    def queued_bytes(self):
+        if self.writer.is_closing():
+            return 0
+        return self.writer.transport.get_write_buffer_size()
+
+    def abort(self):
+        """
+        Drop the connection right away, the reader sees it as closed
+        """
+        self.keep_alive = False
+        self.server._call_in_loop(self.writer.transport.abort)
+
+    async def read_http_headers(self):
+        headers = {}
+        # first line should be HTTP GET
+        http_get = (await self.reader.readline()).decode().strip()
+        assert http_get.upper().startswith('GET')
+        # remaining should be headers
+        while True:
+            header = (await self.reader.readline()).decode().strip()
+            if not header:
+                break
+            head, value = header.split(':', 1)
+            headers[head.lower().strip()] = value.strip()
+        return headers
+
+    async def handshake(self):
+        try:
+            headers = await self.read_http_headers()
+            assert headers['upgrade'].lower() == 'websocket'
+        except (AssertionError, KeyError, ValueError):
+            self.keep_alive = False
+            return
+
+        try:
+            key = headers['sec-websocket-key']
+        except KeyError:
+            logger.warning("Client tried to connect but was missing a key")
+            self.keep_alive = False
+            return
+
+        # patch by meower
+        self.ip = headers.get('cf-connecting-ip', self.client_address[0])
+        # end patch by meower
+
+        extensions = None
+        if self.server.compression and 'sec-websocket-extensions' in headers:
+            self.deflate, extensions = PerMessageDeflate.negotiate(
+                headers['sec-websocket-extensions'], self.server.compression_threshold, self.server.compression_context_takeover)
+
+        # Writes from other threads are queued behind this one on the loop
+        response = WebSocketHandler.make_handshake_response(key, extensions)
+        self.server._add_client_(self)
+        self.writer.write(response.encode())
+        self.handshake_done = True
+        self.valid_client = True
+
+        self.server._new_client_(self)
+
+    def finish(self):
+        if not self._finished:
+            self._finished = True
+            self.server._client_left_(self)
@@ -0,0 +1,161 @@
+# License: MIT
+
+import zlib
+
+'''
+permessage-deflate, https://datatracker.ietf.org/doc/html/rfc7692
+
+A compressed message is sent as a raw DEFLATE stream flushed with
+Z_SYNC_FLUSH, minus the 0x00 0x00 0xff 0xff the flush ends with, and with
+RSV1 set on its first frame. Without context takeover every message is
+compressed on its own, so the same message compresses to the same bytes for
+every client with the same window size and the frame can be shared.
+'''
+
+EXTENSION_NAME = 'permessage-deflate'
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+KNOWN_PARAMS = (
+    'server_no_context_takeover',
+    'client_no_context_takeover',
+    'server_max_window_bits',
+    'client_max_window_bits',
+)
+
+
+def parse_extensions(header):
+    """
+    Split a Sec-WebSocket-Extensions header into a list of (name, params)
+    offers, in the client's order of preference. Params without a value
+    map to None.
+    """
+    offers = []
+    for offer in header.split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            if not part:
+                continue
+            if '=' in part:
+                key, value = part.split('=', 1)
+                params[key.strip().lower()] = value.strip().strip('"')
+            else:
+                params[part.lower()] = None
+        offers.append((parts[0].lower(), params))
+    return offers
+
+
+def parse_window_bits(value):
+    try:
+        bits = int(value)
+    except (TypeError, ValueError):
+        return None
+    # zlib can't make a raw stream with an 8 bit window
+    if 9 <= bits <= 15:
+        return bits
+    return None
+
+
+class PerMessageDeflate():
+    """
+    permessage-deflate as negotiated with one client, plus the compression
+    state that goes with it.
+
+    Args:
+        threshold(int): Messages shorter than this many bytes are sent as they are.
+        context_takeover(bool): Keep the compressor between messages. Compresses
+            better, but costs a compressor per client and the frames can't be
+            shared between clients.
+        client_context_takeover(bool): Whether the client keeps its compressor
+            between messages, and so our decompressor has to be kept too.
+        window_bits(int): Server window size.
+    """
+
+    def __init__(self, threshold, context_takeover=False, client_context_takeover=False, window_bits=15):
+        self.threshold = threshold
+        self.context_takeover = context_takeover
+        self.client_context_takeover = client_context_takeover
+        self.window_bits = window_bits
+        self._compressor = None
+        self._decompressor = None
+        if context_takeover:
+            self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -window_bits)
+        if client_context_takeover:
+            self._decompressor = zlib.decompressobj(-15)
+
+    @classmethod
+    def negotiate(cls, header, threshold, context_takeover):
+        """
+        Pick the first permessage-deflate offer in the client's
+        Sec-WebSocket-Extensions header that we can accept.
+
+        Returns the PerMessageDeflate and the value for our
+        Sec-WebSocket-Extensions response header, or (None, None).
+        """
+        for name, params in parse_extensions(header):
+            if name != EXTENSION_NAME:
+                continue
+            if any(key not in KNOWN_PARAMS for key in params):
+                continue
+            if params.get('server_no_context_takeover', None) is not None:
+                continue
+            if params.get('client_no_context_takeover', None) is not None:
+                continue
+            if 'client_max_window_bits' in params and params['client_max_window_bits'] is not None:
+                if parse_window_bits(params['client_max_window_bits']) is None:
+                    continue
+
+            response = [EXTENSION_NAME]
+            server_takeover = context_takeover and 'server_no_context_takeover' not in params
+            if not server_takeover:
+                response.append('server_no_context_takeover')
+            # The client is free to keep its context unless we ask it not to
+            client_takeover = context_takeover and 'client_no_context_takeover' not in params
+            if not client_takeover:
+                response.append('client_no_context_takeover')
+
+            window_bits = 15
+            if 'server_max_window_bits' in params:
+                window_bits = parse_window_bits(params['server_max_window_bits'])
+                if window_bits is None:
+                    continue
+                response.append('server_max_window_bits=%d' % window_bits)
+
+            return cls(threshold, server_takeover, client_takeover, window_bits), '; '.join(response)
+        return None, None
+
+    def wants(self, payload):
+        """
+        Whether a message of these bytes should be compressed
+        """
+        return len(payload) >= self.threshold
+
+    def compress(self, payload):
+        """
+        Compress one message. With context takeover this has to be called
+        in the order the messages go out.
+        """
+        if self._compressor is not None:
+            data = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -self.window_bits)
+            data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-len(DEFLATE_TAIL)]
+
+    def decompress(self, payload, max_size=0):
+        """
+        Decompress one message from the client. Returns None instead if it
+        inflates to more than max_size bytes, the decompressor can't be used
+        after that.
+        """
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-15)
+        if not max_size:
+            return decompressor.decompress(payload + DEFLATE_TAIL)
+        data = decompressor.decompress(payload + DEFLATE_TAIL, max_size + 1)
+        if len(data) > max_size:
+            return None
+        return data
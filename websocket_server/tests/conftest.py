@@ -11,7 +11,7 @@ if os.getcwd().endswith('tests'):
 	sys.path.insert(0, '..')
 elif os.path.exists('websocket_server'):
 	sys.path.insert(0, '.')
-from websocket_server import WebsocketServer
+from websocket_server import WebsocketServer, AsyncWebsocketServer
 
 
 class TestClient():
@@ -61,12 +61,23 @@ class TestServer(WebsocketServer):
         self.received_messages.append(message)
 
 
+class AsyncTestServer(AsyncWebsocketServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received_messages = []
+        self.set_fn_message_received(self.handle_received_message)
+
+    def handle_received_message(self, client, server, message):
+        self.received_messages.append(message)
+
+
 @pytest.fixture(scope='function')
 def threaded_server():
     """ Returns the response of a server after"""
     server = TestServer(loglevel=logging.DEBUG)
     server.run_forever(threaded=True)
     yield server
+    server.shutdown()
     server.server_close()
 
 
@@ -90,3 +101,23 @@ def client_session(threaded_server):
     assert client.ws.sock and client.ws.sock.connected
     yield client, threaded_server
     client.ws.close()
+
+
+@pytest.fixture(scope='function')
+def async_server():
+    """ Returns an asyncio backed server running on its own thread """
+    server = AsyncTestServer(loglevel=logging.DEBUG)
+    server.run_forever(threaded=True)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def async_session(async_server):
+    """
+    Gives a simple connection to an asyncio backed server
+    """
+    conn = websocket.create_connection("ws://{}:{}".format(*async_server.server_address))
+    yield conn, async_server
+    conn.close()
@@ -0,0 +1,129 @@
+from time import sleep
+import threading
+import socket
+
+import websocket
+import pytest
+
+
+class TestAsyncServerWithoutClient():
+    def test_run_forever(self, async_server):
+        assert async_server.thread
+        assert not isinstance(async_server.thread, threading._MainThread)
+        assert async_server.thread.is_alive()
+
+    def test_attributes(self, async_server):
+        tpl = async_server.server_address
+        assert async_server.port == tpl[1]
+        assert async_server.host == tpl[0]
+
+    def test_shutdown_gracefully_without_clients(self, async_server):
+        assert async_server.thread.is_alive()
+        async_server.shutdown_gracefully()
+        async_server.thread.join(1)
+        assert not async_server.thread.is_alive()
+        assert async_server.socket.fileno() <= 0
+
+
+class TestAsyncServerWithClient():
+    @pytest.mark.parametrize("length", [1, 125, 126, 127, 65535, 65536, 1500000])
+    def test_send_message_to_all(self, async_session, length):
+        conn, server = async_session
+        msg = 'a' * (length - 1) + '^'
+        server.send_message_to_all(msg)
+        assert conn.recv() == msg
+
+    def test_send_message_from_other_thread(self, async_session):
+        conn, server = async_session
+        thread = threading.Thread(target=server.send_message, args=(server.clients[0], '$äüö^'))
+        thread.start()
+        thread.join()
+        assert conn.recv() == '$äüö^'
+
+    def test_message_received(self, async_session):
+        conn, server = async_session
+        conn.send('hello')
+        conn.send('b' * 70000)
+        sleep(0.5)
+        assert server.received_messages == ['hello', 'b' * 70000]
+
+    def test_ping(self, async_session):
+        conn, server = async_session
+        conn.ping('are you there')
+        opcode, frame = conn.recv_data_frame(control_frame=True)
+        assert opcode == websocket.ABNF.OPCODE_PONG
+        assert frame.data == b'are you there'
+
+    def test_client_closes_gracefully(self, async_session):
+        conn, server = async_session
+        assert server.clients
+        conn.close()
+        sleep(0.5)
+        assert not server.clients
+
+    def test_disconnect_clients_gracefully(self, async_session):
+        conn, server = async_session
+        server.disconnect_clients_gracefully()
+        assert not server.clients
+        opcode, frame = conn.recv_data_frame(control_frame=True)
+        assert opcode == websocket.ABNF.OPCODE_CLOSE
+
+    def test_disconnect_right_after_handshake(self, async_server):
+        url = "ws://{}:{}".format(*async_server.server_address)
+        for _ in range(20):
+            conn = websocket.create_connection(url)
+            async_server.disconnect_clients_gracefully()
+            opcode, frame = conn.recv_data_frame(control_frame=True)
+            assert opcode == websocket.ABNF.OPCODE_CLOSE
+            conn.close()
+
+    def test_send_message_to_many(self, async_server):
+        url = "ws://{}:{}".format(*async_server.server_address)
+        conns = [websocket.create_connection(url) for i in range(3)]
+        async_server.send_message_to_many(async_server.clients[1:], "to many")
+        assert conns[1].recv() == "to many"
+        assert conns[2].recv() == "to many"
+        conns[0].settimeout(0.2)
+        with pytest.raises(websocket.WebSocketTimeoutException):
+            conns[0].recv()
+        for conn in conns:
+            conn.close()
+
+    def test_slow_client_is_disconnected(self, async_server):
+        url = "ws://{}:{}".format(*async_server.server_address)
+        async_server.send_queue_limit = 256 * 1024
+        slow = websocket.create_connection(url, sockopt=((socket.SOL_SOCKET, socket.SO_RCVBUF, 4096),))
+        fast = websocket.create_connection(url)
+
+        # The broadcasts must not wait for the client that never reads
+        msg = 'a' * 65536
+        for i in range(250):
+            async_server.send_message_to_all(msg)
+            assert fast.recv() == msg
+            if async_server.get_send_queue_stats()["evictions"]:
+                break
+
+        for i in range(50):
+            if len(async_server.clients) == 1:
+                break
+            sleep(0.1)
+        assert len(async_server.clients) == 1
+        stats = async_server.get_send_queue_stats()
+        assert stats["evictions"] == 1
+        assert stats["clients"] == 1
+        async_server.send_message_to_all("still here")
+        assert fast.recv() == "still here"
+        slow.close()
+        fast.close()
+
+    def test_deny_new_connections(self, async_server):
+        url = "ws://{}:{}".format(*async_server.server_address)
+        async_server.deny_new_connections(status=1013, reason=b"Please try re-connecting later")
+        conn = websocket.create_connection(url)
+        sleep(0.2)
+        assert not async_server.clients
+
+        async_server.allow_new_connections()
+        conn = websocket.create_connection(url)
+        sleep(0.2)
+        assert len(async_server.clients) == 1
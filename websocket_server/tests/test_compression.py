@@ -0,0 +1,248 @@
+from time import sleep
+from base64 import b64encode
+import os
+import json
+import zlib
+import socket
+import struct
+
+import pytest
+
+from websocket_server.deflate import PerMessageDeflate, parse_extensions
+
+
+TAIL = b'\x00\x00\xff\xff'
+MESSAGE = json.dumps({"cmd": "direct", "val": {"mode": 1, "p": "Hello, world! " * 40}})
+
+
+def connect(server, extensions=None):
+    """
+    A raw client, websocket-client does not speak permessage-deflate
+    """
+    sock = socket.create_connection(server.server_address[:2])
+    request = 'GET / HTTP/1.1\r\n'\
+              'Host: localhost\r\n'\
+              'Upgrade: websocket\r\n'\
+              'Connection: Upgrade\r\n'\
+              'Sec-WebSocket-Key: %s\r\n'\
+              'Sec-WebSocket-Version: 13\r\n' % b64encode(os.urandom(16)).decode()
+    if extensions:
+        request += 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+    sock.sendall((request + '\r\n').encode())
+
+    rfile = sock.makefile('rb')
+    assert rfile.readline().startswith(b'HTTP/1.1 101')
+    headers = {}
+    while True:
+        header = rfile.readline().decode().strip()
+        if not header:
+            break
+        head, value = header.split(':', 1)
+        headers[head.lower().strip()] = value.strip()
+    return sock, rfile, headers
+
+
+def read_frame(rfile):
+    b1, b2 = rfile.read(2)
+    length = b2 & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', rfile.read(8))[0]
+    return b1, rfile.read(length)
+
+
+def send_frame(sock, payload, rsv1=False, opcode=0x1, fin=True):
+    mask = os.urandom(4)
+    header = bytearray([(0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode])
+    if len(payload) <= 125:
+        header.append(0x80 | len(payload))
+    else:
+        header.append(0x80 | 126)
+        header.extend(struct.pack('>H', len(payload)))
+    masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    sock.sendall(bytes(header) + mask + masked)
+
+
+def deflate(payload):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return (compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(TAIL)]
+
+
+def inflate(payload, decompressor=None):
+    if decompressor is None:
+        decompressor = zlib.decompressobj(-15)
+    return decompressor.decompress(payload + TAIL)
+
+
+@pytest.fixture(params=['threaded_server', 'async_server'])
+def server(request):
+    server = request.getfixturevalue(request.param)
+    server.compression = True
+    return server
+
+
+def test_parse_extensions():
+    header = 'permessage-deflate; client_max_window_bits; server_max_window_bits="10", x-webkit-deflate-frame'
+    assert parse_extensions(header) == [
+        ('permessage-deflate', {'client_max_window_bits': None, 'server_max_window_bits': '10'}),
+        ('x-webkit-deflate-frame', {}),
+    ]
+
+
+def test_negotiate_without_context_takeover():
+    deflate, response = PerMessageDeflate.negotiate('permessage-deflate; client_max_window_bits', 256, False)
+    assert response == 'permessage-deflate; server_no_context_takeover; client_no_context_takeover'
+    assert not deflate.context_takeover
+    assert not deflate.client_context_takeover
+    assert deflate.window_bits == 15
+
+
+def test_negotiate_with_context_takeover():
+    deflate, response = PerMessageDeflate.negotiate('permessage-deflate', 256, True)
+    assert response == 'permessage-deflate'
+    assert deflate.context_takeover
+    assert deflate.client_context_takeover
+
+    # The client can always opt out for the server
+    deflate, response = PerMessageDeflate.negotiate('permessage-deflate; server_no_context_takeover', 256, True)
+    assert response == 'permessage-deflate; server_no_context_takeover'
+    assert not deflate.context_takeover
+    assert deflate.client_context_takeover
+
+
+def test_negotiate_window_bits():
+    deflate, response = PerMessageDeflate.negotiate('permessage-deflate; server_max_window_bits=10', 256, False)
+    assert response.endswith('; server_max_window_bits=10')
+    assert deflate.window_bits == 10
+
+
+def test_negotiate_skips_offers_it_can_not_accept():
+    header = 'permessage-deflate; server_max_window_bits=8, permessage-deflate; unknown, permessage-deflate'
+    deflate, response = PerMessageDeflate.negotiate(header, 256, False)
+    assert deflate.window_bits == 15
+    assert PerMessageDeflate.negotiate('permessage-deflate; server_max_window_bits=8', 256, False) == (None, None)
+    assert PerMessageDeflate.negotiate('x-webkit-deflate-frame', 256, False) == (None, None)
+
+
+def test_not_negotiated_when_disabled(threaded_server):
+    sock, rfile, headers = connect(threaded_server, 'permessage-deflate')
+    assert 'sec-websocket-extensions' not in headers
+    threaded_server.send_message_to_all(MESSAGE)
+    b1, payload = read_frame(rfile)
+    assert not b1 & 0x40
+    assert payload.decode() == MESSAGE
+    sock.close()
+
+
+def test_compressed_message(server):
+    sock, rfile, headers = connect(server, 'permessage-deflate')
+    assert headers['sec-websocket-extensions'] == 'permessage-deflate; server_no_context_takeover; client_no_context_takeover'
+    server.send_message(server.clients[0], MESSAGE)
+    b1, payload = read_frame(rfile)
+    assert b1 & 0x40
+    assert len(payload) < len(MESSAGE)
+    assert inflate(payload).decode() == MESSAGE
+    sock.close()
+
+
+def test_message_below_threshold_is_not_compressed(server):
+    sock, rfile, headers = connect(server, 'permessage-deflate')
+    server.send_message_to_all('short')
+    b1, payload = read_frame(rfile)
+    assert not b1 & 0x40
+    assert payload == b'short'
+    sock.close()
+
+
+def test_compressed_message_from_client(server):
+    sock, rfile, headers = connect(server, 'permessage-deflate')
+    send_frame(sock, deflate(MESSAGE.encode()), rsv1=True)
+    send_frame(sock, b'plain')
+    sleep(0.5)
+    assert server.received_messages == [MESSAGE, 'plain']
+    sock.close()
+
+
+def test_compressed_fragmented_message_from_client(server):
+    sock, rfile, headers = connect(server, 'permessage-deflate')
+    data = deflate(MESSAGE.encode())
+    # RSV1 only on the first frame, the message is inflated after reassembly
+    send_frame(sock, data[:10], rsv1=True, fin=False)
+    send_frame(sock, data[10:], opcode=0x0)
+    sleep(0.5)
+    assert server.received_messages == [MESSAGE]
+    sock.close()
+
+
+def test_compressed_message_too_big(server):
+    server.max_message_size = 1000
+    sock, rfile, headers = connect(server, 'permessage-deflate')
+    send_frame(sock, deflate(b'a' * 5000), rsv1=True)
+    b1, payload = read_frame(rfile)
+    assert b1 & 0x0f == 0x8
+    assert struct.unpack('!H', payload[:2])[0] == 1009
+    sleep(0.2)
+    assert server.received_messages == []
+    sock.close()
+
+
+def test_broadcast_is_compressed_once(server, monkeypatch):
+    calls = []
+    compress = PerMessageDeflate.compress
+    def counting_compress(self, payload):
+        calls.append(payload)
+        return compress(self, payload)
+    monkeypatch.setattr(PerMessageDeflate, 'compress', counting_compress)
+
+    conns = [connect(server, 'permessage-deflate') for i in range(3)]
+    plain = connect(server)
+    server.send_message_to_all(MESSAGE)
+    payloads = set()
+    for sock, rfile, headers in conns:
+        b1, payload = read_frame(rfile)
+        assert b1 & 0x40
+        payloads.add(payload)
+    assert len(calls) == 1
+    assert len(payloads) == 1
+    assert inflate(payloads.pop()).decode() == MESSAGE
+    assert read_frame(plain[1])[1].decode() == MESSAGE
+    for sock, rfile, headers in conns + [plain]:
+        sock.close()
+
+
+def test_context_takeover(server):
+    server.compression_context_takeover = True
+    sock, rfile, headers = connect(server, 'permessage-deflate')
+    assert headers['sec-websocket-extensions'] == 'permessage-deflate'
+    decompressor = zlib.decompressobj(-15)
+    server.send_message_to_all(MESSAGE)
+    server.send_message_to_all(MESSAGE)
+    first = read_frame(rfile)[1]
+    second = read_frame(rfile)[1]
+    # The second copy is mostly a back reference into the first one
+    assert len(second) < len(first)
+    assert inflate(first, decompressor).decode() == MESSAGE
+    assert inflate(second, decompressor).decode() == MESSAGE
+    sock.close()
+
+
+def test_rsv1_without_compression_closes(server):
+    sock, rfile, headers = connect(server)
+    send_frame(sock, deflate(MESSAGE.encode()), rsv1=True)
+    sleep(0.5)
+    assert server.received_messages == []
+    assert not server.clients
+    sock.close()
+
+
+def test_compressed_binary_message(server):
+    conns = [connect(server, 'permessage-deflate') for i in range(2)]
+    data = bytes(range(256)) * 4
+    server.send_binary_to_many(server.clients, data)
+    for sock, rfile, headers in conns:
+        b1, payload = read_frame(rfile)
+        assert b1 & 0x40
+        assert b1 & 0x0f == 0x2
+        assert inflate(payload) == data
+        sock.close()
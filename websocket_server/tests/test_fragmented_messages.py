@@ -0,0 +1,165 @@
+from time import sleep
+import struct
+
+import websocket
+from websocket import ABNF
+import pytest
+
+from websocket_server import MessageAssembler, OPCODE_TEXT, OPCODE_CONTINUATION
+
+
+@pytest.fixture(params=['session', 'async_session'])
+def any_session(request):
+    """
+    A connection to each of the server backends
+    """
+    return request.getfixturevalue(request.param)
+
+
+def received_binary(server):
+    messages = []
+    server.set_fn_message_received_binary(lambda client, server, message: messages.append(message))
+    return messages
+
+
+def close_status(conn):
+    opcode, frame = conn.recv_data_frame(control_frame=True)
+    assert opcode == ABNF.OPCODE_CLOSE
+    return struct.unpack('!H', frame.data[:2])[0]
+
+
+def test_unfragmented_message_is_not_copied():
+    assembler = MessageAssembler()
+    payload = b'hello'
+    assert assembler.add_frame(True, OPCODE_TEXT, 0, payload)[2] is payload
+
+
+def test_fragments_are_joined():
+    assembler = MessageAssembler()
+    assert assembler.add_frame(False, OPCODE_TEXT, 0, b'hel') is None
+    assert assembler.add_frame(False, OPCODE_CONTINUATION, 0, b'lo') is None
+    assert assembler.add_frame(True, OPCODE_CONTINUATION, 0, b'!') == (OPCODE_TEXT, False, b'hello!')
+    assert assembler.opcode is None
+    assert assembler.chunks == []
+
+
+def test_fragmented_text_message(any_session):
+    conn, server = any_session
+    conn.send_frame(ABNF.create_frame("hel", ABNF.OPCODE_TEXT, fin=0))
+    # Control frames may come in between the fragments
+    conn.ping("in between")
+    conn.send_frame(ABNF.create_frame("lo, ", ABNF.OPCODE_CONT, fin=0))
+    conn.send_frame(ABNF.create_frame("world", ABNF.OPCODE_CONT, fin=1))
+    conn.send("next")
+    sleep(0.5)
+    assert server.received_messages == ['hello, world', 'next']
+
+
+def test_utf8_split_between_fragments(any_session):
+    conn, server = any_session
+    data = '$äüö^'.encode()
+    conn.send_frame(ABNF.create_frame(data[:2], ABNF.OPCODE_TEXT, fin=0))
+    conn.send_frame(ABNF.create_frame(data[2:], ABNF.OPCODE_CONT, fin=1))
+    sleep(0.5)
+    assert server.received_messages == ['$äüö^']
+
+
+def test_binary_message(any_session):
+    conn, server = any_session
+    messages = received_binary(server)
+    conn.send_binary(b'\x00\x01\xfe\xff')
+    conn.send("text")
+    sleep(0.5)
+    assert messages == [b'\x00\x01\xfe\xff']
+    assert server.received_messages == ['text']
+
+
+def test_fragmented_binary_message(any_session):
+    conn, server = any_session
+    messages = received_binary(server)
+    conn.send_frame(ABNF.create_frame(b'\x00' * 70000, ABNF.OPCODE_BINARY, fin=0))
+    conn.send_frame(ABNF.create_frame(b'\xff' * 10, ABNF.OPCODE_CONT, fin=1))
+    sleep(0.5)
+    assert messages == [b'\x00' * 70000 + b'\xff' * 10]
+
+
+def test_message_too_big(any_session):
+    conn, server = any_session
+    server.max_message_size = 1000
+    conn.send('a' * 1000)
+    conn.send_frame(ABNF.create_frame('a' * 600, ABNF.OPCODE_TEXT, fin=0))
+    conn.send_frame(ABNF.create_frame('a' * 600, ABNF.OPCODE_CONT, fin=1))
+    assert close_status(conn) == 1009
+    sleep(0.2)
+    assert server.received_messages == ['a' * 1000]
+    assert not server.clients
+
+
+def test_frame_too_big(any_session):
+    conn, server = any_session
+    server.max_frame_size = 500
+    conn.send_frame(ABNF.create_frame('a' * 400, ABNF.OPCODE_TEXT, fin=0))
+    conn.send_frame(ABNF.create_frame('a' * 400, ABNF.OPCODE_CONT, fin=1))
+    conn.send('a' * 501)
+    assert close_status(conn) == 1009
+    sleep(0.2)
+    assert server.received_messages == ['a' * 800]
+    assert not server.clients
+
+
+def test_frame_too_big_is_not_read():
+    assembler = MessageAssembler()
+    # Only the header has been read, the payload would be 8 GiB
+    assert assembler.check_frame(True, OPCODE_TEXT, 0, 1 << 33, None, 1024, 0) == 1009
+    assert assembler.check_frame(True, OPCODE_TEXT, 0, 1024, None, 1024, 0) is None
+
+
+def test_client_size_limits(any_session):
+    conn, server = any_session
+    client = server.clients[0]
+    server.set_client_size_limits(client, max_message_size=100)
+    conn.send('a' * 100)
+    conn.send('a' * 101)
+    assert close_status(conn) == 1009
+    sleep(0.2)
+    assert server.received_messages == ['a' * 100]
+    server.set_client_size_limits(client)
+    assert server._size_limits_(client['handler']) == (server.max_frame_size, server.max_message_size)
+
+
+def test_continuation_without_message(any_session):
+    conn, server = any_session
+    conn.send_frame(ABNF.create_frame("lost", ABNF.OPCODE_CONT, fin=1))
+    assert close_status(conn) == 1002
+    sleep(0.2)
+    assert server.received_messages == []
+
+
+def test_new_message_inside_fragmented_message(any_session):
+    conn, server = any_session
+    conn.send_frame(ABNF.create_frame("first", ABNF.OPCODE_TEXT, fin=0))
+    conn.send_frame(ABNF.create_frame("second", ABNF.OPCODE_TEXT, fin=1))
+    assert close_status(conn) == 1002
+    sleep(0.2)
+    assert server.received_messages == []
+
+
+def test_invalid_utf8(any_session):
+    conn, server = any_session
+    conn.send_frame(ABNF.create_frame(b'\xff\xfe', ABNF.OPCODE_TEXT, fin=1))
+    assert close_status(conn) == 1007
+
+
+def test_send_binary(any_session):
+    conn, server = any_session
+    server.send_binary(server.clients[0], b'\x00\x01\xfe\xff')
+    server.send_binary_to_many(server.clients, bytearray(b'\x80' * 300))
+    assert conn.recv_data() == (ABNF.OPCODE_BINARY, b'\x00\x01\xfe\xff')
+    assert conn.recv_data() == (ABNF.OPCODE_BINARY, b'\x80' * 300)
+
+
+def test_send_binary_refuses_text(any_session):
+    conn, server = any_session
+    server.send_binary(server.clients[0], 'not bytes')
+    server.send_message(server.clients[0], 'next')
+    assert conn.recv_data() == (ABNF.OPCODE_TEXT, b'next')
@@ -0,0 +1,120 @@
+import socket
+import os
+
+from websocket_server import FrameReader
+
+
+class ChunkedSocket():
+    """
+    Hands out a byte string a few bytes per recv, counting the calls
+    """
+
+    def __init__(self, data, chunk=4096):
+        self.data = data
+        self.chunk = chunk
+        self.recvs = 0
+
+    def recv_into(self, buffer):
+        self.recvs += 1
+        size = min(len(buffer), self.chunk, len(self.data))
+        buffer[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+
+def test_small_reads_share_a_recv():
+    sock = ChunkedSocket(bytes(range(200)))
+    reader = FrameReader(sock)
+    assert bytes(reader.read(2)) == bytes([0, 1])
+    assert bytes(reader.read(4)) == bytes([2, 3, 4, 5])
+    assert bytes(reader.read(100)) == bytes(range(6, 106))
+    assert sock.recvs == 1
+
+
+def test_read_across_recvs():
+    data = os.urandom(1000)
+    sock = ChunkedSocket(data, chunk=7)
+    reader = FrameReader(sock, size=64)
+    out = b''
+    for size in (3, 50, 64, 1, 64, 500, 318):
+        out += bytes(reader.read(size))
+    assert out == data
+
+
+def test_read_larger_than_buffer():
+    data = os.urandom(100000)
+    reader = FrameReader(ChunkedSocket(b'ab' + data + b'cd'), size=1024)
+    assert bytes(reader.read(2)) == b'ab'
+    assert bytes(reader.read(len(data))) == data
+    assert bytes(reader.read(2)) == b'cd'
+
+
+def test_short_read_when_closed():
+    reader = FrameReader(ChunkedSocket(b'abc'))
+    assert bytes(reader.read(2)) == b'ab'
+    assert bytes(reader.read(4)) == b'c'
+    assert bytes(reader.read(4)) == b''
+    assert bytes(FrameReader(ChunkedSocket(b'abc'), size=2).read(10)) == b'abc'
+
+
+def test_buffered_frames_come_with_their_payload():
+    frames = b'\x81\x83abcdXYZ' + b'\x89\x80abcd'
+    sock = ChunkedSocket(frames)
+    reader = FrameReader(sock)
+    b1, b2, length, masks, payload = reader.read_frame()
+    assert (b1, b2, length, masks, bytes(payload)) == (0x81, 0x83, 3, b'abcd', b'XYZ')
+    b1, b2, length, masks, payload = reader.read_frame()
+    assert (b1, b2, length, masks, bytes(payload)) == (0x89, 0x80, 0, b'abcd', b'')
+    assert sock.recvs == 1
+    assert reader.read_frame() is None
+
+
+def test_buffered_16_bit_length_frame_comes_with_its_payload():
+    reader = FrameReader(ChunkedSocket(b'\x82\xfe\x01\x00abcd' + b'x' * 256))
+    b1, b2, length, masks, payload = reader.read_frame()
+    assert (b1, b2, length, masks, bytes(payload)) == (0x82, 0xfe, 256, b'abcd', b'x' * 256)
+
+
+def test_payload_is_left_to_the_caller():
+    # Frames that aren't in yet are only read once the header was checked
+    reader = FrameReader(ChunkedSocket(b'\x82\xfe\x01\x00abcd' + b'x' * 256, chunk=100))
+    assert reader.read_frame() == (0x82, 0xfe, 256, b'abcd', None)
+    assert bytes(reader.read(256)) == b'x' * 256
+    reader = FrameReader(ChunkedSocket(b'\x81\x85abcdXY' + b'Z', chunk=8))
+    assert reader.read_frame() == (0x81, 0x85, 5, b'abcd', None)
+    assert bytes(reader.read(5)) == b'XY' + b'Z'
+
+
+def test_64_bit_length_and_unmasked_header():
+    reader = FrameReader(ChunkedSocket(b'\x82\xff' + (1 << 40).to_bytes(8, 'big') + b'abcd'))
+    assert reader.read_frame() == (0x82, 0xff, 1 << 40, b'abcd', None)
+    reader = FrameReader(ChunkedSocket(b'\x81\x03abc'))
+    assert reader.read_frame() == (0x81, 0x03, 3, None, None)
+
+
+def test_truncated_header():
+    assert FrameReader(ChunkedSocket(b'\x81')).read_frame() is None
+    assert FrameReader(ChunkedSocket(b'\x81\xfe\x01')).read_frame() is None
+    assert FrameReader(ChunkedSocket(b'\x81\x83ab')).read_frame() is None
+
+
+def test_readline_leaves_the_rest_buffered():
+    sock = ChunkedSocket(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n\x81\x80', chunk=5)
+    reader = FrameReader(sock, size=16)
+    assert reader.readline() == b'GET / HTTP/1.1\r\n'
+    assert reader.readline() == b'Host: x\r\n'
+    assert reader.readline() == b'\r\n'
+    assert bytes(reader.read(2)) == b'\x81\x80'
+    assert reader.readline() == b''
+
+
+def test_reads_from_a_socket():
+    a, b = socket.socketpair()
+    try:
+        a.sendall(b'\x89\x80' * 100)
+        reader = FrameReader(b)
+        for i in range(100):
+            assert bytes(reader.read(2)) == b'\x89\x80'
+    finally:
+        a.close()
+        b.close()
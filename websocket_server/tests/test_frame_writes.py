@@ -0,0 +1,70 @@
+import socket
+
+import pytest
+import websocket
+
+from websocket_server import (
+    encode_message, encode_binary, make_payload_frame, make_frame_parts, make_frame_header, OPCODE_TEXT, OPCODE_BINARY, RSV1,
+)
+
+
+@pytest.fixture(params=['session', 'async_session'])
+def any_session(request):
+    return request.getfixturevalue(request.param)
+
+
+def test_encoded_bytes_are_sent_as_they_are():
+    payload = '{"cmd": "ping"}'.encode()
+    assert encode_message(payload) is payload
+    assert encode_message('äö'.encode()) == 'äö'.encode()
+    assert encode_message(b'') == b''
+    assert encode_message(b'\xff\xfe') is False
+    assert encode_message(42) is False
+
+
+def test_memoryview_is_not_copied():
+    data = bytearray(b'hello')
+    view = memoryview(data)
+    assert encode_binary(view).obj is data
+    assert bytes(encode_message(view)) == b'hello'
+    assert encode_message(memoryview(b'\xff')) is False
+
+
+def test_frame_parts_match_frame():
+    for length in (0, 125, 126, 65535, 65536):
+        payload = b'a' * length
+        header, body = make_frame_parts(payload, OPCODE_BINARY, RSV1)
+        assert body is payload
+        assert header + body == make_payload_frame(payload, OPCODE_BINARY, RSV1)
+        assert header == make_frame_header(OPCODE_BINARY, length, RSV1)
+
+
+def test_queued_frames_are_gathered(session):
+    conn, server = session
+    messages = ['a' * 10, 'b' * 200, 'c' * 70000, '']
+    for message in messages:
+        server.send_message_to_all(message)
+    for message in messages:
+        assert conn.recv() == message
+
+
+def test_large_frames_survive_partial_sends(threaded_server):
+    url = "ws://{}:{}".format(*threaded_server.server_address)
+    conn = websocket.create_connection(url, sockopt=((socket.SOL_SOCKET, socket.SO_RCVBUF, 4096),))
+    try:
+        messages = [bytes([i]) * 300000 for i in range(5)]
+        for message in messages:
+            threaded_server.send_binary_to_many(threaded_server.clients, message)
+        for message in messages:
+            assert conn.recv() == message
+    finally:
+        conn.close()
+
+
+def test_bytes_and_memoryview_messages(any_session):
+    conn, server = any_session
+    client = server.clients[0]
+    server.send_message(client, 'ünïcode'.encode())
+    server.send_binary(client, memoryview(b'\x00\x01\x02'))
+    assert conn.recv() == 'ünïcode'
+    assert conn.recv() == b'\x00\x01\x02'
@@ -15,3 +15,16 @@ def test_response_messages():
 		'\r\n'
 	handshake_content = WebSocketHandler.make_handshake_response(key)
 	assert handshake_content == expected
+
+
+def test_response_messages_with_extensions():
+	key = 'zyjFH2rQwrTtNFk5lwEMQg=='
+	expected = \
+		'HTTP/1.1 101 Switching Protocols\r\n'\
+		'Upgrade: websocket\r\n'              \
+		'Connection: Upgrade\r\n'             \
+		'Sec-WebSocket-Accept: 2hnZADGmT/V1/w1GJYBtttUKASY=\r\n'\
+		'Sec-WebSocket-Extensions: permessage-deflate; server_no_context_takeover\r\n'\
+		'\r\n'
+	handshake_content = WebSocketHandler.make_handshake_response(key, 'permessage-deflate; server_no_context_takeover')
+	assert handshake_content == expected
@@ -0,0 +1,108 @@
+from time import sleep, monotonic
+import logging
+
+import websocket
+import pytest
+
+from websocket_server import WebsocketServer, AsyncWebsocketServer
+
+
+@pytest.fixture(params=[WebsocketServer, AsyncWebsocketServer], ids=["threaded", "asyncio"])
+def pinging_server(request):
+    server = request.param(loglevel=logging.DEBUG, ping_interval=0.2, ping_timeout=0.3)
+    server.left = []
+    server.set_fn_client_left(lambda client, server: server.left.append(client['id']))
+    server.run_forever(threaded=True)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition() and monotonic() < deadline:
+        sleep(0.05)
+    return condition()
+
+
+def test_dead_client_is_disconnected(pinging_server):
+    server = pinging_server
+    # Never reads, so it never sees the pings and never answers them
+    conn = websocket.create_connection("ws://{}:{}".format(*server.server_address))
+    assert wait_for(lambda: server.left)
+    assert server.left == [1]
+    assert not server.clients
+    stats = server.get_heartbeat_stats()
+    assert stats["pings_sent"] >= 1
+    assert stats["reaped"] == 1
+    conn.close()
+
+
+def test_client_answering_pings_stays(pinging_server):
+    server = pinging_server
+    conn = websocket.create_connection("ws://{}:{}".format(*server.server_address))
+    for i in range(3):
+        # websocket-client answers the ping with a pong on its own
+        opcode, frame = conn.recv_data_frame(control_frame=True)
+        assert opcode == websocket.ABNF.OPCODE_PING
+    sleep(0.4)
+    assert len(server.clients) == 1
+    assert server.get_heartbeat_stats()["reaped"] == 0
+    conn.close()
+
+
+def test_heartbeat_schedule(threaded_server):
+    server = threaded_server
+    server.ping_interval = 10
+    server.ping_timeout = 5
+    conn = websocket.create_connection("ws://{}:{}".format(*server.server_address))
+    conn.settimeout(1)
+    handler = server.clients[0]['handler']
+    start = handler.last_seen
+
+    # Quiet for less than the interval
+    server._heartbeat_(start + 9)
+    assert handler.ping_sent is None
+
+    server._heartbeat_(start + 10)
+    assert handler.ping_sent == start + 10
+    # Read off the socket, websocket-client would answer it on its own
+    assert conn.sock.recv(2) == bytes([0x80 | websocket.ABNF.OPCODE_PING, 0])
+    assert server.pings_sent == 1
+
+    # Waiting for the answer, the ping isn't repeated
+    server._heartbeat_(start + 14)
+    assert server.pings_sent == 1
+
+    # Anything the client sends counts as an answer
+    conn.send("still here")
+    assert wait_for(lambda: server.received_messages)
+    handler.last_seen = start + 14  # As if it had arrived then
+    server._heartbeat_(start + 16)
+    assert server.reaped == 0
+    assert server.clients
+
+    # Quiet again after its last message, pinged and never answers
+    server._heartbeat_(start + 24)
+    assert handler.ping_sent == start + 24
+    server._heartbeat_(start + 28)
+    assert server.reaped == 0
+    server._heartbeat_(start + 29)
+    assert server.reaped == 1
+    assert wait_for(lambda: not server.clients)
+    conn.close()
+
+
+def test_pong_clears_ping(threaded_server):
+    server = threaded_server
+    conn = websocket.create_connection("ws://{}:{}".format(*server.server_address))
+    handler = server.clients[0]['handler']
+    handler.ping_sent = monotonic()
+    conn.pong("")
+    assert wait_for(lambda: handler.ping_sent is None)
+    conn.close()
+
+
+def test_no_heartbeat_by_default(threaded_server):
+    assert threaded_server.ping_interval == 0
+    assert threaded_server._heartbeat is None
@@ -0,0 +1,38 @@
+import socket
+import logging
+
+import websocket
+import pytest
+
+from websocket_server import WebsocketServer, AsyncWebsocketServer
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="needs SO_REUSEPORT")
+@pytest.mark.parametrize("server_class", [WebsocketServer, AsyncWebsocketServer])
+def test_servers_share_a_port(server_class):
+    first = server_class(loglevel=logging.DEBUG, reuse_port=True)
+    second = server_class(port=first.port, loglevel=logging.DEBUG, reuse_port=True)
+    servers = [first, second]
+    try:
+        for server in servers:
+            server.run_forever(threaded=True)
+        conns = [websocket.create_connection("ws://127.0.0.1:{}".format(first.port)) for i in range(8)]
+        assert len(first.clients) + len(second.clients) == 8
+        for server in servers:
+            server.send_message_to_all("hello")
+        for conn in conns:
+            assert conn.recv() == "hello"
+            conn.close()
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def test_port_is_not_shared_by_default():
+    first = WebsocketServer()
+    try:
+        with pytest.raises(OSError):
+            WebsocketServer(port=first.port)
+    finally:
+        first.server_close()
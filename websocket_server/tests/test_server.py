@@ -1,5 +1,6 @@
 from time import sleep
 import threading
+import socket
 
 import websocket
 import pytest
@@ -142,6 +143,60 @@ class TestServerThreadedWithClient():
                 client.send("test")
                 sleep(0.2)
 
+    def test_send_message_to_many(self, threaded_server):
+        url = "ws://{}:{}".format(*threaded_server.server_address)
+        conns = [websocket.create_connection(url) for i in range(3)]
+        receivers = threaded_server.clients[:2]
+        threaded_server.send_message_to_many(receivers, "to many")
+        assert conns[0].recv() == "to many"
+        assert conns[1].recv() == "to many"
+        conns[2].settimeout(0.2)
+        with pytest.raises(websocket.WebSocketTimeoutException):
+            conns[2].recv()
+        for conn in conns:
+            conn.close()
+
+    def test_slow_client_is_disconnected(self, threaded_server):
+        url = "ws://{}:{}".format(*threaded_server.server_address)
+        threaded_server.send_queue_limit = 256 * 1024
+        slow = websocket.create_connection(url, sockopt=((socket.SOL_SOCKET, socket.SO_RCVBUF, 4096),))
+        fast = websocket.create_connection(url)
+
+        # The broadcasts must not wait for the client that never reads
+        msg = 'a' * 65536
+        for i in range(250):
+            threaded_server.send_message_to_all(msg)
+            assert fast.recv() == msg
+            if threaded_server.get_send_queue_stats()["evictions"]:
+                break
+
+        for i in range(50):
+            if len(threaded_server.clients) == 1:
+                break
+            sleep(0.1)
+        assert len(threaded_server.clients) == 1
+        stats = threaded_server.get_send_queue_stats()
+        assert stats["evictions"] == 1
+        assert stats["clients"] == 1
+        threaded_server.send_message_to_all("still here")
+        assert fast.recv() == "still here"
+        slow.close()
+        fast.close()
+
+    def test_one_writer_thread_for_all_clients(self, threaded_server):
+        url = "ws://{}:{}".format(*threaded_server.server_address)
+        conns = [websocket.create_connection(url)]
+        threads = threading.active_count()
+        conns += [websocket.create_connection(url) for i in range(10)]
+        # One reader thread per client, the writes all go through one thread
+        assert threading.active_count() == threads + 10
+        threaded_server.send_message_to_all("hello")
+        for conn in conns:
+            assert conn.recv() == "hello"
+        assert threading.active_count() == threads + 10
+        for conn in conns:
+            conn.close()
+
     def test_deny_new_connections(self, threaded_server):
         url = "ws://{}:{}".format(*threaded_server.server_address)
         server = threaded_server
@@ -0,0 +1,32 @@
+from time import sleep
+
+from websocket_server import unmask
+
+
+def unmask_bytewise(masks, payload):
+    return bytes(byte ^ masks[i % 4] for i, byte in enumerate(payload))
+
+
+def test_unmask_empty_payload():
+    assert unmask(b'\x01\x02\x03\x04', b'') == b''
+
+
+def test_unmask_matches_bytewise_xor():
+    masks = b'\x37\xfa\x21\x3d'
+    for length in (1, 3, 4, 5, 125, 126, 65535, 65536):
+        payload = bytes(i % 251 for i in range(length))
+        assert unmask(masks, payload) == unmask_bytewise(masks, payload)
+
+
+def test_unmask_keeps_leading_zero_bytes():
+    masks = b'\x00\x00\x00\x00'
+    assert unmask(masks, b'\x00\x00\x01') == b'\x00\x00\x01'
+
+
+def test_client_messages_are_unmasked(session):
+    conn, server = session
+    messages = ['$', 'a' * 125, 'b' * 126, '$äüö^' * 30, 'c' * 65536]
+    for message in messages:
+        conn.send(message)
+    sleep(0.5)
+    assert server.received_messages == messages
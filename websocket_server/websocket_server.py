@@ -2,17 +2,24 @@
 # License: MIT
 
 import sys
+import time
+import zlib
 import struct
 import ssl
 from base64 import b64encode
 from hashlib import sha1
 import logging
-from socket import error as SocketError
+from socket import error as SocketError, SHUT_RDWR
+import socket as socket_module
 import errno
 import threading
+from collections import deque
+from itertools import islice
 from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 
 from websocket_server.thread import WebsocketServerThread
+from websocket_server.deflate import PerMessageDeflate
+from websocket_server.writer import SocketWriter, can_share_writer, WRITE_IDLE, WRITE_BLOCKED, WRITE_DONE
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
@@ -34,6 +41,7 @@ logging.basicConfig()
 '''
 
 FIN    = 0x80
+RSV1   = 0x40
 OPCODE = 0x0f
 MASKED = 0x80
 PAYLOAD_LEN = 0x7f
@@ -48,8 +56,26 @@ OPCODE_PING         = 0x9
 OPCODE_PONG         = 0xA
 
 CLOSE_STATUS_NORMAL = 1000
+CLOSE_STATUS_PROTOCOL_ERROR = 1002
+CLOSE_STATUS_INVALID_DATA = 1007
+CLOSE_STATUS_MESSAGE_TOO_BIG = 1009
 DEFAULT_CLOSE_REASON = bytes('', encoding='utf-8')
 
+DEFAULT_SEND_QUEUE_LIMIT = 4 * 1024 * 1024  # bytes a client may fall behind before it is disconnected
+WRITER_FLUSH_TIMEOUT = 5  # seconds a closing connection gets to flush its send queue
+DEFAULT_COMPRESSION_THRESHOLD = 256  # bytes, shorter messages are not worth compressing
+DEFAULT_MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # bytes, after reassembly and decompression
+DEFAULT_MAX_FRAME_SIZE = 16 * 1024 * 1024  # bytes of payload in a single frame
+READ_BUFFER_SIZE = 64 * 1024  # bytes a connection reads at once, bigger frames get a buffer of their own
+MAX_FRAME_HEADER = 14  # bytes, with a 64 bit length and a masking key
+SHORT_HEADER = struct.Struct('!BB4s')  # masked frame with up to 125 bytes of payload
+SHORT_HEADER_SIZE = SHORT_HEADER.size
+MEDIUM_HEADER = struct.Struct('!BBH4s')  # masked frame with a 16 bit payload length
+MEDIUM_HEADER_SIZE = MEDIUM_HEADER.size
+MAX_SEND_BUFFERS = 512  # buffers per sendmsg, IOV_MAX is 1024 on Linux
+MAX_HEADER_LINE = 64 * 1024  # bytes, longer HTTP header lines are cut off
+DEFAULT_PING_TIMEOUT = 20  # seconds a client gets to answer a ping before it is disconnected
+
 
 class API():
 
@@ -65,6 +91,9 @@ class API():
     def message_received(self, client, server, message):
         pass
 
+    def message_received_binary(self, client, server, message):
+        pass
+
     def set_fn_new_client(self, fn):
         self.new_client = fn
 
@@ -74,12 +103,24 @@ class API():
     def set_fn_message_received(self, fn):
         self.message_received = fn
 
+    def set_fn_message_received_binary(self, fn):
+        self.message_received_binary = fn
+
     def send_message(self, client, msg):
         self._unicast(client, msg)
 
     def send_message_to_all(self, msg):
         self._multicast(msg)
 
+    def send_message_to_many(self, clients, msg):
+        self._multicast_to(clients, msg)
+
+    def send_binary(self, client, data):
+        self._unicast_binary(client, data)
+
+    def send_binary_to_many(self, clients, data):
+        self._multicast_to(clients, data, OPCODE_BINARY)
+
     def deny_new_connections(self, status=CLOSE_STATUS_NORMAL, reason=DEFAULT_CLOSE_REASON):
         self._deny_new_connections(status, reason)
 
@@ -98,115 +139,251 @@ class API():
     def disconnect_clients_abruptly(self):
         self._disconnect_clients_abruptly()
 
+    def get_send_queue_stats(self):
+        return self._get_send_queue_stats()
 
-class WebsocketServer(ThreadingMixIn, TCPServer, API):
-    """
-	A websocket server waiting for clients to connect.
+    def set_client_size_limits(self, client, max_message_size=None, max_frame_size=None):
+        self._set_client_size_limits(client, max_message_size, max_frame_size)
 
-    Args:
-        port(int): Port to bind to
-        host(str): Hostname or IP to listen for connections. By default 127.0.0.1
-            is being used. To accept connections from any client, you should use
-            0.0.0.0.
-        loglevel: Logging level from logging module to use for logging. By default
-            warnings and errors are being logged.
+    def get_heartbeat_stats(self):
+        return self._get_heartbeat_stats()
 
-    Properties:
-        clients(list): A list of connected clients. A client is a dictionary
-            like below.
-                {
-                 'id'      : id,
-                 'handler' : handler,
-                 'address' : (addr, port)
-                }
+
+class WebsocketServerBase(API):
     """
+    Client bookkeeping and message routing shared by the server backends.
+    A backend provides _run_forever, _terminate_client_handler, shutdown and
+    server_close.
 
-    allow_reuse_address = True
-    daemon_threads = True  # comment to keep threads alive until finished
+    Clients are kept in a dict keyed by their handler, so looking up the
+    client of an incoming message and removing a client are O(1).
 
-    def __init__(self, host='127.0.0.1', port=0, loglevel=logging.WARNING, key=None, cert=None):
-        logger.setLevel(loglevel)
-        TCPServer.__init__(self, (host, port), WebSocketHandler)
-        self.host = host
-        self.port = self.socket.getsockname()[1]
+    Sends only queue the frame on the client's handler, the backend writes it
+    out. A client that lets more than send_queue_limit bytes pile up is
+    disconnected, so one slow reader can't hold up a broadcast.
+    """
 
-        self.key = key
-        self.cert = cert
+    @property
+    def clients(self):
+        """
+        Snapshot of the connected clients, in connection order
+        """
+        with self._clients_lock:
+            return list(self._clients.values())
 
-        self.clients = []
-        self.id_counter = 0
-        self.thread = None
+    def _message_received_(self, handler, msg):
+        self.message_received(self.handler_to_client(handler), self, msg)
 
-        self._deny_clients = False
+    def _binary_message_received_(self, handler, msg):
+        self.message_received_binary(self.handler_to_client(handler), self, msg)
 
-    def _run_forever(self, threaded):
-        cls_name = self.__class__.__name__
-        try:
-            logger.info("Listening on port %d for clients.." % self.port)
-            if threaded:
-                self.daemon = True
-                self.thread = WebsocketServerThread(target=super().serve_forever, daemon=True, logger=logger)
-                logger.info(f"Starting {cls_name} on thread {self.thread.getName()}.")
-                self.thread.start()
-            else:
-                self.thread = threading.current_thread()
-                logger.info(f"Starting {cls_name} on main thread.")
-                super().serve_forever()
-        except KeyboardInterrupt:
-            self.server_close()
-            logger.info("Server terminated.")
-        except Exception as e:
-            logger.error(str(e), exc_info=True)
-            sys.exit(1)
+    def _data_message_received_(self, handler, opcode, compressed, payload):
+        """
+        Hand a complete text or binary message to its callback. Returns the
+        CLOSE status to fail the connection with if the message is unusable.
+        """
+        if compressed:
+            max_size = self._size_limits_(handler)[1]
+            try:
+                payload = handler.deflate.decompress(payload, max_size)
+            except zlib.error:
+                logger.warning("Client sent a message that does not inflate.")
+                return CLOSE_STATUS_INVALID_DATA
+            if payload is None:
+                logger.warning("Client sent a message that inflates past %d bytes." % max_size)
+                return CLOSE_STATUS_MESSAGE_TOO_BIG
+        if opcode == OPCODE_TEXT:
+            try:
+                msg = payload.decode('utf8')
+            except UnicodeDecodeError:
+                logger.warning("Client sent a text message that is not valid UTF-8.")
+                return CLOSE_STATUS_INVALID_DATA
+            self._message_received_(handler, msg)
+        else:
+            self._binary_message_received_(handler, payload)
 
-    def _message_received_(self, handler, msg):
-        self.message_received(self.handler_to_client(handler), self, msg)
+    def _size_limits_(self, handler):
+        """
+        The (frame, message) size limits of a connection, its own where
+        they were set and the server's otherwise
+        """
+        max_frame_size = handler.max_frame_size
+        if max_frame_size is None:
+            max_frame_size = self.max_frame_size
+        max_message_size = handler.max_message_size
+        if max_message_size is None:
+            max_message_size = self.max_message_size
+        return max_frame_size, max_message_size
+
+    def _set_client_size_limits(self, client, max_message_size, max_frame_size):
+        """
+        Give one client its own limits, None goes back to the server's
+        """
+        handler = client['handler']
+        handler.max_message_size = max_message_size
+        handler.max_frame_size = max_frame_size
 
     def _ping_received_(self, handler, msg):
         handler.send_pong(msg)
 
     def _pong_received_(self, handler, msg):
-        pass
+        handler.ping_sent = None
+
+    def _heartbeat_period_(self):
+        """
+        Seconds between two looks at the clients, often enough that neither
+        a ping nor a disconnect is much later than it should be
+        """
+        return min(self.ping_interval, self.ping_timeout) / 2
+
+    def _heartbeat_(self, now):
+        """
+        Ping the clients that have been quiet for ping_interval seconds and
+        disconnect the ones that let a ping go unanswered for ping_timeout
+        seconds. Anything a client sends counts as an answer. Called by the
+        backend every heartbeat period.
+        """
+        ping = None
+        for client in self.clients:
+            handler = client['handler']
+            if not handler.keep_alive:
+                continue  # Already on its way out
+            ping_sent = handler.ping_sent
+            if ping_sent is not None and handler.last_seen < ping_sent:
+                if now - ping_sent >= self.ping_timeout:
+                    self._reap_client_(handler, now - handler.last_seen)
+            elif now - handler.last_seen >= self.ping_interval:
+                if ping is None:
+                    ping = self._build_frame_(b'', OPCODE_PING)
+                handler.ping_sent = now
+                handler.send_frame(*ping)
+                self.pings_sent += 1
+
+    def _reap_client_(self, handler, idle):
+        """
+        Disconnect a client that stopped answering pings. The connection is
+        dropped without a CLOSE handshake, nobody is there to answer it,
+        and the client leaves through client_left like any other.
+        """
+        with self._clients_lock:
+            self.reaped += 1
+        logger.info("Client %s did not answer a ping, last heard from %.1f seconds ago. Disconnecting." % (handler.client_address, idle))
+        handler.abort()
+
+    def _get_heartbeat_stats(self):
+        return {
+            "ping_interval": self.ping_interval,
+            "ping_timeout": self.ping_timeout,
+            "pings_sent": self.pings_sent,
+            "reaped": self.reaped,
+        }
+
+    def _add_client_(self, handler):
+        """
+        Register the handler as a client unless new connections are denied.
+        Called by the handler before it sends the handshake response, while it
+        holds its send lock, so a client that saw the response is always listed
+        and a broadcast can not overtake the response.
+        """
+        with self._clients_lock:
+            if self._deny_clients:
+                handler.denied = self._deny_clients
+                return
+            self.id_counter += 1
+            client = {
+                'id': self.id_counter,
+                'handler': handler,
+                'address': handler.client_address
+            }
+            self._clients[handler] = client
 
     def _new_client_(self, handler):
-        if self._deny_clients:
-            status = self._deny_clients["status"]
-            reason = self._deny_clients["reason"]
-            handler.send_close(status, reason)
+        if handler.denied:
+            handler.send_close(handler.denied["status"], handler.denied["reason"])
             self._terminate_client_handler(handler)
             return
 
-        self.id_counter += 1
-        client = {
-            'id': self.id_counter,
-            'handler': handler,
-            'address': handler.client_address
-        }
-        self.clients.append(client)
+        client = self.handler_to_client(handler)
+        if client is None:
+            # Disconnected from another thread before it was announced
+            return
+
         self.new_client(client, self)
 
     def _client_left_(self, handler):
         client = self.handler_to_client(handler)
         self.client_left(client, self)
-        if client in self.clients:
-            self.clients.remove(client)
+        with self._clients_lock:
+            self._clients.pop(handler, None)
 
     def _unicast(self, receiver_client, msg):
         receiver_client['handler'].send_message(msg)
 
+    def _unicast_binary(self, receiver_client, data):
+        receiver_client['handler'].send_binary(data)
+
     def _multicast(self, msg):
-        for client in self.clients:
-            self._unicast(client, msg)
+        self._multicast_to(self.clients, msg)
+
+    def _multicast_to(self, clients, msg, opcode=OPCODE_TEXT):
+        """
+        Build each frame once and write the same bytes to every client that
+        takes it: one plain frame, and one compressed frame per window size
+        for clients with permessage-deflate but no context takeover
+        """
+        if opcode == OPCODE_BINARY:
+            payload = encode_binary(msg)
+        else:
+            payload = encode_message(msg)
+        if payload is False:
+            return
+        frames = {}
+        for client in list(clients):
+            handler = client['handler']
+            deflate = handler.deflate
+            if deflate is None or not deflate.wants(payload):
+                key = None
+            elif deflate.context_takeover:
+                handler.send_deflated(payload, opcode)
+                continue
+            else:
+                key = deflate.window_bits
+            frame = frames.get(key)
+            if frame is None:
+                if key is None:
+                    frame = self._build_frame_(payload, opcode)
+                else:
+                    frame = self._build_frame_(deflate.compress(payload), opcode, RSV1)
+                frames[key] = frame
+            handler.send_frame(*frame)
+
+    def _build_frame_(self, payload, opcode, rsv=0):
+        """
+        A frame as the buffers the backend's handlers queue, see send_frame
+        """
+        return (make_payload_frame(payload, opcode, rsv),)
 
     def handler_to_client(self, handler):
-        for client in self.clients:
-            if client['handler'] == handler:
-                return client
+        return self._clients.get(handler)
 
-    def _terminate_client_handler(self, handler):
-        handler.keep_alive = False
-        handler.finish()
-        handler.connection.close()
+    def _evict_client_(self, handler):
+        """
+        Disconnect a client whose send queue passed send_queue_limit
+        """
+        with self._clients_lock:
+            self.evictions += 1
+        logger.warning("Client %s is too slow, its send queue passed %d bytes. Disconnecting." % (handler.client_address, self.send_queue_limit))
+        handler.abort()
+
+    def _get_send_queue_stats(self):
+        depths = [client['handler'].queued_bytes() for client in self.clients]
+        return {
+            "clients": len(depths),
+            "queued_bytes": sum(depths),
+            "max_queued_bytes": max(depths, default=0),
+            "send_queue_limit": self.send_queue_limit,
+            "evictions": self.evictions,
+        }
 
     def _terminate_client_handlers(self):
         """
@@ -257,12 +434,168 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         self._deny_clients = False
 
 
+class WebsocketServer(ThreadingMixIn, TCPServer, WebsocketServerBase):
+    """
+	A websocket server waiting for clients to connect.
+
+    Args:
+        port(int): Port to bind to
+        host(str): Hostname or IP to listen for connections. By default 127.0.0.1
+            is being used. To accept connections from any client, you should use
+            0.0.0.0.
+        loglevel: Logging level from logging module to use for logging. By default
+            warnings and errors are being logged.
+        send_queue_limit(int): Bytes that may wait to be sent to one client
+            before it is disconnected as too slow. 0 never disconnects.
+        compression(bool): Offer permessage-deflate to clients that ask for it.
+        compression_threshold(int): Messages shorter than this many bytes are
+            sent uncompressed.
+        compression_context_takeover(bool): Keep a compressor per client
+            between messages. Compresses better, but costs memory per client
+            and broadcasts get compressed once per client instead of once.
+        max_message_size(int): Largest message a client may send, after
+            reassembling its frames and inflating it. Bigger messages close
+            the connection with status 1009. 0 means no limit.
+        max_frame_size(int): Largest frame payload a client may send. A
+            bigger frame closes the connection with status 1009 as soon as
+            its header is in, before any of the payload is read. 0 means no
+            limit.
+        ping_interval(float): Ping clients that have not sent anything for
+            this many seconds. 0 never pings.
+        ping_timeout(float): Disconnect clients that leave a ping
+            unanswered for this many seconds, so connections that died
+            without closing don't stay around.
+        reuse_port(bool): Bind with SO_REUSEPORT, so that several processes
+            can listen on the same port and the kernel spreads the
+            connections between them.
+
+    Properties:
+        clients(list): A list of connected clients. A client is a dictionary
+            like below.
+                {
+                 'id'      : id,
+                 'handler' : handler,
+                 'address' : (addr, port)
+                }
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True  # comment to keep threads alive until finished
+
+    def __init__(self, host='127.0.0.1', port=0, loglevel=logging.WARNING, key=None, cert=None, send_queue_limit=DEFAULT_SEND_QUEUE_LIMIT,
+                 compression=False, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, compression_context_takeover=False,
+                 max_message_size=DEFAULT_MAX_MESSAGE_SIZE, max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 ping_interval=0, ping_timeout=DEFAULT_PING_TIMEOUT, reuse_port=False):
+        logger.setLevel(loglevel)
+        TCPServer.__init__(self, (host, port), WebSocketHandler, bind_and_activate=False)
+        try:
+            if reuse_port:
+                self.socket.setsockopt(socket_module.SOL_SOCKET, socket_module.SO_REUSEPORT, 1)
+            self.server_bind()
+            self.server_activate()
+        except:
+            TCPServer.server_close(self)
+            raise
+        self.host = host
+        self.port = self.socket.getsockname()[1]
+
+        self.key = key
+        self.cert = cert
+
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self.id_counter = 0
+        self.thread = None
+
+        self.send_queue_limit = send_queue_limit
+        self.evictions = 0
+        self._writer = SocketWriter()
+
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_context_takeover = compression_context_takeover
+        self.max_message_size = max_message_size
+        self.max_frame_size = max_frame_size
+
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.pings_sent = 0
+        self.reaped = 0
+        self._heartbeat = None
+        self._heartbeat_stop = threading.Event()
+
+        self._deny_clients = False
+
+    def server_close(self):
+        super().server_close()
+        self._heartbeat_stop.set()
+        self._writer.stop()
+
+    def _build_frame_(self, payload, opcode, rsv=0):
+        return make_frame_parts(payload, opcode, rsv)
+
+    def _run_forever(self, threaded):
+        cls_name = self.__class__.__name__
+        try:
+            logger.info("Listening on port %d for clients.." % self.port)
+            self._start_heartbeat()
+            if threaded:
+                self.daemon = True
+                self.thread = WebsocketServerThread(target=super().serve_forever, daemon=True, logger=logger)
+                logger.info(f"Starting {cls_name} on thread {self.thread.getName()}.")
+                self.thread.start()
+            else:
+                self.thread = threading.current_thread()
+                logger.info(f"Starting {cls_name} on main thread.")
+                super().serve_forever()
+        except KeyboardInterrupt:
+            self.server_close()
+            logger.info("Server terminated.")
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            sys.exit(1)
+
+    def _start_heartbeat(self):
+        if self.ping_interval and self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+            self._heartbeat.start()
+
+    def _heartbeat_loop(self):
+        period = self._heartbeat_period_()
+        while not self._heartbeat_stop.wait(period):
+            try:
+                self._heartbeat_(time.monotonic())
+            except Exception as e:
+                logger.error(str(e), exc_info=True)
+
+    def _terminate_client_handler(self, handler):
+        handler.keep_alive = False
+        handler.finish()
+        handler.close_when_flushed()
+
+
 class WebSocketHandler(StreamRequestHandler):
 
     def __init__(self, socket, addr, server):
         self.server = server
+        self.denied = None
+        self.deflate = None
+        self._message = MessageAssembler()
+        self.max_message_size = None  # None uses the server's limits
+        self.max_frame_size = None
+        self.last_seen = time.monotonic()  # when the client last sent a frame
+        self.ping_sent = None  # when the server sent a ping still unanswered
         assert not hasattr(self, "_send_lock"), "_send_lock already exists"
         self._send_lock = threading.Lock()
+        self._send_ready = threading.Condition(self._send_lock)
+        self._send_queue = deque()
+        self._queued_bytes = 0  # queued plus being written
+        self._write_scheduled = False  # the shared writer will look at the queue again
+        self._write_error = False
+        self._flushed = threading.Event()  # the writer is done with the connection
+        self._send_closing = False
+        self._close_connection = False
+        self._evicted = False
         if server.key and server.cert:
             try:
                 socket = ssl.wrap_socket(socket, server_side=True, certfile=server.cert, keyfile=server.key)
@@ -272,36 +605,60 @@ class WebSocketHandler(StreamRequestHandler):
 
     def setup(self):
         StreamRequestHandler.setup(self)
+        self.reader = FrameReader(self.request)
         self.keep_alive = True
         self.handshake_done = False
         self.valid_client = False
+        if can_share_writer(self.request):
+            self._writer = self.server._writer
+        else:
+            # SSL sockets can't be written without blocking, they get a thread of their own
+            self._writer = None
+            threading.Thread(target=self._write_loop, daemon=True).start()
 
     def handle(self):
-        while self.keep_alive:
-            if not self.handshake_done:
-                self.handshake()
-            elif self.valid_client:
-                self.read_next_message()
+        try:
+            while self.keep_alive:
+                if not self.handshake_done:
+                    self.handshake()
+                elif self.valid_client:
+                    self.read_next_message()
+        finally:
+            # Let the writer flush before socketserver closes the connection
+            with self._send_ready:
+                self._send_closing = True
+                self._wake_writer(True)
+            if not self._flushed.wait(WRITER_FLUSH_TIMEOUT):
+                # Give up on a client that doesn't read, the writer has to let go of the socket before it is closed
+                with self._send_ready:
+                    self._write_error = True
+                    self._wake_writer(True)
+                self._flushed.wait(WRITER_FLUSH_TIMEOUT)
 
     def read_bytes(self, num):
-        return self.rfile.read(num)
+        """
+        The next num bytes from the client, fewer if it is gone. This is a
+        view of the connection's read buffer that is only valid until the
+        next read, copy what has to be kept.
+        """
+        return self.reader.read(num)
 
     def read_next_message(self):
         try:
-            b1, b2 = self.read_bytes(2)
-        except SocketError as e:  # to be replaced with ConnectionResetError for py3
-            if e.errno == errno.ECONNRESET:
-                logger.info("Client closed connection.")
-                self.keep_alive = 0
-                return
-            b1, b2 = 0, 0
-        except ValueError as e:
-            b1, b2 = 0, 0
+            frame = self.reader.read_frame()
+        except (SocketError, ValueError):
+            frame = None
+        if frame is None:
+            logger.info("Client closed connection.")
+            self.keep_alive = 0
+            return
+        self.last_seen = time.monotonic()
+        b1, b2, payload_length, masks, payload = frame
 
         fin    = b1 & FIN
+        rsv1   = b1 & RSV1
         opcode = b1 & OPCODE
         masked = b2 & MASKED
-        payload_length = b2 & PAYLOAD_LEN
 
         if opcode == OPCODE_CLOSE_CONN:
             logger.info("Client asked to close connection.")
@@ -311,14 +668,8 @@ class WebSocketHandler(StreamRequestHandler):
             logger.warning("Client must always be masked.")
             self.keep_alive = 0
             return
-        if opcode == OPCODE_CONTINUATION:
-            logger.warning("Continuation frames are not supported.")
-            return
-        elif opcode == OPCODE_BINARY:
-            logger.warning("Binary frames are not supported.")
-            return
-        elif opcode == OPCODE_TEXT:
-            opcode_handler = self.server._message_received_
+        if opcode in (OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY):
+            opcode_handler = None
         elif opcode == OPCODE_PING:
             opcode_handler = self.server._ping_received_
         elif opcode == OPCODE_PONG:
@@ -328,21 +679,45 @@ class WebSocketHandler(StreamRequestHandler):
             self.keep_alive = 0
             return
 
-        if payload_length == 126:
-            payload_length = struct.unpack(">H", self.rfile.read(2))[0]
-        elif payload_length == 127:
-            payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
+        # Checked before the payload is read, so a huge length is never buffered
+        status = self._message.check_frame(fin, opcode, rsv1, payload_length, self.deflate, *self.server._size_limits_(self))
+        if status:
+            self._fail(status)
+            return
+
+        if payload is None:
+            payload = self.read_bytes(payload_length)
+        payload = unmask(masks, payload)
+        if opcode_handler is not None:
+            opcode_handler(self, payload.decode('utf8'))
+            return
 
-        masks = self.read_bytes(4)
-        message_bytes = bytearray()
-        for message_byte in self.read_bytes(payload_length):
-            message_byte ^= masks[len(message_bytes) % 4]
-            message_bytes.append(message_byte)
-        opcode_handler(self, message_bytes.decode('utf8'))
+        message = self._message.add_frame(fin, opcode, rsv1, payload)
+        if message is not None:
+            status = self.server._data_message_received_(self, *message)
+            if status:
+                self._fail(status)
+
+    def _fail(self, status):
+        """
+        Close the connection because of something the client sent, status
+        is one of the CLOSE codes of RFC 6455 section 7.4.1
+        """
+        self.send_close(status)
+        self.keep_alive = 0
 
     def send_message(self, message):
         self.send_text(message)
 
+    def send_binary(self, data):
+        payload = encode_binary(data)
+        if payload is False:
+            return False
+        if self.deflate and self.deflate.wants(payload):
+            self.send_deflated(payload, OPCODE_BINARY)
+        else:
+            self.send_frame(*make_frame_parts(payload, OPCODE_BINARY))
+
     def send_pong(self, message):
         self.send_text(message, OPCODE_PONG)
 
@@ -357,69 +732,207 @@ class WebSocketHandler(StreamRequestHandler):
         if status < CLOSE_STATUS_NORMAL or status > 1015:
             raise Exception(f"CLOSE status must be between 1000 and 1015, got {status}")
 
-        header = bytearray()
-        payload = struct.pack('!H', status) + reason
-        payload_length = len(payload)
-        assert payload_length <= 125, "We only support short closing reasons at the moment"
-
         # Send CLOSE with status & reason
-        header.append(FIN | OPCODE_CLOSE_CONN)
-        header.append(payload_length)
-        with self._send_lock:
-            self.request.send(header + payload)
+        self.send_frame(make_close_frame(status, reason))
 
     def send_text(self, message, opcode=OPCODE_TEXT):
         """
         Important: Fragmented(=continuation) messages are not supported since
         their usage cases are limited - when we don't know the payload length.
         """
+        payload = encode_message(message)
+        if payload is False:
+            return False
+        if opcode == OPCODE_TEXT and self.deflate and self.deflate.wants(payload):
+            self.send_deflated(payload)
+        else:
+            self.send_frame(*make_frame_parts(payload, opcode))
 
-        # Validate message
-        if isinstance(message, bytes):
-            message = try_decode_UTF8(message)  # this is slower but ensures we have UTF-8
-            if not message:
-                logger.warning("Can\'t send message, message is not valid UTF-8")
-                return False
-        elif not isinstance(message, str):
-            logger.warning('Can\'t send message, message has to be a string or bytes. Got %s' % type(message))
+    def send_deflated(self, payload, opcode=OPCODE_TEXT):
+        """
+        Compress and queue a text or binary message, see PerMessageDeflate
+        """
+        if not self.deflate.context_takeover:
+            self.send_frame(*make_frame_parts(self.deflate.compress(payload), opcode, RSV1))
+            return
+        # The compressor has to see the messages in the order they are queued
+        with self._send_ready:
+            evict = self._queue_frame(*make_frame_parts(self.deflate.compress(payload), opcode, RSV1))
+        if evict:
+            self.server._evict_client_(self)
+
+    def send_frame(self, *buffers):
+        """
+        Queue an already built frame for the writer, see make_frame. The
+        frame can come in parts, like the header and payload from
+        make_frame_parts, which are written back to back without being
+        joined.
+        """
+        with self._send_ready:
+            evict = self._queue_frame(*buffers)
+        if evict:
+            self.server._evict_client_(self)
+
+    def _queue_frame(self, *buffers):
+        """
+        Append a frame to the send queue, the caller holds _send_lock.
+        Returns True if the frame would take the queue past the server's
+        send_queue_limit, the queue is dropped and the client has to go.
+        A frame always fits into an empty queue.
+        """
+        if self._send_closing or self._evicted:
             return False
+        size = 0
+        for buffer in buffers:
+            size += len(buffer)
+        limit = self.server.send_queue_limit
+        if limit and self._queued_bytes and self._queued_bytes + size > limit:
+            self._evicted = True
+            self._send_queue.clear()
+            self._wake_writer(True)
+            return True
+        for buffer in buffers:
+            if buffer:  # An empty payload would never be taken off the queue
+                self._send_queue.append(buffer)
+        self._queued_bytes += size
+        self._wake_writer()
+        return False
 
-        header  = bytearray()
-        payload = encode_to_UTF8(message)
-        payload_length = len(payload)
+    def _wake_writer(self, always=False):
+        """
+        Tell the writer there is something to do, the caller holds
+        _send_lock. The shared writer is only woken if it isn't going to
+        look at this connection anyway, unless always is set.
+        """
+        if self._writer is None:
+            self._send_ready.notify()
+        elif always or not self._write_scheduled:
+            self._write_scheduled = True
+            self._writer.wake(self)
 
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
+    def _take_frames(self):
+        """
+        Everything queued as one bytes object, for sockets that can't
+        gather buffers. The caller holds _send_lock.
+        """
+        if len(self._send_queue) == 1:
+            return self._send_queue.popleft()
+        data = b''.join(self._send_queue)
+        self._send_queue.clear()
+        return data
 
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
+    def write_some(self):
+        """
+        Called by the server's SocketWriter: send as much as the socket
+        takes without blocking. The queued buffers go out with one sendmsg
+        from where they are, so neither a frame's header and payload nor
+        the frames are copied together first. Returns one of the WRITE_
+        states.
+        """
+        while True:
+            with self._send_ready:
+                if self._evicted or self._write_error:
+                    self._send_queue.clear()
+                    self._queued_bytes = 0
+                    return WRITE_DONE
+                if not self._send_queue:
+                    if self._send_closing:
+                        return WRITE_DONE
+                    self._write_scheduled = False
+                    return WRITE_IDLE
+                if len(self._send_queue) <= MAX_SEND_BUFFERS:
+                    buffers = list(self._send_queue)
+                else:
+                    buffers = list(islice(self._send_queue, MAX_SEND_BUFFERS))
+            try:
+                sent = self.request.sendmsg(buffers, (), socket_module.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return WRITE_BLOCKED
+            except (SocketError, ValueError):
+                self.write_failed()
+                continue
+            with self._send_ready:
+                if self._evicted or self._write_error:
+                    continue  # The queue was dropped while we were sending
+                self._queued_bytes -= sent
+                queue = self._send_queue
+                while sent:
+                    size = len(queue[0])
+                    if size > sent:
+                        # The socket is full, keep the rest for when it is writable
+                        queue[0] = memoryview(queue[0])[sent:]
+                        return WRITE_BLOCKED
+                    queue.popleft()
+                    sent -= size
+
+    def write_failed(self):
+        with self._send_ready:
+            self._write_error = True
+
+    def write_finished(self):
+        """
+        Called by the SocketWriter once it is done with the connection
+        """
+        if self._close_connection:
+            self.connection.close()
+        self._flushed.set()
 
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
+    def _write_loop(self):
+        """
+        Write out the send queue of a connection that can't use the shared
+        writer, on its own thread so that a client which reads slowly only
+        ever blocks this thread and not its senders. Everything queued by
+        the time the writer wakes up goes out in one sendall.
+        """
+        while True:
+            with self._send_ready:
+                while not (self._send_queue or self._send_closing or self._evicted or self._write_error):
+                    self._send_ready.wait()
+                if self._evicted or self._write_error or not self._send_queue:
+                    break
+                data = self._take_frames()
+            try:
+                self.request.sendall(data)
+            except (SocketError, ValueError):
+                with self._send_ready:
+                    self._send_closing = True
+                    self._send_queue.clear()
+                    self._queued_bytes = 0
+                break
+            with self._send_ready:
+                self._queued_bytes -= len(data)
+        self.write_finished()
 
-        else:
-            raise Exception("Message is too big. Consider breaking it into chunks.")
-            return
+    def queued_bytes(self):
+        return self._queued_bytes
 
-        with self._send_lock:
-            self.request.send(header + payload)
+    def close_when_flushed(self):
+        """
+        Stop taking frames and close the connection once the queued ones are sent
+        """
+        with self._send_ready:
+            self._send_closing = True
+            self._close_connection = True
+            self._wake_writer(True)
+
+    def abort(self):
+        """
+        Drop the connection right away, unblocking both the reader and the writer
+        """
+        self.keep_alive = False
+        try:
+            self.request.shutdown(SHUT_RDWR)
+        except (SocketError, ValueError):
+            pass
 
     def read_http_headers(self):
         headers = {}
         # first line should be HTTP GET
-        http_get = self.rfile.readline().decode().strip()
+        http_get = self.reader.readline().decode().strip()
         assert http_get.upper().startswith('GET')
         # remaining should be headers
         while True:
-            header = self.rfile.readline().decode().strip()
+            header = self.reader.readline().decode().strip()
             if not header:
                 break
             head, value = header.split(':', 1)
@@ -442,27 +955,38 @@ class WebSocketHandler(StreamRequestHandler):
             self.keep_alive = False
             return
 
-        response = self.make_handshake_response(key)
-        with self._send_lock:
-            self.handshake_done = self.request.send(response.encode())
-        self.valid_client = True
         # patch by meower
-        
         self.ip = headers.get('cf-connecting-ip', self.client_address[0])
         # end patch by meower
 
-        self.server._new_client_(self)
+        extensions = None
+        if self.server.compression and 'sec-websocket-extensions' in headers:
+            self.deflate, extensions = PerMessageDeflate.negotiate(
+                headers['sec-websocket-extensions'], self.server.compression_threshold, self.server.compression_context_takeover)
 
+        response = self.make_handshake_response(key, extensions)
+        with self._send_ready:
+            self.server._add_client_(self)
+            self._queue_frame(response.encode())
+            self.handshake_done = True
+            self.valid_client = True
+
+        self.server._new_client_(self)
 
 
     @classmethod
-    def make_handshake_response(cls, key):
+    def make_handshake_response(cls, key, extensions=None):
+        if extensions:
+            extensions = 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+        else:
+            extensions = ''
         return \
           'HTTP/1.1 101 Switching Protocols\r\n'\
           'Upgrade: websocket\r\n'              \
           'Connection: Upgrade\r\n'             \
           'Sec-WebSocket-Accept: %s\r\n'        \
-          '\r\n' % cls.calculate_response_key(key)
+          '%s'                                   \
+          '\r\n' % (cls.calculate_response_key(key), extensions)
 
     @classmethod
     def calculate_response_key(cls, key):
@@ -475,6 +999,326 @@ class WebSocketHandler(StreamRequestHandler):
         self.server._client_left_(self)
 
 
+class FrameReader():
+    """
+    Reads a connection in chunks of up to READ_BUFFER_SIZE bytes into a
+    buffer that is reused for its whole life. One recv usually brings in
+    several small frames, which are then handed out as memoryview slices
+    of the buffer without another syscall or copy. A payload too big for
+    the buffer is read into a buffer of its own.
+    """
+
+    def __init__(self, sock, size=READ_BUFFER_SIZE):
+        self.sock = sock
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte not handed out yet
+        self._end = 0  # end of the bytes received
+
+    def _compact(self):
+        """
+        Move the bytes not handed out yet to the front of the buffer
+        """
+        unread = self._end - self._start
+        self._view[:unread] = self._view[self._start:self._end]
+        self._start, self._end = 0, unread
+
+    def _fill(self):
+        """
+        Receive once into the free end of the buffer. Returns the number of
+        bytes received, 0 once the client is gone.
+        """
+        if self._end == len(self._buffer):
+            self._compact()
+        received = self.sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def read(self, num):
+        """
+        The next num bytes, fewer if the client is gone. The memoryview is
+        only valid until the next read.
+        """
+        start = self._start
+        if start + num <= self._end:
+            self._start = start + num
+            return self._view[start:start + num]
+        if num > len(self._buffer):
+            return self._read_large(num)
+        if self._start + num > len(self._buffer):
+            self._compact()
+        while self._end - self._start < num:
+            if not self._fill():
+                num = self._end - self._start
+                break
+        data = self._view[self._start:self._start + num]
+        self._start += num
+        return data
+
+    def read_frame(self):
+        """
+        The next frame as (b1, b2, payload_length, masks, payload). masks is
+        None if the frame is not masked. A masked frame with a 7 or 16 bit
+        length that is buffered whole, as most are, comes with its payload,
+        still masked, in one call. Otherwise payload is None and the caller reads it once
+        it has checked the header. Returns None once the client is gone.
+        """
+        start = self._start
+        end = self._end
+        if start == end:
+            # Nothing buffered, wait for the next chunk
+            self._start = self._end = start = 0
+            end = self._fill()
+            if not end:
+                return None
+        # Fast path for the usual frame: masked, up to 64 KiB and with its header buffered
+        if end - start >= SHORT_HEADER_SIZE:
+            b1, b2, masks = SHORT_HEADER.unpack_from(self._buffer, start)
+            payload_length = b2 & PAYLOAD_LEN
+            if b2 & MASKED:
+                if payload_length < PAYLOAD_LEN_EXT16:
+                    start += SHORT_HEADER_SIZE
+                elif payload_length == PAYLOAD_LEN_EXT16 and end - start >= MEDIUM_HEADER_SIZE:
+                    b1, b2, payload_length, masks = MEDIUM_HEADER.unpack_from(self._buffer, start)
+                    start += MEDIUM_HEADER_SIZE
+                else:
+                    payload_length = None
+                if payload_length is not None:
+                    stop = start + payload_length
+                    if stop <= end:
+                        self._start = stop
+                        if not payload_length:
+                            return b1, b2, 0, masks, b''
+                        return b1, b2, payload_length, masks, self._view[start:stop]
+                    self._start = start
+                    return b1, b2, payload_length, masks, None
+        header = self._read_header()
+        if header is None:
+            return None
+        return header + (None,)
+
+    def _read_header(self):
+        """
+        (b1, b2, payload_length, masks) of a header that may still have to
+        be received, None once the client is gone
+        """
+        head = self.read(2)
+        if len(head) < 2:
+            return None
+        b1, b2 = head
+        payload_length = b2 & PAYLOAD_LEN
+        if payload_length == PAYLOAD_LEN_EXT16:
+            extended = self.read(2)
+            if len(extended) < 2:
+                return None
+            payload_length = struct.unpack(">H", extended)[0]
+        elif payload_length == PAYLOAD_LEN_EXT64:
+            extended = self.read(8)
+            if len(extended) < 8:
+                return None
+            payload_length = struct.unpack(">Q", extended)[0]
+        masks = None
+        if b2 & MASKED:
+            masks = bytes(self.read(4))
+            if len(masks) < 4:
+                return None
+        return b1, b2, payload_length, masks
+
+    def _read_large(self, num):
+        data = memoryview(bytearray(num))
+        filled = self._end - self._start
+        data[:filled] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        while filled < num:
+            received = self.sock.recv_into(data[filled:])
+            if not received:
+                break
+            filled += received
+        return data[:filled]
+
+    def readline(self, limit=MAX_HEADER_LINE):
+        """
+        The next line including its newline, for the HTTP handshake
+        """
+        while True:
+            end = self._buffer.find(b'\n', self._start, self._end)
+            if end >= 0:
+                end += 1
+                break
+            if self._end - self._start >= limit or not self._fill():
+                end = self._end
+                break
+        line = bytes(self._view[self._start:end])
+        self._start = end
+        return line
+
+
+class MessageAssembler():
+    """
+    Reassembles a client's fragmented messages. The frames' payloads are
+    collected in a list and joined once the last one is in, an unfragmented
+    message is passed on as it is.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.opcode = None  # of the message being assembled, None between messages
+        self.compressed = False
+        self.chunks = []
+        self.size = 0
+
+    def check_frame(self, fin, opcode, rsv1, payload_length, deflate, max_frame_size=0, max_size=0):
+        """
+        Validate a frame header before its payload is read. Returns the CLOSE
+        status to fail the connection with, or None if the frame is fine.
+        """
+        if opcode >= OPCODE_CLOSE_CONN:
+            if rsv1 or not fin or payload_length > 125:
+                logger.warning("Control frames must be short, unfragmented and uncompressed.")
+                return CLOSE_STATUS_PROTOCOL_ERROR
+            return None
+        if opcode == OPCODE_CONTINUATION:
+            if self.opcode is None:
+                logger.warning("Continuation frame without a message to continue.")
+                return CLOSE_STATUS_PROTOCOL_ERROR
+            if rsv1:
+                logger.warning("RSV1 is only allowed on the first frame of a message.")
+                return CLOSE_STATUS_PROTOCOL_ERROR
+        else:
+            if self.opcode is not None:
+                logger.warning("New message before the last one was finished.")
+                return CLOSE_STATUS_PROTOCOL_ERROR
+            if rsv1 and deflate is None:
+                logger.warning("RSV1 is only allowed with permessage-deflate.")
+                return CLOSE_STATUS_PROTOCOL_ERROR
+        if max_frame_size and payload_length > max_frame_size:
+            logger.warning("Client sent a frame of more than %d bytes." % max_frame_size)
+            return CLOSE_STATUS_MESSAGE_TOO_BIG
+        if max_size and self.size + payload_length > max_size:
+            logger.warning("Client sent a message of more than %d bytes." % max_size)
+            return CLOSE_STATUS_MESSAGE_TOO_BIG
+        return None
+
+    def add_frame(self, fin, opcode, rsv1, payload):
+        """
+        Add the payload of a checked data frame. Returns (opcode, compressed,
+        payload) once the message is complete, otherwise None.
+        """
+        if opcode != OPCODE_CONTINUATION:
+            if fin:
+                return opcode, bool(rsv1), payload
+            self.opcode = opcode
+            self.compressed = bool(rsv1)
+        self.chunks.append(payload)
+        self.size += len(payload)
+        if not fin:
+            return None
+        message = (self.opcode, self.compressed, b''.join(self.chunks))
+        self._reset()
+        return message
+
+
+def unmask(masks, payload):
+    """
+    XOR a client payload with its 4-byte masking key in one go
+
+    The payload and the key repeated to the same length are read as two wide
+    integers, so the XOR runs in C instead of a Python loop per byte.
+    """
+    payload_length = len(payload)
+    if not payload_length:
+        return b''
+    key = (masks * ((payload_length + 3) // 4))[:payload_length]
+    result = int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')
+    return result.to_bytes(payload_length, 'little')
+
+
+def make_frame_header(opcode, payload_length, rsv=0):
+    # Normal payload
+    if payload_length <= 125:
+        return struct.pack(">BB", FIN | rsv | opcode, payload_length)
+
+    # Extended payload
+    elif payload_length >= 126 and payload_length <= 65535:
+        return struct.pack(">BBH", FIN | rsv | opcode, PAYLOAD_LEN_EXT16, payload_length)
+
+    # Huge extended payload
+    elif payload_length < 18446744073709551616:
+        return struct.pack(">BBQ", FIN | rsv | opcode, PAYLOAD_LEN_EXT64, payload_length)
+
+    else:
+        raise Exception("Message is too big. Consider breaking it into chunks.")
+
+
+def make_frame(message, opcode=OPCODE_TEXT):
+    """
+    Build a complete unmasked server frame, or return False if the message
+    can't be sent. Shared by every server backend.
+    """
+    payload = encode_message(message)
+    if payload is False:
+        return False
+    return make_payload_frame(payload, opcode)
+
+
+def make_payload_frame(payload, opcode=OPCODE_TEXT, rsv=0):
+    """
+    Build a complete unmasked server frame around an encoded payload
+    """
+    return make_frame_header(opcode, len(payload), rsv) + payload
+
+
+def make_frame_parts(payload, opcode=OPCODE_TEXT, rsv=0):
+    """
+    make_payload_frame as (header, payload), for a writer that gathers the
+    two with sendmsg instead of copying the payload behind the header
+    """
+    return make_frame_header(opcode, len(payload), rsv), payload
+
+
+def encode_message(message):
+    """
+    The UTF-8 payload of a message, or False if the message can't be sent.
+    Bytes and memoryviews are already encoded, they are only checked and
+    then sent as they are.
+    """
+    if isinstance(message, str):
+        return encode_to_UTF8(message)
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        payload = encode_binary(message)
+        if not is_UTF8(payload):
+            logger.warning("Can\'t send message, message is not valid UTF-8")
+            return False
+        return payload
+    logger.warning('Can\'t send message, message has to be a string or bytes. Got %s' % type(message))
+    return False
+
+
+def encode_binary(data):
+    """
+    The payload of a binary message, or False if the data can't be sent.
+    A memoryview is sent without copying it, so it must not change until
+    it is written.
+    """
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, memoryview):
+        return data.cast('B')
+    if isinstance(data, bytearray):
+        return bytes(data)
+    logger.warning('Can\'t send binary message, data has to be bytes. Got %s' % type(data))
+    return False
+
+
+def make_close_frame(status=CLOSE_STATUS_NORMAL, reason=DEFAULT_CLOSE_REASON):
+    payload = struct.pack('!H', status) + reason
+    payload_length = len(payload)
+    assert payload_length <= 125, "We only support short closing reasons at the moment"
+    return make_frame_header(OPCODE_CLOSE_CONN, payload_length) + payload
+
+
 def encode_to_UTF8(data):
     try:
         return data.encode('UTF-8')
@@ -486,6 +1330,20 @@ def encode_to_UTF8(data):
         return False
 
 
+def is_UTF8(data):
+    """
+    Whether data is valid UTF-8. ASCII, which JSON usually is, is checked
+    without decoding it.
+    """
+    if isinstance(data, bytes) and data.isascii():
+        return True
+    try:
+        str(data, 'utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
 def try_decode_UTF8(data):
     try:
         return data.decode('utf-8')
@@ -0,0 +1,131 @@
+# License: MIT
+
+import socket
+import logging
+import selectors
+import threading
+
+logger = logging.getLogger(__name__)
+
+'''
+What WebSocketHandler.write_some reports back to the SocketWriter
+'''
+WRITE_IDLE = 0     # everything queued is written
+WRITE_BLOCKED = 1  # the socket is full, try again once it is writable
+WRITE_DONE = 2     # the connection is closing and has nothing left to write
+
+
+def can_share_writer(sock):
+    """
+    Whether a connection can be written by a SocketWriter. That needs
+    non-blocking sends on a socket that the reader keeps using in blocking
+    mode, which MSG_DONTWAIT gives us, and sendmsg to gather the queued
+    buffers. SSL sockets take neither.
+    """
+    return hasattr(socket, 'MSG_DONTWAIT') and hasattr(sock, 'sendmsg') and not hasattr(sock, 'getpeercert')
+
+
+class SocketWriter():
+    """
+    Writes the send queues of all of a server's connections from one thread.
+
+    Senders queue frames on their handler and wake the writer. The writer
+    sends what each socket takes without blocking, and waits with a selector
+    for the sockets that are full, so a client that reads slowly costs a
+    selector entry instead of a thread. The thread is started on the first
+    wake and exits once the writer is stopped and has nothing left to do.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []  # handlers woken since the writer last looked
+        self._woken = False  # a wake-up byte is on its way
+        self._stopping = False
+        self._thread = None
+        self._selector = None
+        self._wake_r = self._wake_w = None
+
+    def wake(self, handler):
+        """
+        Have the writer look at a handler's send queue, from any thread
+        """
+        with self._lock:
+            self._pending.append(handler)
+            if self._thread is None:
+                self._start()
+            elif self._woken:
+                return
+            self._woken = True
+            wake_w = self._wake_w
+        try:
+            wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # A full socketpair wakes the writer just as well
+
+    def stop(self):
+        """
+        Let the thread exit once every connection has been written out
+        """
+        with self._lock:
+            self._stopping = True
+            if self._thread is not None:
+                self._woken = True
+                try:
+                    self._wake_w.send(b'\0')
+                except OSError:
+                    pass
+
+    def _start(self):
+        # Called with _lock held
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, args=(self._selector, self._wake_r, self._wake_w), daemon=True)
+        self._thread.start()
+
+    def _run(self, selector, wake_r, wake_w):
+        blocked = set()
+        try:
+            while True:
+                ready = [key.data for key, events in selector.select() if key.data is not None]
+                with self._lock:
+                    pending = self._pending
+                    self._pending = []
+                    self._woken = False
+                    if self._stopping and not pending and not blocked:
+                        self._thread = None
+                        break
+                try:
+                    while wake_r.recv(4096):
+                        pass
+                except (BlockingIOError, OSError):
+                    pass
+                for handler in pending + ready:
+                    self._write(selector, blocked, handler)
+                # Don't keep finished handlers, and with them their sockets, alive while waiting
+                pending = ready = handler = None
+        finally:
+            selector.close()
+            wake_r.close()
+            wake_w.close()
+
+    def _write(self, selector, blocked, handler):
+        try:
+            state = handler.write_some()
+            if state == WRITE_BLOCKED:
+                if handler not in blocked:
+                    selector.register(handler.request, selectors.EVENT_WRITE, handler)
+                    blocked.add(handler)
+                return
+        except Exception as e:
+            logger.error("Error writing to %s: %s" % (handler.client_address, e), exc_info=True)
+            handler.write_failed()
+            state = WRITE_DONE
+        if handler in blocked:
+            selector.unregister(handler.request)
+            blocked.discard(handler)
+        if state == WRITE_DONE:
+            # Only now that the selector let go of the socket may it be closed
+            handler.write_finished()